@@ -0,0 +1,127 @@
+import collections
+
+import eventlet
+
+DROP_NEWEST = 'drop-newest'
+DROP_OLDEST = 'drop-oldest'
+COALESCE = 'coalesce'
+OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST, COALESCE)
+# superseded messages are compacted out of the queue once there are more
+# of them than this and than queued messages
+MAX_TOMBSTONES = 64
+
+# A queued message. body is the encoded bulk body, key identifies the
+# document it acts on (None for multi-document bodies).
+Message = collections.namedtuple('Message', 'exchange routing_key body key')
+
+
+class PublishBuffer(eventlet.queue.Queue):
+    """
+    Queue of Messages bounded by the total size of their bodies as well as
+    their number.
+
+    Blocking puts wait for room. Non-blocking puts that don't fit follow
+    the overflow policy:
+
+      drop-newest: the new message is refused with eventlet.queue.Full.
+      drop-oldest: the oldest queued messages are dropped to make room.
+      coalesce: a message supersedes the one queued for the same document,
+          whether the buffer is full or not; when that doesn't make room
+          the new message is refused.
+
+    A superseding message is queued last, behind anything queued for its
+    document in between, such as keyless partial updates.
+
+    Dropped and superseded messages are counted in dropped and coalesced,
+    both count as done for join.
+
+    :param max_bytes: Total body size, a single larger message is accepted
+        into an empty buffer.
+    :param maxsize: Number of messages, None for no limit.
+    """
+
+    def __init__(self, max_bytes, maxsize=None, overflow=DROP_NEWEST):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy %r' % overflow)
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.bytes = 0
+        self.live = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.keyed = {}
+        self.space = eventlet.queue.LightQueue(1)
+        eventlet.queue.Queue.__init__(self, maxsize)
+
+    def qsize(self):
+        return self.live
+
+    def _fits(self, message, supersedes=None):
+        live, size = self.live, self.bytes
+        if supersedes:
+            live -= 1
+            size -= len(supersedes[0].body)
+        if not live:
+            return True
+        if self.maxsize is not None and live >= self.maxsize:
+            return False
+        return size + len(message.body) <= self.max_bytes
+
+    def put(self, message, block=True, timeout=None):
+        if self.overflow == COALESCE and message.key is not None:
+            entry = self.keyed.get(message.key)
+            if entry and self._fits(message, entry):
+                self._remove(entry)
+                self.coalesced += 1
+                self.task_done()
+                self._compact()
+
+        while not self._fits(message):
+            if not block:
+                if self.overflow != DROP_OLDEST:
+                    raise eventlet.queue.Full()
+                self._get()
+                self.dropped += 1
+                self.task_done()
+                continue
+            try:
+                self.space.get(True, timeout)
+            except eventlet.queue.Empty:
+                raise eventlet.queue.Full()
+
+        entry = [message]
+        if self.overflow == COALESCE and message.key is not None:
+            self.keyed[message.key] = entry
+        eventlet.queue.Queue.put(self, entry, False)
+
+    def _put(self, entry):
+        self.bytes += len(entry[0].body)
+        self.live += 1
+        eventlet.queue.Queue._put(self, entry)
+
+    def _remove(self, entry):
+        """Leaves a queued entry in place as an empty tombstone."""
+        message = entry[0]
+        entry[0] = None
+        self.bytes -= len(message.body)
+        self.live -= 1
+        if self.keyed.get(message.key) is entry:
+            del self.keyed[message.key]
+        try:
+            self.space.put_nowait(None)
+        except eventlet.queue.Full:
+            pass
+        return message
+
+    def _compact(self):
+        """Drops the tombstones from the queue once they outnumber both
+        MAX_TOMBSTONES and the queued messages."""
+        if len(self.queue) - self.live > max(MAX_TOMBSTONES, self.live):
+            self.queue = collections.deque(
+                entry for entry in self.queue if entry[0] is not None)
+
+    def _get(self):
+        entry = self.queue.popleft()
+        while entry[0] is None:
+            entry = self.queue.popleft()
+        return self._remove(entry)
@@ -1,28 +1,217 @@
 #!/usr/bin/env python
 import sys
 import os
+import errno
 import time
 import signal
-import pyes
 import json
 import logging
+import eventlet
+from contextlib import contextmanager
+from eventlet import pools
 from swiftclient.client import HTTPConnection
 from swiftclient import client
 from urlparse import urlparse
-from copy import copy
 
-from swift.common.utils import get_logger, drop_privileges
+from swift.common.utils import get_logger, drop_privileges, readconf, \
+    TRUE_VALUES
 from swift.common.daemon import Daemon
 from swiftclient import get_account, get_container, head_object, \
-    ClientException, get_auth_1_0, encode_utf8
+    ClientException, encode_utf8
 
 from swearch.index import ObjectUpdateHandler, ContainerUpdateHandler, \
-    get_search_client
+    get_search_client, get_index_id, get_routing, stale_docs, \
+    timestamp_version, LISTING_FIELDS
 from swearch.rabbit import RabbitMQElasticIndexer
+from swearch.fingerprint import container_fingerprint, get_fingerprint_store
+from swearch import metrics
 
+QUEUE_TYPES = ['object', 'container', 'account']
+PROXY_URL = 'http://127.0.0.1'
+# lowest messages/s a worker is paced at, the rate can't reach 0
+MIN_RATE = 0.01
 
 
-class IndexWorker(Daemon):
+def green_worker_process(conf, queue):
+    """Monkey patches the process of a worker handling several messages of
+    queue at once, as handlers only overlap while waiting on green sockets.
+    Call before the worker is built, so its connections are green too."""
+    if int(conf.get('queue', {}).get('%s_concurrency' % queue, 1)) > 1:
+        eventlet.monkey_patch(all=False, socket=True, select=True,
+                              thread=True, time=True)
+
+
+class SwiftConnectionPool(pools.Pool):
+    """
+    Keep-alive connections to the proxy at ``url``.
+
+    Connections idle for longer than ``idle_timeout`` seconds, or that
+    failed with anything but an HTTP error, are replaced by new ones.
+    """
+
+    def __init__(self, url, max_size=1, idle_timeout=60, timeout=10):
+        self.url = encode_utf8(url)
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.last_used = {}
+        super(SwiftConnectionPool, self).__init__(max_size=max_size)
+
+    def create(self):
+        """Uses the swiftclient HTTPConnection to create a connection which
+        handles both HTTP and HTTPS and passes in a swearch True boolean"""
+        conn = client.HTTPConnection(self.url, swearch=True)
+        conn.timeout = self.timeout
+        return conn
+
+    @contextmanager
+    def connection(self):
+        conn = self.get()
+        if time.time() - self.last_used.pop(conn, time.time()) > \
+                self.idle_timeout:
+            conn.close()
+            conn = self.create()
+        try:
+            yield conn
+        except ClientException:
+            raise
+        except Exception:
+            conn.close()
+            conn = self.create()
+            raise
+        finally:
+            self.last_used[conn] = time.time()
+            self.put(conn)
+
+
+class RateController(object):
+    """
+    AIMD limit on the rate messages are handled at, steered by the depth
+    of the queue they feed.
+
+    The depth is sampled every ``interval`` seconds through ``measure``.
+    Below ``target_depth`` the rate grows by ``increase`` messages per
+    second each sample; above it the rate is multiplied by ``decrease``.
+    Neither happens while the measured drain rate already moves the
+    queue towards the target.
+    """
+
+    def __init__(self, measure, target_depth, interval=3, min_rate=1,
+                 max_rate=1000, increase=10, decrease=0.5, logger=None):
+        self.measure = measure
+        self.target_depth = target_depth
+        self.interval = interval
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.rate = max_rate
+        self.depth = None
+        self.sampled = 0
+        self.next_slot = 0
+
+    def update(self, depth, now=None):
+        now = now or time.time()
+        # messages per second the queue shrinks by
+        drain = 0
+        if self.depth is not None:
+            drain = (self.depth - depth) / max(now - self.sampled, 0.001)
+        projected = depth - drain * self.interval
+
+        if depth > self.target_depth and projected > self.target_depth:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+        elif depth <= self.target_depth and projected <= self.target_depth:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+        metrics.registry.set('swearch_rate_limit', self.rate)
+
+        self.logger.debug("Queue depth %d/%d, draining %.1f/s, rate %.1f/s" %
+                          (depth, self.target_depth, drain, self.rate))
+        self.depth = depth
+        self.sampled = now
+        return self.rate
+
+    def wait(self):
+        """Sleeps until the next message may be handled."""
+        now = time.time()
+        if now - self.sampled >= self.interval:
+            depth = self.measure()
+            if depth >= 0:
+                self.update(depth, now)
+            else:
+                self.sampled = now
+
+        slot = max(self.next_slot, now)
+        self.next_slot = slot + 1.0 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class PidfileDaemon(Daemon):
+    """Daemon started and stopped through the pidfile at self.pidfile."""
+
+    def start(self):
+        # Check for a pidfile to see if the daemon already runs
+        try:
+            pf = file(self.pidfile, 'r')
+            pid = int(pf.read().strip())
+            pf.close()
+        except IOError:
+            pid = None
+
+        if pid:
+            message = "pidfile %s already exist. Daemon already running?\n"
+            sys.stderr.write(message % self.pidfile)
+            sys.exit(1)
+
+        # Start the daemon
+        pid = daemonize(self.pidfile, user=self.user)
+        self.logger.notice('Started child %s' % pid)
+        self.run()
+
+    def stop(self):
+        # Get the pid from the pidfile
+        try:
+            pf = file(self.pidfile, 'r')
+            pid = int(pf.read().strip())
+            pf.close()
+        except IOError:
+            pid = None
+
+        if not pid:
+            message = "pidfile %s does not exist. Daemon not running?\n"
+            sys.stderr.write(message % self.pidfile)
+            return  # not an error in a restart
+
+        # Try killing the daemon process
+        try:
+            # Try to terminate gracefully with SIGTERM
+            i = 0
+            while i < 30:
+                os.kill(pid, signal.SIGTERM)
+                time.sleep(0.1)
+                i += 1
+
+            # Okay, kill it with fire
+            i = 0
+            while i < 5:
+                os.kill(pid, signal.SIGKILL)
+                time.sleep(0.1)
+                i += 1
+        except OSError, err:
+            err = str(err)
+            if err.find("No such process") > 0:
+                if os.path.exists(self.pidfile):
+                    os.remove(self.pidfile)
+            else:
+                sys.exit(1)
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+
+class IndexWorker(PidfileDaemon):
     """
     Index worker daemon that pops messages from the backlog and indexes them.
 
@@ -35,6 +224,7 @@ class IndexWorker(Daemon):
         self.conf = self.index_config
 
         self.index = self.index_config.get('search_index_name', 'os_default')
+        self.routing = get_routing(self.index_config)
 
         self.key = key
         self.user = user
@@ -50,6 +240,15 @@ class IndexWorker(Daemon):
         self.container_listing_count = int(
             self.queue_config.get('container_listing_count', 5000))
 
+        # containers unchanged since their last backfill are skipped
+        self.fingerprints = None
+        if queue == 'container':
+            self.fingerprints = get_fingerprint_store(self.index_config)
+
+        # HEAD every object on backfill, only needed to index object meta
+        self.backfill_object_meta = self.queue_config.get(
+            'backfill_object_meta', 'false').lower() in TRUE_VALUES
+
         self.queue_type = queue
 
         self.highwater_name = {
@@ -57,11 +256,9 @@ class IndexWorker(Daemon):
             'container': 'object',
             'account': 'container',
         }.get(self.queue_type)
-
-        self.highwater = int(self.queue_config.get(
-            "%s_highwater" % self.highwater_name, 500000))
-        self.highwater_ok = int(self.queue_config.get(
-            "%s_highwater_ok" % self.highwater_name, 10000))
+        if queue == 'container' and not self.backfill_object_meta:
+            # objects are indexed straight from the listings
+            self.highwater_name = 'river'
 
         self.message_handler = {
             'index_account': self.index_account,
@@ -72,29 +269,64 @@ class IndexWorker(Daemon):
         self.prefetch = int(self.queue_config.get(
             '%s_prefetch_count' % self.queue_type, 100))
 
-        self.waterlevel_interval = int(self.queue_config.get(
-            "%s_waterlevel_interval" % self.highwater_name, 3))
+        # number of messages handled at once; messages for the same
+        # account/container/object are still handled in order
+        self.concurrency = int(self.queue_config.get(
+            '%s_concurrency' % self.queue_type, 1))
 
         self.indexer = RabbitMQElasticIndexer(self.queue_config)
+
+        # shared by every swift request of the worker, auth included
+        self.conn_pool = SwiftConnectionPool(
+            PROXY_URL,
+            max_size=int(self.queue_config.get(
+                'swift_pool_size', self.concurrency)),
+            idle_timeout=float(self.queue_config.get(
+                'swift_idle_timeout', 60)),
+            timeout=float(self.queue_config.get('swift_conn_timeout', 10)))
         self.auth_token = self.get_auth_token(self.key)
 
-        self.highwater_queue = {
-            'object': self.indexer.rabbitmq_queue,
-            'container': self.indexer.backfill_queue_name(self.highwater_name),
-            'account': self.indexer.backfill_queue_name(self.highwater_name),
-        }.get(self.queue_type)
+        self.highwater_queue = self.indexer.rabbitmq_queue
+        if self.highwater_name != 'river':
+            self.highwater_queue = self.indexer.backfill_queue_name(
+                self.highwater_name)
+
+        # the rate messages are handled at keeps the queue they feed near
+        # its target depth, so the river and elastic search get a steady
+        # stream instead of bursts
+        min_rate = max(float(self.queue_config.get(
+            "%s_min_rate" % self.queue_type, 1)), MIN_RATE)
+        self.rate = RateController(
+            self.water_level,
+            target_depth=int(self.queue_config.get(
+                "%s_target_depth" % self.highwater_name, 10000)),
+            interval=float(self.queue_config.get(
+                "%s_waterlevel_interval" % self.highwater_name, 3)),
+            min_rate=min_rate,
+            max_rate=max(float(self.queue_config.get(
+                "%s_max_rate" % self.queue_type, 1000)), min_rate),
+            increase=float(self.queue_config.get(
+                "%s_rate_increase" % self.queue_type, 10)),
+            decrease=float(self.queue_config.get(
+                "rate_decrease_factor", 0.5)),
+            logger=self.logger)
+
+        # host:port or unix:<path> to serve metrics on, {queue} and {pid}
+        # are filled in so several workers can share one setting
+        self.metrics_address = self.queue_config.get('metrics_address', '')
 
     def run_forever(self, *args, **kwargs):
+        if self.metrics_address:
+            metrics.start_server(self.metrics_address.format(
+                queue=self.queue_type, pid=os.getpid()))
         while True:
             try:
-                # before any action is taken, check the river backlog so
-                # we don't overflow the river and flood elastic search.
-                for messages in self.queue_highwater():
-                    time.sleep(self.waterlevel_interval)
-
                 self.indexer.start_consumer(
                     self.queue_type, self.handle_messages,
-                        prefetch=int(self.prefetch))
+                    prefetch=int(self.prefetch),
+                    concurrency=self.concurrency,
+                    partition=self.task_partition,
+                    throttle=self.rate.wait)
             finally:
                 self.indexer.close_mq_client()
 
@@ -103,18 +335,25 @@ class IndexWorker(Daemon):
         try:
             task = json.loads(body)
             f = self.message_handler.get(task['type'])
+            labels = {'type': task['type']}
 	    if f:
                 try:
-                    f(*task['args'], **task['kwargs'])
+                    with metrics.registry.timer('swearch_handler_seconds',
+                                                labels):
+                        f(*task['args'], **task['kwargs'])
                 except ClientException as e:
                     if e.http_status == 401:
+                        metrics.registry.inc('swearch_reauth_total', labels)
                         self.auth_token = self.get_auth_token(self.key)
                         f(*task['args'], **task['kwargs'])
                     elif e.http_status == 404:
-                        pass
+                        metrics.registry.inc('swearch_not_found_total',
+                                             labels)
+                metrics.registry.inc('swearch_messages_total', labels)
             else:
                 self.logger.error("INVALID ACTION: %s" % (task))
         except:
+            metrics.registry.inc('swearch_message_errors_total')
             print 'Unexpected error: %s' % sys.exc_info()[0]
             print 'The body: %s' % body
 
@@ -131,107 +370,34 @@ class IndexWorker(Daemon):
         #else:
         #    self.logger.error("INVALID ACTION: %s" % (task))
 
-    def queue_highwater(self):
-        was_highwater = False
-        while True:
-            water_level = self.indexer.queue_size(self.highwater_queue)
-
-            if not was_highwater and water_level > self.highwater:
-                if not was_highwater:
-                    self.logger.warning(
-                        "'%s' hit high water mark of "
-                        "%d/%d messages.  Suspending processing." %
-                        (self.highwater_name, water_level, self.highwater))
-                was_highwater = True
-                yield copy(water_level)
-            elif was_highwater and water_level > self.highwater_ok:
-                self.logger.warning(
-                    "Water '%s' level still too high %d/%d" %
-                    (self.highwater_name, water_level, self.highwater_ok))
-                yield copy(water_level)
-            else:
-                if was_highwater:
-                    self.logger.warning(
-                        "'%s' high water recovered. %s messages pending" %
-                        (self.highwater_name, water_level))
-                break
-
-    def start(self):
-        # Check for a pidfile to see if the daemon already runs
-        try:
-            pf = file(self.pidfile, 'r')
-            pid = int(pf.read().strip())
-            pf.close()
-        except IOError:
-            pid = None
-
-        if pid:
-            message = "pidfile %s already exist. Daemon already running?\n"
-            sys.stderr.write(message % self.pidfile)
-            sys.exit(1)
-
-        # Start the daemon
-        pid = daemonize(self.pidfile, user=self.user)
-        self.logger.notice('Started child %s' % pid)
-        self.run()
-
-    def stop(self):
-        # Get the pid from the pidfile
-        try:
-            pf = file(self.pidfile, 'r')
-            pid = int(pf.read().strip())
-            pf.close()
-        except IOError:
-            pid = None
-
-        if not pid:
-            message = "pidfile %s does not exist. Daemon not running?\n"
-            sys.stderr.write(message % self.pidfile)
-            return  # not an error in a restart
-
-        # Try killing the daemon process
-        try:
-            # Try to terminate gracefully with SIGTERM
-            i = 0
-            while i < 30:
-                os.kill(pid, signal.SIGTERM)
-                time.sleep(0.1)
-                i += 1
-
-            # Okay, kill it with fire
-            i = 0
-            while i < 5:
-                os.kill(pid, signal.SIGKILL)
-                time.sleep(0.1)
-                i += 1
-        except OSError, err:
-            err = str(err)
-            if err.find("No such process") > 0:
-                if os.path.exists(self.pidfile):
-                    os.remove(self.pidfile)
-            else:
-                sys.exit(1)
-
-    def restart(self):
-        self.stop()
-        self.start()
-
-    def _get_conn(self, url, timeout=10):
-        url = encode_utf8(url)
-        parsed = urlparse(url)
-        """Uses the swiftclient HTTPConnection to create a connection which handles both HTTP and HTTPS
-         and passes in a swearch True boolean """
-        conn = client.HTTPConnection(url, swearch=True)
-        conn.timeout = timeout
-        return parsed, conn
+    def water_level(self):
+        "Depth of the queue this worker feeds"
+        depth = self.indexer.queue_size(self.highwater_queue)
+        metrics.registry.set('swearch_water_level', depth,
+                             {'queue': self.highwater_name})
+        return depth
+
+    def task_partition(self, body):
+        """Returns the index id of the item a backfill task is for."""
+        task = json.loads(body)
+        return get_index_id(*task['args'][:3])
+
+    @contextmanager
+    def _get_conn(self, url, request):
+        "Pooled connection to the proxy, with the parsed url to request"
+        with metrics.registry.timer('swearch_swift_request_seconds',
+                                    {'request': request}):
+            with self.conn_pool.connection() as conn:
+                yield urlparse(encode_utf8(url)), conn
 
     def index_account(self, account, verify=False):
         "List all containers for the account and create task for each"
         self.logger.debug("Indexing Account %s" % (account))
-        url = '/'.join(['http://127.0.0.1', 'v1', account])
-        headers, containers = get_account(url, self.auth_token,
-                                          full_listing=True,
-                                          http_conn=self._get_conn(url))
+        url = '/'.join([PROXY_URL, 'v1', account])
+        with self._get_conn(url, 'get_account') as http_conn:
+            headers, containers = get_account(url, self.auth_token,
+                                              full_listing=True,
+                                              http_conn=http_conn)
 
         self.logger.info("Found %s Container(s) in %s" %
                          (len(containers), account.encode('utf8')))
@@ -240,46 +406,50 @@ class IndexWorker(Daemon):
             self.indexer.publish_backfill_task(
                 'container', account, container['name'], verify=verify)
 
-    def index_container(self, account, container, marker=None, verify=False):
+    def index_container(self, account, container, marker=None, verify=False,
+                        fingerprint=None):
         "List all objects for the container and create task for each"
         self.logger.debug("Indexing container %s/%s; marker=%s" % (
             account.encode('utf8'),
             container.encode('utf8'),
             (marker or '').encode('utf8')))
         # Index the container up to marker
-        url = '/'.join(['http://127.0.0.1', 'v1', account])
-        headers, objects = get_container(url, self.auth_token, container,
-                                         limit=self.container_listing_count,
-                                         marker=marker,
-                                         http_conn=self._get_conn(url))
+        url = '/'.join([PROXY_URL, 'v1', account])
+        with self._get_conn(url, 'get_container') as http_conn:
+            headers, objects = get_container(
+                url, self.auth_token, container,
+                limit=self.container_listing_count, marker=marker,
+                http_conn=http_conn)
 
         self.logger.info("Found %s Objects(s) in container %s" %
                          (len(objects), container.encode('utf8')))
 
+        kwargs = {}
+        if self.fingerprints:
+            fingerprint_index = self.fingerprint_index()
+            # later pages carry the fingerprint the pass started with
+            if fingerprint is None:
+                fingerprint = container_fingerprint(headers)
+                if not verify and fingerprint == self.fingerprints.get(
+                        fingerprint_index, account, container):
+                    self.logger.info("Skipping unchanged container %s/%s" % (
+                        account.encode('utf8'), container.encode('utf8')))
+                    return
+            kwargs['fingerprint'] = fingerprint
+
         if len(objects) == self.container_listing_count:
             self.indexer.publish_backfill_task(
                 'container', account, container,
                 marker=objects[-1]['name'],
-                verify=verify)
+                verify=verify, **kwargs)
 
         update_handler = ContainerUpdateHandler(
-            self.indexer, account, container, index=self.index)
+            self.indexer, account, container, index=self.index,
+            routing=self.routing)
         _id, props = update_handler.parse_props(headers)
 
         if verify:
-            # Get Indexed State of Container
-            client = get_search_client(self.index_config)
-            results = client.search(
-                query=pyes.TermQuery("_id", _id),
-                indices=[self.index_config.get(
-                    'search_index_name', 'os_default')])
-            assert results.total == 1, '%s indexed instead of 1' % \
-                results.total
-            for name, val in results[0].iteritems():
-                if encode_utf8(val) != encode_utf8(props[name]):
-                    self.logger.error('Indexed Property Does Not Match')
-                    self.logger.error(val)
-                    self.logger.error(props[name])
+            self.verify_docs([(_id, props)], update_handler.routing)
         else:
             update_handler.index(_id, props, block=True)
 
@@ -287,49 +457,272 @@ class IndexWorker(Daemon):
         self.logger.info(
             "Found %s Objects in %s/%s" %
             (len(objects), account.encode('utf8'), container.encode('utf8')))
+        if self.backfill_object_meta:
+            for obj in objects:
+                self.indexer.publish_backfill_task(
+                    'object', account, container, obj['name'], verify=verify)
+        else:
+            self.index_listing(account, container, objects, verify=verify)
+
+        if self.fingerprints and \
+                len(objects) < self.container_listing_count:
+            self.fingerprints.set(fingerprint_index, account, container,
+                                  fingerprint)
+
+    def fingerprint_index(self):
+        "The indexes search_index_name points at, fingerprints are per index"
+        client = get_search_client(self.index_config)
+        return ','.join(sorted(client.indices.aliases(self.index)))
+
+    def index_listing(self, account, container, objects, verify=False):
+        "Index objects straight from their container listing entries"
+        docs = []
+        names = {}
+        routing = self.routing and self.routing.route(account, container)
         for obj in objects:
-            self.indexer.publish_backfill_task(
-                'object', account, container, obj['name'], verify=verify)
+            update_handler = ObjectUpdateHandler(
+                self.indexer, account, container, obj['name'],
+                index=self.index)
+            headers = update_handler.listing_headers(obj)
+            _id, props = update_handler.parse_props(headers)
+            docs.append((_id, props,
+                         timestamp_version(headers.get('x-timestamp'))))
+            names[_id] = obj['name']
+        client = get_search_client(self.index_config)
+        if verify:
+            # the listing has no meta to check or repair with, stale
+            # objects are indexed from a HEAD instead
+            stale = stale_docs(client, self.index, docs, routing,
+                               fields=LISTING_FIELDS)
+            if stale:
+                self.logger.warning("Repairing %d of %d indexed objects" %
+                                    (len(stale), len(docs)))
+                self.indexer.index_docs(
+                    self.index,
+                    self.head_docs(account, container,
+                                   [names[doc[0]] for doc in stale]),
+                    block=True, routing=routing)
+        else:
+            # only objects missing from the index are indexed, the listing
+            # has no meta and may be older than the indexed doc. Strictly
+            # newer versions only, so an object deleted, or indexed with
+            # its meta, since the listing isn't overwritten.
+            missing = stale_docs(client, self.index, docs, routing,
+                                 fields=[])
+            self.indexer.index_docs(self.index, missing, block=True,
+                                    routing=routing, version_type='external')
+
+    def verify_docs(self, docs, routing=None):
+        "Reindex the docs that are missing or stale in the search index"
+        client = get_search_client(self.index_config)
+        stale = stale_docs(client, self.index, docs, routing)
+        if stale:
+            self.logger.warning("Repairing %d of %d indexed documents" %
+                                (len(stale), len(docs)))
+            self.indexer.index_docs(self.index, stale, block=True,
+                                    routing=routing)
+
+    def head_docs(self, account, container, objs):
+        "HEAD the objects for their docs, skipping those since deleted"
+        docs = []
+        for obj in objs:
+            try:
+                docs.append(self.head_doc(account, container, obj))
+            except ClientException as e:
+                if e.http_status != 404:
+                    raise
+                self.logger.debug("Object gone: %s/%s/%s" % (
+                    account.encode('utf8'),
+                    container.encode('utf8'),
+                    obj.encode('utf8')))
+        return docs
+
+    def head_doc(self, account, container, obj):
+        "HEAD the object, returns its (_id, props, version) doc"
+        url = '/'.join([PROXY_URL, 'v1', account])
+        with self._get_conn(url, 'head_object') as http_conn:
+            headers = head_object(url, self.auth_token, container, obj,
+                                  http_conn=http_conn)
+
+        update_handler = ObjectUpdateHandler(
+            self.indexer, account, container, obj, index=self.index)
+        _id, props = update_handler.parse_props(headers)
+        return _id, props, timestamp_version(headers.get('x-timestamp'))
 
     def index_object(self, account, container, obj, verify=False):
         "Get details for object and index it"
-        url = '/'.join(['http://127.0.0.1', 'v1', account])
-        headers = head_object(url, self.auth_token, container, obj,
-                              http_conn=self._get_conn(url))
+        _id, props, version = self.head_doc(account, container, obj)
 
         self.logger.debug("Indexing Object: %s/%s/%s" % (
             account.encode('utf8'),
             container.encode('utf8'),
             obj.encode('utf8')))
 
-        update_handler = ObjectUpdateHandler(
-            self.indexer, account, container, obj, index=self.index)
-        _id, props = update_handler.parse_props(headers)
-
+        routing = self.routing and self.routing.route(account, container)
         if verify:
-            # Check Indexed State of Object
-            client = get_search_client(self.index_config)
-            _id, props = update_handler.parse_props(headers)
-            q = pyes.TermQuery("_id", _id)
-            results = client.search(
-                query=q, indices=[self.index_config.get(
-                    'search_index_name', 'os_default')])
-            assert results.total == 1, '%s indexed instead of 1' % \
-                results.total
-            for name, val in results[0].iteritems():
-                if encode_utf8(val) != encode_utf8(props[name]):
-                    self.logger.error('Indexed Property Does Not Match')
-                    self.logger.error(val)
-                    self.logger.error(props[name])
+            self.verify_docs([(_id, props, version)], routing)
         else:
-            update_handler.index(_id, props, block=True)
+            self.indexer.index_doc(self.index, _id, props, block=True,
+                                   version=version, routing=routing)
 
     def get_auth_token(self, key):
         "get auth token to use for index requests"
-        storage_url, token = get_auth_1_0(
-            'http://127.0.0.1/auth/v1.0', '.super_admin:.super_admin', key,
-            False)
-        return token
+        url = '/'.join([PROXY_URL, 'auth', 'v1.0'])
+        with self._get_conn(url, 'auth') as (parsed, conn):
+            conn.request('GET', parsed.path, '', {
+                'X-Auth-User': '.super_admin:.super_admin',
+                'X-Auth-Key': key})
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status < 200 or resp.status >= 300:
+                raise ClientException('Auth GET failed',
+                                      http_status=resp.status,
+                                      http_reason=resp.reason)
+        return resp.getheader('x-storage-token',
+                              resp.getheader('x-auth-token'))
+
+
+class WorkerSupervisor(PidfileDaemon):
+    """
+    Forks and watches IndexWorker processes for every queue type.
+
+    The number of workers for each queue type comes from the
+    ``<queue>_workers`` settings in ``[queue]`` and crashed workers are
+    restarted. SIGHUP re-reads the worker counts from the config file,
+    SIGTTIN and SIGTTOU add or remove one worker for every queue type
+    running workers, and SIGTERM stops the workers with the supervisor.
+
+    :param conf_file: Path to the swearch config file.
+    """
+
+    def __init__(self, conf_file, pid=None, key=None, user='swift'):
+        self.conf_file = conf_file
+        self.conf = readconf(conf_file)
+        self.key = key
+        self.user = user
+        self.pidfile = pid
+        self.logger = get_logger(
+            self.conf.get('index', {}),
+            name='swearch-supervisor',
+            log_route='swearch-supervisor',
+            fmt="%(server)s [PID: %(process)d] %(message)s")
+
+        queue_config = self.conf.get('queue', {})
+        self.interval = float(queue_config.get('supervisor_interval', 1))
+        # workers dying sooner than this after starting are restarted no
+        # sooner than this, so a broken setup doesn't fork in a loop
+        self.respawn_delay = float(
+            queue_config.get('worker_respawn_delay', 10))
+
+        self.workers = self.worker_counts(self.conf)
+        self.children = dict((queue, []) for queue in QUEUE_TYPES)
+        self.started = {}
+        self.next_spawn = dict((queue, 0) for queue in QUEUE_TYPES)
+
+    def worker_counts(self, conf):
+        queue_config = conf.get('queue', {})
+        return dict(
+            (queue, int(queue_config.get('%s_workers' % queue, 1)))
+            for queue in QUEUE_TYPES)
+
+    def run_forever(self, *args, **kwargs):
+        signal.signal(signal.SIGHUP, self.reload)
+        signal.signal(signal.SIGTTIN, self.scale_up)
+        signal.signal(signal.SIGTTOU, self.scale_down)
+        signal.signal(signal.SIGTERM, self.shutdown)
+        while True:
+            self.reap()
+            self.manage()
+            time.sleep(self.interval)
+
+    def spawn(self, queue):
+        pid = os.fork()
+        if pid == 0:
+            for signum in [signal.SIGHUP, signal.SIGTTIN, signal.SIGTTOU,
+                           signal.SIGTERM]:
+                signal.signal(signum, signal.SIG_DFL)
+            status = 0
+            try:
+                green_worker_process(self.conf, queue)
+                IndexWorker(self.conf, key=self.key, user=self.user,
+                            queue=queue).run_forever()
+            except Exception:
+                self.logger.exception('%s worker failed' % queue)
+                status = 1
+            finally:
+                os._exit(status)
+
+        self.logger.notice('Started %s worker %s' % (queue, pid))
+        self.children[queue].append(pid)
+        self.started[pid] = time.time()
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as err:
+                if err.errno != errno.ECHILD:
+                    raise
+                return
+            if not pid:
+                return
+
+            started = self.started.pop(pid, 0)
+            for queue, pids in self.children.iteritems():
+                if pid in pids:
+                    pids.remove(pid)
+                    self.logger.error('%s worker %s exited with status %s' %
+                                      (queue, pid, status))
+                    if time.time() - started < self.respawn_delay:
+                        self.next_spawn[queue] = \
+                            time.time() + self.respawn_delay
+
+    def manage(self):
+        for queue in QUEUE_TYPES:
+            pids = self.children[queue]
+            while len(pids) < self.workers[queue]:
+                if self.next_spawn[queue] > time.time():
+                    break
+                self.spawn(queue)
+            while len(pids) > self.workers[queue]:
+                # unacked messages of the stopped worker go back on the queue
+                pid = pids.pop()
+                self.logger.notice('Stopping %s worker %s' % (queue, pid))
+                self.kill(pid)
+
+    def kill(self, pid, signum=signal.SIGTERM):
+        try:
+            os.kill(pid, signum)
+        except OSError as err:
+            if err.errno != errno.ESRCH:
+                raise
+
+    def reload(self, *args):
+        try:
+            self.workers = self.worker_counts(readconf(self.conf_file))
+        except Exception:
+            self.logger.exception('Unable to reload %s' % self.conf_file)
+        else:
+            self.logger.notice('Reloaded worker counts: %s' % self.workers)
+
+    def scale_up(self, *args):
+        for queue, count in self.workers.iteritems():
+            if count:
+                self.workers[queue] = count + 1
+        self.logger.notice('Scaled workers up to: %s' % self.workers)
+
+    def scale_down(self, *args):
+        for queue, count in self.workers.iteritems():
+            if count > 1:
+                self.workers[queue] = count - 1
+        self.logger.notice('Scaled workers down to: %s' % self.workers)
+
+    def shutdown(self, *args):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for pids in self.children.itervalues():
+            for pid in pids:
+                self.kill(pid)
+        sys.exit(0)
 
 
 def daemonize(pidfile, user=None):
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import sqlite3
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from swearch.index import get_index_id
+
+# container headers that change whenever its listing or its own indexed
+# properties do
+FINGERPRINT_HEADERS = ['x-container-object-count', 'x-container-bytes-used',
+                       'x-put-timestamp', 'x-timestamp',
+                       'x-container-read', 'x-container-write']
+
+
+def container_fingerprint(headers):
+    """Digest of the container headers from its listing.
+
+    An object overwritten with one of the same size leaves the object count
+    and bytes used alone and so goes unnoticed.
+    """
+    names = FINGERPRINT_HEADERS + sorted(
+        name for name in headers if name.startswith('x-container-meta-'))
+    fingerprint = hashlib.md5()
+    for name in names:
+        value = headers.get(name)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        fingerprint.update('%s:%s\n' % (name, value or ''))
+    return fingerprint.hexdigest()
+
+
+def fingerprint_id(index, account, container):
+    """Fingerprints are kept per concrete index, so a new index behind the
+    search alias gets every container backfilled into it."""
+    return '%s/%s' % (index, get_index_id(account, container))
+
+
+class RedisFingerprintStore(object):
+    def __init__(self, host='127.0.0.1', port=6379, prefix=''):
+        if redis is None:
+            raise ImportError('fingerprint_store = redis needs the redis '
+                              'package')
+        self.client = redis.StrictRedis(host=host, port=port)
+        self.prefix = prefix
+
+    def key(self, index, account, container):
+        return '%sfingerprint.%s' % (
+            self.prefix, fingerprint_id(index, account, container))
+
+    def get(self, index, account, container):
+        return self.client.get(self.key(index, account, container))
+
+    def set(self, index, account, container, fingerprint):
+        self.client.set(self.key(index, account, container), fingerprint)
+
+
+class SqliteFingerprintStore(object):
+    """Local stand-in for the redis store, shared by the workers of a host."""
+
+    def __init__(self, path):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS fingerprint '
+                          '(id TEXT PRIMARY KEY, fingerprint TEXT)')
+        self.conn.commit()
+
+    def get(self, index, account, container):
+        row = self.conn.execute(
+            'SELECT fingerprint FROM fingerprint WHERE id = ?',
+            (fingerprint_id(index, account, container),)).fetchone()
+        if row:
+            return str(row[0])
+
+    def set(self, index, account, container, fingerprint):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO fingerprint VALUES (?, ?)',
+            (fingerprint_id(index, account, container), fingerprint))
+        self.conn.commit()
+
+
+def get_fingerprint_store(config):
+    """Returns the configured fingerprint store, None when disabled."""
+    store = config.get('fingerprint_store', 'none').lower()
+    if store == 'redis':
+        return RedisFingerprintStore(
+            host=config.get('redis_host', '127.0.0.1'),
+            port=int(config.get('redis_port', 6379)),
+            prefix=config.get('redis_prefix', ''))
+    elif store == 'sqlite':
+        return SqliteFingerprintStore(config.get(
+            'fingerprint_db', '/var/cache/swearch/fingerprints.db'))
+    elif store != 'none':
+        raise ValueError('Unknown fingerprint_store %r' % store)
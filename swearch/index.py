@@ -1,11 +1,18 @@
 """
     Index module. Provides classes for indexing and searching the index.
 """
+import base64
 import hashlib
+import heapq
+import json
 import logging
 import os
+import time
+import zlib
 
 import pyes
+from pyes import connection_http
+from swift.common import utils as swift_utils
 
 from swearch import utils
 
@@ -13,31 +20,41 @@ from swearch import utils
 SORT_WHITELIST = ['dir', 'container', 'name', 'path', 'type']
 RESULT_WHITELIST = ['name', 'object', 'container', 'content_type', 'type',
                     'meta']
+# Object headers that must be known to index without a HEAD
+REQUIRED_HEADERS = ['etag', 'content-type']
+# Object props known from a container listing entry, it has no meta
+LISTING_FIELDS = ['hash', 'content_type']
 
 
 class UpdateHandler(object):
-    def after_POST(self, req):
+    def timing_since(self, metric, start):
+        # only swift's loggers report to statsd
+        if hasattr(self.logger, 'timing_since'):
+            self.logger.timing_since(metric, start)
+
+    def after_POST(self, req, resp_headers=None):
         """Performed on updates."""
         pass
 
-    def after_PUT(self, req):
+    def after_PUT(self, req, resp_headers=None):
         """Performed on creates."""
         pass
 
-    def after_DELETE(self, req):
+    def after_DELETE(self, req, resp_headers=None):
         """Performed on deletes."""
         pass
 
 
 class ContainerUpdateHandler(UpdateHandler):
     def __init__(self, indexer, account, name,
-                 index='os_default', app=None, logger=None):
+                 index='os_default', app=None, logger=None, routing=None):
         self.indexer = indexer
         self.account = account
         self.name = name
         self.app = app
         self.index_name = index
         self.logger = logger or logging.getLogger(__name__)
+        self.routing = routing and routing.route(account, name)
 
     def parse_props(self, headers):
         path = self.name
@@ -62,8 +79,8 @@ class ContainerUpdateHandler(UpdateHandler):
                         pass
                 else:
 
-                    metaname = unicode(name[17:].lower(), errors='replace')
-                    props['meta'][metaname] = unicode(value, errors='replace')
+                    metaname = utils.unicode_decode(name[17:].lower())
+                    props['meta'][metaname] = utils.unicode_decode(value)
             elif name == 'x-container-read':
                 props['read'] = value
             elif name == 'x-container-write':
@@ -73,41 +90,45 @@ class ContainerUpdateHandler(UpdateHandler):
         return _id, props
 
     def index(self, _id, props, block=False):
-        self.indexer.index_doc(self.index_name, _id, props, block=block)
+        self.indexer.index_doc(self.index_name, _id, props, block=block,
+                               routing=self.routing)
 
     def update(self, req):
         path = utils.unicode_quote('/v1/%s/%s' % (self.account, self.name))
         head_req = utils.make_request(req.environ, 'HEAD', path)
+        start = time.time()
         resp = head_req.get_response(self.app)
+        self.timing_since('swearch.head.container.timing', start)
         headers = dict((k.lower(), v) for k, v in resp.headers.iteritems())
         _id, props = self.parse_props(headers)
         self.logger.info("Updating Container %s/%s" %
                          (self.account, self.name))
         return self.index(_id, props)
 
-    def after_POST(self, req):
+    def after_POST(self, req, resp_headers=None):
         """Performed on updates."""
         return self.update(req)
 
-    def after_PUT(self, req):
+    def after_PUT(self, req, resp_headers=None):
         """Performed on creates."""
         return self.update(req)
 
-    def after_COPY(self, req):
+    def after_COPY(self, req, resp_headers=None):
         """Performed on copies."""
         return self.update(req)
 
-    def after_DELETE(self, req):
+    def after_DELETE(self, req, resp_headers=None):
         """Performed on deletes."""
         self.logger.info("Deleting Container %s/%s" %
                          (self.account, self.name))
         _id = get_index_id(self.account, self.name)
-        return self.indexer.remove_doc(self.index_name, _id)
+        return self.indexer.remove_doc(self.index_name, _id,
+                                       routing=self.routing)
 
 
 class ObjectUpdateHandler(UpdateHandler):
     def __init__(self, indexer, account, container, name,
-                 index='os_default', app=None, logger=None):
+                 index='os_default', app=None, logger=None, routing=None):
         self.indexer = indexer
         self.account = account
         self.container = container
@@ -115,6 +136,7 @@ class ObjectUpdateHandler(UpdateHandler):
         self.app = app
         self.index_name = index
         self.logger = logger or logging.getLogger(__name__)
+        self.routing = routing and routing.route(account, container)
 
     def parse_props(self, headers):
         path = "%s/%s" % (self.container, self.name)
@@ -142,45 +164,129 @@ class ObjectUpdateHandler(UpdateHandler):
                     except KeyError:
                         pass
                 else:
-                    metaname = unicode(name[14:].lower(), errors='replace')
-                    props['meta'][metaname] = unicode(value, errors='replace')
+                    metaname = utils.unicode_decode(name[14:].lower())
+                    props['meta'][metaname] = utils.unicode_decode(value)
 
         _id = get_index_id(self.account, self.container, self.name)
         return _id, props
 
-    def index(self, _id, props, block=False):
-        self.indexer.index_doc(self.index_name, _id, props, block=block)
+    def index(self, _id, props, block=False, version=None):
+        self.indexer.index_doc(self.index_name, _id, props, block=block,
+                               version=version, routing=self.routing)
+
+    def listing_headers(self, listing):
+        """Object headers from its container listing entry, which has no
+        x-object-meta-* values."""
+        # swift_bytes is appended to the content type of manifests
+        content_type = listing.get('content_type', '').split(';swift_bytes=')
+        headers = {
+            'etag': listing.get('hash'),
+            'content-type': content_type[0] or None,
+        }
+        if listing.get('last_modified'):
+            headers['x-timestamp'] = \
+                swift_utils.last_modified_date_to_timestamp(
+                    listing['last_modified']).internal
+        return headers
 
-    def update(self, req):
+    def head(self, req):
         path = utils.unicode_quote('/v1/%s/%s/%s' %
                                    (self.account, self.container, self.name))
         head_req = utils.make_request(req.environ, 'HEAD', path)
+        start = time.time()
         resp = head_req.get_response(self.app)
-        headers = dict((k.lower(), v) for k, v in resp.headers.iteritems())
+        self.timing_since('swearch.head.object.timing', start)
+        return dict((k.lower(), v) for k, v in resp.headers.iteritems())
+
+    def request_headers(self, req, resp_headers):
+        """Rebuilds the object headers from a write and its response.
+
+        Returns None when they don't fully describe the stored object, e.g.
+        copies and manifests, or a POST whose response carries no etag.
+        """
+        if req.method not in ['PUT', 'POST']:
+            return None
+        if 'x-copy-from' in req.headers or \
+                'x-object-manifest' in req.headers or \
+                req.params.get('multipart-manifest') == 'put':
+            return None
+        if req.headers.get('x-detect-content-type', '').lower() in \
+                swift_utils.TRUE_VALUES:
+            return None
+
+        headers = dict((k.lower(), v) for k, v in req.headers.iteritems()
+                       if k.lower().startswith('x-object-meta-'))
+        # The response content-type describes the response body, the
+        # object's own comes from the request.
+        headers['etag'] = resp_headers.get('etag')
+        headers['content-type'] = req.headers.get('content-type')
+        # set on the request by the proxy
+        headers['x-timestamp'] = req.headers.get('x-timestamp')
+        for name in REQUIRED_HEADERS:
+            if not headers.get(name):
+                return None
+        return headers
+
+    def update(self, req, resp_headers=None):
+        headers = None
+        if resp_headers is not None:
+            headers = self.request_headers(req, resp_headers)
+        if headers is None:
+            headers = self.head(req)
 
         _id, props = self.parse_props(headers)
         self.logger.info("Updating Object %s/%s/%s" %
                          (self.account, self.container, self.name))
-        return self.index(_id, props)
+        version = timestamp_version(headers.get('x-timestamp'))
+        return self.index(_id, props, version=version)
+
+    def post_fields(self, req):
+        """Returns the fields a metadata POST changes, None if they can't
+        be told from the request.
+
+        Swift replaces all of the object's metadata on a POST, and its
+        content type when one is given.
+        """
+        if req.headers.get('x-detect-content-type', '').lower() in \
+                swift_utils.TRUE_VALUES:
+            return None
+        headers = dict((k.lower(), v) for k, v in req.headers.iteritems()
+                       if k.lower().startswith('x-object-meta-'))
+        _id, props = self.parse_props(headers)
+        fields = {'meta': props['meta']}
+        if req.headers.get('content-type'):
+            fields['content_type'] = req.headers['content-type']
+        return fields
 
-    def after_POST(self, req):
+    def after_POST(self, req, resp_headers=None):
         """Performed on updates."""
-        return self.update(req)
+        fields = self.post_fields(req)
+        if fields is None:
+            return self.update(req, resp_headers)
+
+        _id = get_index_id(self.account, self.container, self.name)
+        self.logger.info("Updating Object metadata %s/%s/%s" %
+                         (self.account, self.container, self.name))
+        return self.indexer.update_doc(self.index_name, _id, fields,
+                                       routing=self.routing)
 
-    def after_PUT(self, req):
+    def after_PUT(self, req, resp_headers=None):
         """Performed on creates."""
-        return self.update(req)
+        return self.update(req, resp_headers)
 
-    def after_COPY(self, req):
+    def after_COPY(self, req, resp_headers=None):
         """Performed on copies."""
         return self.update(req)
 
-    def after_DELETE(self, req):
+    def after_DELETE(self, req, resp_headers=None):
         """Performed on deletes."""
         _id = get_index_id(self.account, self.container, self.name)
         self.logger.info("Deleting Object %s/%s/%s" %
                          (self.account, self.container, self.name))
-        return self.indexer.remove_doc(self.index_name, _id)
+        return self.indexer.remove_doc(
+            self.index_name, _id,
+            version=timestamp_version(req.headers.get('x-timestamp')),
+            routing=self.routing)
 
 
 def filter_result_props(props):
@@ -210,16 +316,222 @@ def get_index_id(account, container=None, obj=None):
     return hashlib.sha1(_id).hexdigest()
 
 
+def timestamp_version(timestamp):
+    """Returns the external version of a document written at a Swift
+    timestamp, None without one."""
+    if not timestamp:
+        return None
+    try:
+        return swift_utils.Timestamp(timestamp).raw
+    except ValueError:
+        return None
+
+
+class AccountRouting(object):
+    """
+    Routes the documents of an account to a single shard, so searches,
+    which always filter by account, only query that shard.
+
+    Documents of the accounts given a number of partitions are spread
+    across as many routing values by container instead, and searches of
+    those accounts query one shard per partition, or a single one when
+    confined to a container.
+
+    :param partitions: Dict of account to its number of partitions.
+    """
+
+    def __init__(self, partitions=None):
+        self.partitions = partitions or {}
+
+    def route(self, account, container=None):
+        """Returns the routing value of a document."""
+        partitions = self.partitions.get(account, 1)
+        if partitions <= 1:
+            return account
+        if container is None:
+            return '%s:0' % account
+        partition = zlib.crc32(utils.unicode_encode(container)) & 0xffffffff
+        return '%s:%d' % (account, partition % partitions)
+
+    def search_routing(self, account, container=None):
+        """Returns the routing values a search of the account, or of one
+        of its containers, needs to query."""
+        partitions = self.partitions.get(account, 1)
+        if partitions <= 1 or container:
+            return self.route(account, container)
+        return ','.join('%s:%d' % (account, i) for i in range(partitions))
+
+
+def get_routing(config):
+    """Returns the configured AccountRouting, None when disabled."""
+    if config.get('account_routing', 'false').lower() not in \
+            swift_utils.TRUE_VALUES:
+        return None
+    partitions = {}
+    for entry in config.get('routing_partitions', '').split(','):
+        if entry.strip():
+            account, count = entry.strip().rsplit(':', 1)
+            partitions[account] = int(count)
+    return AccountRouting(partitions)
+
+
+def stale_docs(client, index_name, docs, routing=None, fields=None):
+    """Returns the (_id, props[, version]) tuples of docs that are missing
+    from the index or whose indexed fields differ from props, in one
+    mget. The docs must share their routing value.
+
+    :param fields: Only compare these props, e.g. LISTING_FIELDS, an
+                   empty list to only return missing docs.
+    """
+    indexed = {}
+    query_params = {}
+    if routing:
+        query_params['routing'] = routing
+    for doc in client.mget([doc[0] for doc in docs],
+                           index=index_name, doc_type='entity',
+                           **query_params):
+        meta = doc.get_meta()
+        if meta.get('found', meta.get('exists')):
+            indexed[meta.id] = doc
+
+    stale = []
+    for doc in docs:
+        _id, props = doc[:2]
+        indexed_doc = indexed.get(_id)
+        # compare to props as they come back from elastic search
+        expected = json.loads(json.dumps(props))
+        if fields is not None:
+            expected = dict((name, expected.get(name)) for name in fields)
+        if indexed_doc is None or any(
+                indexed_doc.get(name) != value
+                for name, value in expected.iteritems()):
+            stale.append(doc)
+    return stale
+
+
+# Long lived search clients, keyed by process and hosts
+_search_clients = {}
+
+
+class RoundRobinConnection(connection_http.Connection):
+    """pyes HTTP connection that rotates requests across the live hosts.
+
+    Plain pyes connections stick to one random host per thread, and green
+    threads all share one. Failing hosts are still benched for retry_time
+    seconds, and connections are kept alive in the pyes pool.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(RoundRobinConnection, self).__init__(*args, **kwargs)
+        self._next_server = 0
+
+    def execute(self, request):
+        self._local.server = None
+        return super(RoundRobinConnection, self).execute(request)
+
+    def _get_server(self):
+        with self._lock:
+            while self._inactive_servers and \
+                    self._inactive_servers[0][0] <= time.time():
+                ts, server = heapq.heappop(self._inactive_servers)
+                self._active_servers.append(server)
+
+            if not self._active_servers:
+                raise pyes.exceptions.NoServerAvailable()
+            self._next_server = \
+                (self._next_server + 1) % len(self._active_servers)
+            return self._active_servers[self._next_server]
+
+
 def get_search_client(config):
     hosts_str = config.get('elastic_hosts', '127.0.0.1:9200')
     elastic_hosts = [x.strip() for x in hosts_str.split(',')]
-    conn = pyes.ES(elastic_hosts)
+
+    key = (os.getpid(), tuple(elastic_hosts))
+    conn = _search_clients.get(key)
+    if conn is None:
+        timeout = float(config.get('elastic_timeout', 30))
+        max_retries = int(config.get('elastic_max_retries', 3))
+        retry_time = int(config.get('elastic_retry_time', 60))
+        # Number of keep-alive connections held per host
+        connection_http.update_connection_pool(
+            int(config.get('elastic_pool_size', 10)))
+
+        conn = pyes.ES(elastic_hosts, timeout=timeout,
+                       max_retries=max_retries, retry_time=retry_time)
+        conn.connection = RoundRobinConnection(
+            [server for server in conn.servers
+             if server.scheme in ['http', 'https']],
+            timeout=timeout, max_retries=max_retries, retry_time=retry_time)
+        _search_clients[key] = conn
     return conn
 
 
+def encode_marker(values):
+    """Encodes the sort values of a hit as an opaque paging cursor."""
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+def decode_marker(marker, sort_keys):
+    """Returns the sort values in a cursor made by encode_marker, or None
+    if marker isn't one for these sort keys."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(
+            utils.unicode_encode(marker)))
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(values, list) or len(values) != len(sort_keys):
+        return None
+    return values
+
+
+def cursor_filter(sort_keys, values):
+    """Matches the hits sorting after the given sort values."""
+    clauses = []
+    for i, (field, order) in enumerate(sort_keys):
+        must = [pyes.TermFilter(key[0], value)
+                for key, value in zip(sort_keys[:i], values[:i])]
+        op = 'gt' if order == 'asc' else 'lt'
+        must.append(pyes.RangeFilter(pyes.ESRangeOp(field, op, values[i])))
+        clauses.append(pyes.ANDFilter(must))
+    return pyes.ORFilter(clauses)
+
+
+class SearchResults(object):
+    """A page of search hits, iterating over their source documents."""
+
+    def __init__(self, response, size=None, sorted_hits=False):
+        hits = response.get('hits', {})
+        self.total = hits.get('total', 0)
+        self.hits = hits.get('hits', [])
+
+        # Sorted pages that came back full can be followed by the next
+        self.next_marker = None
+        if sorted_hits and self.hits and len(self.hits) >= size:
+            self.next_marker = encode_marker(self.hits[-1]['sort'])
+
+    def __len__(self):
+        return len(self.hits)
+
+    def __iter__(self):
+        for hit in self.hits:
+            yield hit.get('_source', {})
+
+
 class Searcher(object):
-    def __init__(self, hosts, index, account, logger=None):
+    """
+    Search of an account's documents.
+
+    :param keyword_fields: The index maps the SORT_WHITELIST fields as
+        exact values. Only then are hits sorted by path by default and
+        paged with cursor markers, markers are object names otherwise.
+    """
+
+    def __init__(self, hosts, index, account, logger=None, client=None,
+                 routing=None, keyword_fields=False):
         self.account = account
+        self.routing = routing
+        self.keyword_fields = keyword_fields
         self.path = None
         self.recursive = True
         self.type = None
@@ -232,12 +544,38 @@ class Searcher(object):
         self.logger = logger or logging.getLogger(__name__)
         self.elastic_hosts = hosts
         self.search_index_name = index
+        self.client = client or get_search_client(
+            {'elastic_hosts': ','.join(hosts)})
 
     def add_condition(self, field, query):
         self.conditions.append((field, query))
 
-    def execute(self):
-        conn = pyes.ES(self.elastic_hosts)
+    def sort_keys(self):
+        """Returns the (field, order) pairs to sort by, ending with the
+        unique path so the order is total when the index has keyword
+        fields. None sorts by relevance."""
+        if self.sort in [None, '']:
+            if not self.keyword_fields or \
+                    [val for field, val in self.conditions if val != '']:
+                return None
+            return [('path', 'asc')]
+
+        keys = []
+        for row in self.sort.split(','):
+            sort_data = row.split(' ')
+            order = 'asc'
+            if len(sort_data) > 1 and sort_data[1].lower() == 'desc':
+                order = 'desc'
+            if sort_data[0] in SORT_WHITELIST:
+                keys.append((sort_data[0], order))
+                if sort_data[0] == 'path':
+                    break
+        else:
+            if self.keyword_fields:
+                keys.append(('path', 'asc'))
+        return keys or None
+
+    def build_query(self, sort_keys=None):
         queries = []
         filters = []
 
@@ -256,26 +594,95 @@ class Searcher(object):
                 queries.append(pyes.TermQuery('dir', self.path))
 
         if self.marker not in [None, '']:
-            filters.append(
-                pyes.RangeFilter(pyes.ESRangeOp('name', 'gt', self.marker)))
+            # Either a cursor from a previous page's next marker, or the
+            # name of the last hit seen.
+            values = self.keyword_fields and sort_keys and \
+                decode_marker(self.marker, sort_keys)
+            if values:
+                filters.append(cursor_filter(sort_keys, values))
+            else:
+                filters.append(pyes.RangeFilter(
+                    pyes.ESRangeOp('name', 'gt', self.marker)))
 
         q = pyes.MatchAllQuery()
         if len(queries) > 0:
             q = pyes.BoolQuery(queries)
 
-        q = pyes.FilteredQuery(q, pyes.ANDFilter(filters))
-        self.logger.info("Running query: %s" % q.serialize())
-        results = conn.search(q, self.search_index_name, start=self.start,
-                              size=self.limit)
-        if self.sort not in [None, '']:
-            sort_list = []
-            for row in self.sort.split(','):
-                sort_data = row.split(' ')
-                prefix = ""
-                if len(sort_data) > 1 and sort_data[1].lower() == 'desc':
-                    prefix = "-"
-                if sort_data[0] in SORT_WHITELIST:
-                    sort_list.append("{0}{1}".format(prefix, sort_data[0]))
-            if sort_list:
-                results.order_by(sort_list)
-        return results
+        return pyes.FilteredQuery(q, pyes.ANDFilter(filters))
+
+    def query_params(self):
+        """Returns the routing of the search, if any."""
+        if not self.routing:
+            return {}
+        container = None
+        if self.path not in [None, '']:
+            container = self.path.split('/', 1)[0]
+        return {'routing': self.routing.search_routing(self.account,
+                                                       container)}
+
+    def execute(self):
+        conn = self.client
+        sort_keys = self.sort_keys()
+        q = self.build_query(sort_keys)
+        sort = None
+        if sort_keys:
+            sort = [{field: {'order': order}} for field, order in sort_keys]
+        search = pyes.Search(q, start=self.start, size=self.limit, sort=sort)
+        self.logger.info("Running query: %s" % search.serialize())
+        response = conn.search_raw(search, indices=self.search_index_name,
+                                   **self.query_params())
+        return SearchResults(response, size=self.limit,
+                             sorted_hits=self.keyword_fields and
+                             bool(sort_keys))
+
+    def scroll(self, keepalive='5m', size=500):
+        """Opens a scan scroll over every hit of the query.
+
+        Returns the total number of hits and the ScrollPages of their
+        source documents.
+        """
+        conn = self.client
+        search = pyes.Search(self.build_query(), size=size)
+        self.logger.info("Scrolling query: %s" % search.serialize())
+        response = conn.search_raw(search, indices=self.search_index_name,
+                                   search_type='scan', scroll=keepalive,
+                                   **self.query_params())
+        total = response['hits']['total']
+        return total, ScrollPages(conn, response['_scroll_id'], keepalive,
+                                  self.logger)
+
+
+class ScrollPages(object):
+    """Iterates over pages of source documents from an open scroll.
+
+    The scroll is released once exhausted or closed, whether iterated or
+    not.
+    """
+
+    def __init__(self, client, scroll_id, keepalive, logger):
+        self.client = client
+        self.scroll_id = scroll_id
+        self.keepalive = keepalive
+        self.logger = logger
+
+    def __iter__(self):
+        try:
+            while self.scroll_id:
+                response = self.client.search_scroll(self.scroll_id,
+                                                     self.keepalive)
+                self.scroll_id = response.get('_scroll_id', self.scroll_id)
+                hits = response['hits']['hits']
+                if not hits:
+                    break
+                yield [hit.get('_source', {}) for hit in hits]
+        finally:
+            self.close()
+
+    def close(self):
+        scroll_id, self.scroll_id = self.scroll_id, None
+        if not scroll_id:
+            return
+        try:
+            self.client._send_request('DELETE', '_search/scroll', scroll_id)
+        except Exception:
+            self.logger.exception('Unable to clear search scroll')
@@ -0,0 +1,159 @@
+import BaseHTTPServer
+import SocketServer
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(labels):
+    return tuple(sorted((labels or {}).iteritems()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """Counters, gauges and histograms rendered in the Prometheus text
+    format."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.types = {}
+        self.values = {}
+
+    def _get(self, kind, name, labels, default):
+        key = (name, _labels(labels))
+        self.types.setdefault(name, kind)
+        if key not in self.values:
+            self.values[key] = default()
+        return key
+
+    def inc(self, name, labels=None, value=1):
+        with self.lock:
+            key = self._get('counter', name, labels, int)
+            self.values[key] += value
+
+    def set(self, name, value, labels=None):
+        with self.lock:
+            key = self._get('gauge', name, labels, int)
+            self.values[key] = value
+
+    def observe(self, name, value, labels=None):
+        with self.lock:
+            key = self._get('histogram', name, labels,
+                            lambda: Histogram(self.buckets))
+            self.values[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, labels)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.types):
+                kind = self.types[name]
+                lines.append('# TYPE %s %s' % (name, kind))
+                for key in sorted(k for k in self.values if k[0] == name):
+                    labels = key[1]
+                    value = self.values[key]
+                    if kind != 'histogram':
+                        lines.append('%s%s %s' % (
+                            name, _format_labels(labels),
+                            _format_value(value)))
+                        continue
+                    cumulative = 0
+                    for le, count in zip(value.buckets, value.counts):
+                        cumulative += count
+                        lines.append('%s_bucket%s %d' % (
+                            name, _format_labels(labels, [('le', le)]),
+                            cumulative))
+                    lines.append('%s_bucket%s %d' % (
+                        name, _format_labels(labels, [('le', '+Inf')]),
+                        value.count))
+                    lines.append('%s_sum%s %s' % (
+                        name, _format_labels(labels),
+                        _format_value(value.sum)))
+                    lines.append('%s_count%s %d' % (
+                        name, _format_labels(labels), value.count))
+        return '\n'.join(lines) + '\n'
+
+
+# metrics of this process
+registry = Metrics()
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class UnixHTTPServer(SocketServer.UnixStreamServer):
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        SocketServer.UnixStreamServer.server_bind(self)
+
+
+def start_server(address, metrics=registry):
+    """Serves metrics from a background thread.
+
+    :param address: host:port, or unix:<path> for a UNIX socket
+    """
+    if address.startswith('unix:'):
+        server = UnixHTTPServer(address[5:], MetricsHandler)
+    else:
+        host, port = address.rsplit(':', 1)
+        server = BaseHTTPServer.HTTPServer((host, int(port)), MetricsHandler)
+    server.metrics = metrics
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
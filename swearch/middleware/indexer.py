@@ -2,8 +2,10 @@
     Indexer Middleware module
 """
 import sys
+import time
 import traceback
 
+import eventlet
 from swift.common import swob
 from swift.common import utils as swift_utils
 
@@ -12,6 +14,57 @@ from swearch import rabbit
 from swearch import utils
 
 
+class WriteCoalescer(object):
+    """Buffers index actions for a short window keyed by index id.
+
+    Only the last action queued for an id within the window is run, so a
+    PUT followed by a burst of POSTs, or by a DELETE, costs one HEAD and
+    one publish.
+    """
+
+    def __init__(self, window, max_pending=10000, logger=None):
+        self.window = window
+        self.max_pending = max_pending
+        self.logger = logger
+        self.pending = {}
+        self.pool = eventlet.GreenPool()
+        self.flusher = eventlet.spawn(self._flusher)
+
+    def add(self, _id, action, *args):
+        if _id not in self.pending and len(self.pending) >= self.max_pending:
+            self._run(_id, action, args)
+            return
+
+        # The window starts with the first pending action so that
+        # constantly updated objects still get flushed.
+        if _id in self.pending:
+            self.logger.increment('swearch.coalesced')
+        deadline = self.pending.get(_id, (time.time() + self.window,))[0]
+        self.pending[_id] = (deadline, action, args)
+
+    def flush(self, force=False):
+        now = time.time()
+        for _id, (deadline, action, args) in self.pending.items():
+            if force or deadline <= now:
+                del self.pending[_id]
+                self.pool.spawn_n(self._run, _id, action, args)
+
+    def _run(self, _id, action, args):
+        try:
+            action(*args)
+        except Exception:
+            self.logger.exception('Unable to index %s' % _id)
+
+    def _flusher(self):
+        while True:
+            self.flush()
+            wait = self.window
+            if self.pending:
+                wait = min(deadline for deadline, action, args
+                           in self.pending.itervalues()) - time.time()
+            eventlet.sleep(max(wait, 0.01))
+
+
 class IndexMiddleware(object):
     """Indexer Middleware.
 
@@ -29,7 +82,20 @@ class IndexMiddleware(object):
         self.queue_config = config.get('queue', {})
         self.index_config = config.get('index', {})
         self.app = app
-        self.indexer = rabbit.RabbitMQElasticIndexer(self.queue_config)
+        # shares the proxy's logger, and so its statsd settings
+        self.indexer = rabbit.RabbitMQElasticIndexer(self.queue_config,
+                                                     logger=self.logger)
+
+        self.routing = index.get_routing(self.index_config)
+
+        self.coalescer = None
+        coalesce_window = float(
+            self.index_config.get('coalesce_window', 0))
+        if coalesce_window > 0:
+            self.coalescer = WriteCoalescer(
+                coalesce_window,
+                int(self.index_config.get('coalesce_max_pending', 10000)),
+                logger=self.logger)
 
     def __call__(self, env, start_response):
         req = swob.Request(env)
@@ -37,21 +103,33 @@ class IndexMiddleware(object):
         def my_start_response(status, headers, exc_info=None):
             # Register a posthook to index requests
             status_int = int(status.split(' ', 1)[0])
+            # Handed to the update handlers so writes can be indexed
+            # without a HEAD back through the proxy.
+            resp_headers = dict((k.lower(), v) for k, v in headers)
             if 'eventlet.posthooks' in env:
                 env['eventlet.posthooks'].append(
-                    (self.index_request, (req, status_int), {}))
+                    (self.index_request, (req, status_int, resp_headers), {}))
             else:
                 # If I don't have the ability to register a posthook,
                 # the response hasn't been fullfilled yet
                 try:
-                    self.index_request(env, req, status_int)
+                    self.index_request(env, req, status_int, resp_headers)
                 except Exception:
                     traceback.print_exc(file=sys.stdout)
             start_response(status, headers, exc_info)
 
         return self.app(env, my_start_response)
 
-    def index_request(self, env, req, status):
+    def bump_generation(self, memcache, account):
+        """Invalidates the account's cached search results on every
+        proxy."""
+        try:
+            memcache.set(utils.search_generation_key(account), time.time())
+        except Exception:
+            self.logger.exception(
+                'Unable to update search generation of %s' % account)
+
+    def index_request(self, env, req, status, resp_headers=None):
         """Index the request by creating a task in the indexer."""
 
         if status // 100 is not 2:
@@ -59,6 +137,7 @@ class IndexMiddleware(object):
         if req.method not in ['DELETE', 'PUT', 'POST', 'COPY']:
             return
 
+        start = time.time()
         version, account, container, obj = swift_utils.split_path(req.path,
                                                                   1, 4, True)
 
@@ -70,6 +149,11 @@ class IndexMiddleware(object):
         if account == 'AUTH_.auth':
             return
 
+        memcache = env.get('swift.cache')
+        if memcache:
+            # off the request path, so a slow memcache can't hold up writes
+            eventlet.spawn_n(self.bump_generation, memcache, account)
+
         if obj and container and account:
             update_handler = index.ObjectUpdateHandler(
                 self.indexer,
@@ -78,7 +162,8 @@ class IndexMiddleware(object):
                 obj,
                 index=self.index_config.get('search_index_name'),
                 app=self.app,
-                logger=self.logger)
+                logger=self.logger,
+                routing=self.routing)
         elif container and account:
             update_handler = index.ContainerUpdateHandler(
                 self.indexer,
@@ -86,7 +171,8 @@ class IndexMiddleware(object):
                 container,
                 index=self.index_config.get('search_index_name'),
                 app=self.app,
-                logger=self.logger)
+                logger=self.logger,
+                routing=self.routing)
         else:
             update_handler = None
 
@@ -101,7 +187,25 @@ class IndexMiddleware(object):
             if handler:
                 self.logger.info("Indexing request: %s %s" % (req.method,
                                                               req.path))
-                handler(req)
+                self.logger.increment('swearch.actions.%s' % req.method)
+                if self.coalescer:
+                    _id = index.get_index_id(account, container, obj)
+                    if obj and req.method == 'POST' and \
+                            _id in self.coalescer.pending:
+                        # a partial update can't stand in for the write
+                        # it replaces, which may not be indexed yet
+                        handler = update_handler.update
+                    self.coalescer.add(_id, handler, req, resp_headers)
+                else:
+                    handler(req, resp_headers)
+
+        # swift's statsd client has no gauges, as a timer the depth still
+        # gets its percentiles
+        self.logger.timing('swearch.publish_queue.depth',
+                           self.indexer.publish_queue.qsize())
+        self.logger.timing('swearch.publish_queue.bytes',
+                           self.indexer.publish_queue.bytes)
+        self.logger.timing_since('swearch.index_request.timing', start)
 
 
 def filter_factory(global_conf, **local_conf):
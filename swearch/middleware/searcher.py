@@ -4,6 +4,7 @@
 import json
 import socket
 import sys
+import time
 import traceback
 from xml.sax import saxutils
 
@@ -11,9 +12,61 @@ from swift.common import swob
 from swift.common import utils as swift_utils
 
 from swearch import index
+from swearch import prep
 from swearch import utils
 
 
+# Serialized results are written out in chunks of about this many bytes
+CHUNK_SIZE = 65536
+
+
+def _text(val):
+    if isinstance(val, basestring):
+        return utils.unicode_encode(val)
+    return str(val)
+
+
+def serialize_json(items):
+    yield '['
+    for i, item in enumerate(items):
+        if i:
+            yield ', '
+        yield json.dumps(item)
+    yield ']'
+
+
+def serialize_xml(items):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<results>'
+    for item in items:
+        yield '\n<object>'
+        for key, val in item.iteritems():
+            yield '<%s>%s</%s>' % (key, saxutils.escape(_text(val)), key)
+        yield '</object>'
+    yield '\n</results>'
+
+
+def serialize_text(items):
+    for item in items:
+        for key, val in item.iteritems():
+            yield '%s: %s\n' % (_text(key), _text(val))
+        yield '\n'
+
+
+def buffered(chunks, size=CHUNK_SIZE):
+    """Joins small serialized chunks into writes of about size bytes."""
+    buf = []
+    buf_len = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        buf_len += len(chunk)
+        if buf_len >= size:
+            yield ''.join(buf)
+            buf = []
+            buf_len = 0
+    if buf:
+        yield ''.join(buf)
+
+
 class SearchMiddleware(object):
     """Search API Middleware."""
 
@@ -33,6 +86,89 @@ class SearchMiddleware(object):
 
         hosts_str = index_config.get('elastic_hosts', '127.0.0.1:9200')
         self.elastic_hosts = [x.strip() for x in hosts_str.split(',')]
+        self.search_client = index.get_search_client(index_config)
+        self.routing = index.get_routing(index_config)
+        # indexes created by swearch-prep have a text field instead of _all
+        self.default_field = index_config.get(
+            'search_default_field', prep.TEXT_FIELD)
+        # sort by path and page with cursor markers
+        self.keyword_fields = index_config.get(
+            'search_keyword_fields',
+            'false').lower() in swift_utils.TRUE_VALUES
+
+        # Results are cached per account generation, which IndexMiddleware
+        # bumps in memcache on every write. Generations younger than
+        # search_cache_settle seconds aren't cached as ES may still be
+        # catching up with the river.
+        self.result_cache = None
+        cache_size = int(index_config.get('search_cache_size', 1000))
+        if cache_size > 0:
+            self.result_cache = utils.LRUCache(
+                cache_size, float(index_config.get('search_cache_ttl', 60)))
+        self.cache_settle = float(
+            index_config.get('search_cache_settle', 5))
+        self.cache_max_rows = int(
+            index_config.get('search_cache_max_rows', 1000))
+
+        self.export_keepalive = index_config.get('export_keepalive', '5m')
+        self.export_page_size = int(
+            index_config.get('export_page_size', 500))
+
+    def search_generation(self, req, account):
+        """Returns the account's search generation, or None if results for
+        the account can't be cached right now."""
+        memcache = req.environ.get('swift.cache')
+        if self.result_cache is None or memcache is None:
+            return None
+        try:
+            generation = memcache.get(utils.search_generation_key(account))
+        except Exception:
+            self.logger.exception('Unable to get search generation')
+            return None
+        if generation is None:
+            # evicted, or written to before memcache came up; a write
+            # would go unnoticed by results cached under a guess
+            return None
+        generation = float(generation)
+        if time.time() - generation < self.cache_settle:
+            return None
+        return generation
+
+    def cache_results(self, items, cache_key, page_info):
+        """Passes the results through, caching them along with the page's
+        total and next marker once all were served."""
+        result_list = []
+        for item in items:
+            result_list.append(item)
+            yield item
+        self.result_cache.set(cache_key, (result_list,) + page_info)
+
+    def export(self, req, srch):
+        """Streams every hit of the search as newline delimited JSON."""
+        srch.marker = None
+        try:
+            total, pages = srch.scroll(self.export_keepalive,
+                                       self.export_page_size)
+        except socket.timeout:
+            return swob.HTTPServiceUnavailable(req=req)
+
+        def body():
+            for page in pages:
+                yield ''.join(
+                    '%s\n' % json.dumps(index.filter_result_props(item))
+                    for item in page)
+
+        if req.method == 'HEAD':
+            pages.close()
+        headers = [
+            ('X-Search-Items-Total', total),
+            ('Content-Type', 'application/x-ndjson'),
+        ]
+        # closing the response releases the scroll, even when the client
+        # went away before the body was started
+        return swob.Response(
+            request=req, app_iter=swift_utils.CloseableChain(body(), pages),
+            headers=headers)
 
     def GET(self, req):
         """Serves a GET to the middleware."""
@@ -80,6 +216,8 @@ class SearchMiddleware(object):
         field = (req.params.get('field', None)
                  or req.params.get('df', None)
                  or '_all')
+        if field == '_all':
+            field = self.default_field
 
         marker = req.params.get('marker', None)
 
@@ -93,7 +231,10 @@ class SearchMiddleware(object):
         srch = index.Searcher(self.elastic_hosts,
                               self.search_index_name,
                               account,
-                              logger=self.logger)
+                              logger=self.logger,
+                              client=self.search_client,
+                              routing=self.routing,
+                              keyword_fields=self.keyword_fields)
         srch.logger = self.logger
         if query:
             srch.add_condition(field, query)
@@ -109,50 +250,62 @@ class SearchMiddleware(object):
         srch.start = start
         srch.marker = marker
 
-        try:
-            results = srch.execute()
-        except socket.timeout:
-            return swob.HTTPServiceUnavailable(req=req)
+        export = req.params.get('export', '').lower()
+        if export == 'ndjson':
+            return self.export(req, srch)
+        elif export:
+            return swob.HTTPBadRequest(request=req)
 
-        self.logger.debug(results)
+        cached = cache_key = None
+        generation = self.search_generation(req, account)
+        if generation is not None:
+            cache_key = (generation, account, path, recursive, _type,
+                         tuple(sorted(srch.conditions)), sort, limit, start,
+                         marker)
+            cached = self.result_cache.get(cache_key)
+
+        if cached:
+            result_list, total, next_marker = cached
+            items = iter(result_list)
+        else:
+            try:
+                results = srch.execute()
+            except socket.timeout:
+                return swob.HTTPServiceUnavailable(req=req)
 
-        result_list = []
-        for item in results:
-            t = index.filter_result_props(item)
-            result_list.append(t)
+            self.logger.debug(results)
+
+            # Hits are filtered and serialized as they are read from the
+            # response rather than collected first.
+            total = results.total
+            next_marker = results.next_marker
+            items = (index.filter_result_props(item) for item in results)
+
+        # markers filter the hits, so total already excludes those before
+        # the marker and only start is left to skip
+        count = max(0, min(limit, total - start))
+        if not cached and cache_key and count <= self.cache_max_rows:
+            items = self.cache_results(items, cache_key, (total, next_marker))
 
         headers = [
-            ('X-Search-Items-Count', len(result_list)),
-            ('X-Search-Items-Total', results.total),
+            ('X-Search-Items-Count', count),
+            ('X-Search-Items-Total', total),
             ('X-Search-Items-Offset', start),
         ]
+        if next_marker:
+            headers.append(('X-Search-Next-Marker', next_marker))
 
         if fmt == 'json':
             headers.append(('Content-Type', 'application/json; charset=utf-8'))
-            return swob.Response(request=req, body=json.dumps(result_list),
-                                 headers=headers)
+            body = serialize_json(items)
         elif fmt == 'xml':
             headers.append(('Content-Type', 'application/xml; charset=utf-8'))
-            output_list = [
-                '<?xml version="1.0" encoding="UTF-8"?>', '<results>']
-            for res in result_list:
-                item = '<object>'
-                for key, val in res.iteritems():
-                    item += '<%s>%s</%s>' % (
-                        key, saxutils.escape(str(val)), key)
-                item += '</object>'
-                output_list.append(item)
-            output_list.append('</results>')
-            res_body = '\n'.join(output_list)
-            return swob.Response(request=req, body=res_body, headers=headers)
+            body = serialize_xml(items)
         else:
             headers.append(('Content-Type', 'text/plain'))
-            res_body = ''
-            for res in result_list:
-                for key, val in res.iteritems():
-                    res_body += str(key) + ': ' + str(val) + '\n'
-                res_body += '\n'
-            return swob.Response(request=req, body=res_body, headers=headers)
+            body = serialize_text(items)
+        return swob.Response(request=req, app_iter=buffered(body),
+                             headers=headers)
 
     def __call__(self, env, start_response):
         req = swob.Request(env)
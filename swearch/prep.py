@@ -0,0 +1,114 @@
+"""
+    Prep module. Creates search indexes with the swearch mapping and points
+    the search_index_name alias at them.
+"""
+import time
+
+from pyes.exceptions import IndexMissingException
+
+from swearch.index import get_routing
+
+DOC_TYPE = 'entity'
+# searched by default in place of _all
+TEXT_FIELD = 'text'
+# exact match, sortable fields
+KEYWORD_FIELDS = ['account', 'container', 'path', 'dir', 'type',
+                  'content_type', 'name']
+# copied into TEXT_FIELD, along with meta.*
+TEXT_SOURCES = ['container', 'path', 'content_type', 'analyzed_name']
+
+
+def index_mapping(routing=False):
+    """Returns the mapping of indexed documents.
+
+    :param routing: Require a routing value, see index.AccountRouting.
+    """
+    properties = {
+        TEXT_FIELD: {'type': 'string'},
+        'analyzed_name': {'type': 'string'},
+        'object': {'type': 'string', 'index': 'not_analyzed'},
+        'hash': {'type': 'string', 'index': 'not_analyzed'},
+        'read': {'type': 'string', 'index': 'not_analyzed'},
+        'write': {'type': 'string', 'index': 'not_analyzed'},
+        'meta': {'type': 'object'},
+    }
+    for name in KEYWORD_FIELDS:
+        properties[name] = {'type': 'string', 'index': 'not_analyzed',
+                            'doc_values': True}
+    for name in TEXT_SOURCES:
+        properties[name]['copy_to'] = TEXT_FIELD
+
+    mapping = {
+        '_all': {'enabled': False},
+        # metadata values are free form, don't let the first one seen
+        # decide they're dates or numbers
+        'date_detection': False,
+        'numeric_detection': False,
+        'dynamic_templates': [{
+            'meta': {
+                'path_match': 'meta.*',
+                'mapping': {'type': 'string', 'copy_to': TEXT_FIELD},
+            },
+        }],
+        'properties': properties,
+    }
+    if routing:
+        mapping['_routing'] = {'required': True}
+    return mapping
+
+
+def index_settings(config, bulk=False):
+    """Returns the index settings from the [index] config.
+
+    :param bulk: Settings for loading the index, without replicas or
+        periodic refreshes until finish_index restores them.
+    """
+    settings = {
+        'number_of_shards': int(config.get('index_shards', 5)),
+        'number_of_replicas': int(config.get('index_replicas', 1)),
+        'refresh_interval': config.get('index_refresh_interval', '1s'),
+    }
+    if bulk:
+        settings['number_of_replicas'] = 0
+        settings['refresh_interval'] = '-1'
+    return settings
+
+
+def new_index_name(config):
+    """Returns a name for a new index behind the search_index_name
+    alias."""
+    return '%s-%s' % (config.get('search_index_name', 'os_default'),
+                      time.strftime('%Y%m%d%H%M%S'))
+
+
+def create_index(client, name, config, bulk=False):
+    client.indices.create_index(name, {
+        'settings': index_settings(config, bulk),
+        'mappings': {
+            DOC_TYPE: index_mapping(get_routing(config) is not None),
+        },
+    })
+
+
+def finish_index(client, name, config):
+    """Restores the replicas and refresh interval of a bulk loaded
+    index."""
+    settings = index_settings(config)
+    del settings['number_of_shards']
+    client.indices.update_settings(name, {'index': settings})
+
+
+def alias_indices(client, config):
+    """Returns the indices search_index_name points at."""
+    try:
+        return client.indices.get_alias(
+            config.get('search_index_name', 'os_default'))
+    except IndexMissingException:
+        return []
+
+
+def point_alias(client, name, config):
+    """Points search_index_name at the index alone, in one aliases
+    update."""
+    client.indices.set_alias(
+        config.get('search_index_name', 'os_default'), [name])
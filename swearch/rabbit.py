@@ -1,17 +1,53 @@
+import collections
 import json
 import random
 import sys
+import time
 import traceback
+from contextlib import contextmanager
 
 import eventlet
 import pika
 from swift.common import utils
 
+from swearch import buffer
+from swearch import metrics
+from swearch import spool
+
+# shared by every message, they are never modified
+PERSISTENT = pika.BasicProperties(delivery_mode=2)
+
+
+class PipelinedChannel(object):
+    """
+    Publishes on a BlockingChannel without waiting for broker confirms.
+
+    BlockingChannel only offers publishing that blocks until the message
+    is confirmed, so this goes through the underlying asynchronous channel
+    of pika before 1.0, which requirements.txt pins.
+    """
+
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.channel = channel
+
+    def select_confirms(self, callback):
+        """Puts the channel in confirm mode, acks and nacks are passed to
+        callback as they arrive."""
+        self.channel._impl.confirm_delivery(callback, nowait=True)
+
+    def publish(self, **kwargs):
+        """Sends a message with the basic_publish arguments."""
+        self.channel._impl.basic_publish(**kwargs)
+        # flushes the frames without waiting for the ack
+        self.connection.process_data_events(time_limit=0)
+
 
 class RabbitMQElasticIndexer(object):
-    def __init__(self, conf):
+    def __init__(self, conf, logger=None):
         # RabbitMQ Config
-        self.logger = utils.get_logger(conf, log_route='swearch-rabbit')
+        self.logger = logger or utils.get_logger(conf,
+                                                 log_route='swearch-rabbit')
         urls_str = conf.get('rabbitmq_hosts', '127.0.0.1:5672')
         urls = [x.strip() for x in urls_str.split(',')]
         self.rabbitmq_hosts = []
@@ -24,6 +60,10 @@ class RabbitMQElasticIndexer(object):
         self.rabbitmq_vhost = conf.get('rabbitmq_vhost', 'swift')
         self.rabbitmq_buffer_size = int(conf.get('rabbitmq_buffer_size',
                                                  '50000').strip())
+        self.rabbitmq_buffer_bytes = int(conf.get(
+            'rabbitmq_buffer_mb', '64').strip()) << 20
+        self.rabbitmq_buffer_overflow = conf.get(
+            'rabbitmq_buffer_overflow', buffer.DROP_NEWEST).strip().lower()
 
         # Set up connection params
         credentials = pika.PlainCredentials(
@@ -37,9 +77,13 @@ class RabbitMQElasticIndexer(object):
                 connection_attempts=2, heartbeat_interval=20,
             ))
 
-        # Lazy loaded
+        # Lazy loaded. pika's BlockingConnection can't be used by two green
+        # threads at once, so consumers get a connection of their own and
+        # the publishing one is only used holding _conn_lock, see
+        # mq_client.
         self.connection = None
         self.channel = None
+        self.consumer_connection = None
 
         self.require_confirmations = (conf.get(
             'rabbitmq_require_confirmations',
@@ -47,6 +91,35 @@ class RabbitMQElasticIndexer(object):
         self.send_attempts = int(
             conf.get('rabbitmq_send_attempts', '2').strip())
 
+        # With confirmations required, a non-zero window lets the publisher
+        # keep that many messages in flight instead of blocking on every
+        # broker ack. Unacknowledged messages are resent after the timeout.
+        self.confirm_window = int(
+            conf.get('rabbitmq_confirm_window', '0').strip())
+        self.confirm_timeout = float(
+            conf.get('rabbitmq_confirm_timeout', '30').strip())
+        self._delivery_tag = 0
+        self._unconfirmed = collections.OrderedDict()
+        self._resend = collections.deque()
+        self._conn_lock = eventlet.semaphore.Semaphore()
+
+        # Number of queued actions sent to the river as one bulk message,
+        # and how long the publisher waits for a batch to fill up.
+        self.batch_size = max(int(
+            conf.get('rabbitmq_batch_size', '100').strip()), 1)
+        self.batch_linger = float(
+            conf.get('rabbitmq_batch_linger_ms', '0').strip()) / 1000.0
+
+        # Actions carrying the Swift timestamp they were made at are
+        # versioned with it, so ES rejects those arriving out of order.
+        self.external_versioning = conf.get(
+            'external_versioning', 'true').lower() in utils.TRUE_VALUES
+
+        # Partial updates merge objects such as meta into the indexed ones,
+        # so updates replace fields through a script instead.
+        self.update_script = conf.get(
+            'update_script', 'ctx._source.putAll(fields)')
+
         self.rabbitmq_exchange = conf.get(
             'rabbitmq_exchange', 'search.exchange')
         self.rabbitmq_queue = conf.get('rabbitmq_queue', 'elasticsearch')
@@ -57,10 +130,32 @@ class RabbitMQElasticIndexer(object):
         self.rabbitmq_backfill_queue = conf.get(
             'rabbitmq_backfill_queue', 'search.backfill')
 
+        # With a spool directory, queued messages are journaled to disk
+        # and published from there instead of the in-memory queue, so
+        # they survive restarts and broker outages. Every process takes
+        # a spool of its own under the directory.
+        self.spool = None
+        spool_dir = conf.get('rabbitmq_spool_dir', '').strip()
+        if spool_dir:
+            self.spool = spool.open_spool(
+                spool_dir,
+                max_bytes=int(conf.get(
+                    'rabbitmq_spool_max_mb', '1024').strip()) << 20,
+                segment_bytes=int(conf.get(
+                    'rabbitmq_spool_segment_mb', '16').strip()) << 20,
+                logger=self.logger)
+        # seconds between fsyncs of the spool, off the request path
+        self.spool_sync_interval = float(
+            conf.get('rabbitmq_spool_sync_interval', '1').strip())
+
         # Heartbeat greenlet
-        self.publish_queue = eventlet.Queue(self.rabbitmq_buffer_size)
+        self.publish_queue = buffer.PublishBuffer(
+            self.rabbitmq_buffer_bytes, self.rabbitmq_buffer_size,
+            self.rabbitmq_buffer_overflow)
         self.heartbeat = eventlet.spawn(self._heartbeat)
         self.publisher = eventlet.spawn(self._publisher)
+        if self.spool and self.spool_sync_interval > 0:
+            eventlet.spawn(self._spool_syncer)
 
         self._timeout = None
 
@@ -71,7 +166,8 @@ class RabbitMQElasticIndexer(object):
         while True:
             try:
                 if self.connection and self.connection.is_open:
-                    self.connection.process_data_events()
+                    with self._conn_lock:
+                        self.connection.process_data_events()
                 elif self.connection and not self.connection.is_open:
                     self.connection = self.channel = None
             except Exception:
@@ -87,40 +183,273 @@ class RabbitMQElasticIndexer(object):
         while True:
             self._publish_retry()
 
+    def _spool_syncer(self):
+        while True:
+            eventlet.sleep(self.spool_sync_interval)
+            try:
+                self.spool.sync()
+            except Exception:
+                self.logger.exception('Unable to sync the spool.')
+
+    def _get_batch(self, timeout=None):
+        """Blocks for the next queued message, then drains up to batch_size
+        messages waiting at most batch_linger seconds for more to arrive.
+
+        Returns (message, source) pairs, source being the spool segment
+        of the message or None when it came from publish_queue.
+
+        Raises eventlet.queue.Empty if nothing was queued within timeout.
+        """
+        if self.spool:
+            return self._get_spooled_batch(timeout)
+
+        batch = [self.publish_queue.get(True, timeout)]
+        deadline = time.time() + self.batch_linger
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self.publish_queue.get(True, timeout))
+                else:
+                    batch.append(self.publish_queue.get(False))
+            except eventlet.queue.Empty:
+                break
+        return [(message, None) for message in batch]
+
+    def _get_spooled_batch(self, timeout=None):
+        batch = self.spool.read(self.batch_size, timeout)
+        if not batch:
+            raise eventlet.queue.Empty()
+        deadline = time.time() + self.batch_linger
+        while len(batch) < self.batch_size and time.time() < deadline:
+            batch.extend(self.spool.read(self.batch_size - len(batch),
+                                         deadline - time.time()))
+
+        return [(buffer.Message(str(record['exchange']),
+                                str(record['routing_key']),
+                                record['body'].encode('utf-8'), None),
+                 segment)
+                for segment, record in batch]
+
+    def _merge_batch(self, batch):
+        """Joins the bulk bodies of messages bound for the same exchange and
+        routing key into single messages, preserving their order.
+
+        Returns a list of (kwargs, sources) tuples, kwargs being those of
+        basic_publish and sources holding the source of every message
+        merged into each.
+        """
+        merged = []
+        for message, source in batch:
+            if merged and (
+                    merged[-1][0]['exchange'] == message.exchange and
+                    merged[-1][0]['routing_key'] == message.routing_key):
+                merged[-1][0]['body'].append(message.body)
+                merged[-1][1].append(source)
+            else:
+                merged.append((dict(
+                    exchange=message.exchange,
+                    routing_key=message.routing_key,
+                    body=[message.body],
+                    mandatory=True,
+                    properties=PERSISTENT), [source]))
+        for kwargs, sources in merged:
+            kwargs['body'] = ''.join(kwargs['body'])
+        return merged
+
+    def _done(self, sources):
+        """Releases queued messages once sent or given up on."""
+        for source in sources:
+            if source is None:
+                self.publish_queue.task_done()
+            else:
+                self.spool.ack(source)
+
     def _publish_retry(self):
-        """Blocking call with reconnect logic for publishing a single message.
+        """Blocking call with reconnect logic for publishing a batch of
+        messages.
 
         Reduces the likelihood of dropping an indexer message.
         """
 
-        kwargs = self.publish_queue.get(True)
-        conn, chan = self.get_mq_client()
+        if self.require_confirmations and self.confirm_window > 0:
+            return self._publish_pipelined()
+
+        batch = self._get_batch()
+        for kwargs, sources in self._merge_batch(batch):
+            if not self._send_retry(kwargs):
+                self.logger.update_stats('swearch.publish.dropped',
+                                         len(sources))
+            self._done(sources)
+
+    def _send_retry(self, kwargs):
+        reconnect = False
+        start = time.time()
         for i in range(self.send_attempts):
             try:
-                result = chan.basic_publish(**kwargs)
-                if result:
+                with self.mq_client(reconnect) as (conn, chan):
+                    sent = chan.basic_publish(**kwargs)
+                if sent:
                     # message sent successfully
-                    self.publish_queue.task_done()
-                    break
+                    metrics.registry.observe('swearch_publish_seconds',
+                                             time.time() - start)
+                    return True
 
                 self.logger.error(
                     'Unable to confirm delivery of message '
                     'to rabbit: %s'
                     % kwargs)
-                self.get_mq_client(reconnect=True)
             except Exception:
                 self.logger.exception(
                     'Unable to deliver message to rabbit: %s' % kwargs)
-                self.get_mq_client(reconnect=True)
+            reconnect = True
+
+        self.logger.error(
+            'Giving up delivering message to rabbit: %s' % kwargs)
+        return False
+
+    def _publish_pipelined(self):
+        """Publishes the next batch without blocking on broker confirms.
+
+        Up to confirm_window messages are kept in flight. Acks and nacks
+        are matched back to them in _on_confirm and only the nacked or
+        timed out messages are resent.
+        """
+        if self._resend:
+            messages = [self._resend.popleft()]
         else:
-            self.publish_queue.task_done()
+            timeout = None
+            if self._unconfirmed:
+                timeout = self.confirm_timeout
+            try:
+                batch = self._get_batch(timeout)
+            except eventlet.queue.Empty:
+                self._expire_unconfirmed()
+                return
+            messages = [(kwargs, 0, sources)
+                        for kwargs, sources in self._merge_batch(batch)]
+
+        for kwargs, attempts, sources in messages:
+            self._wait_for_window()
+            try:
+                self._publish_async(kwargs, attempts + 1, sources)
+            except Exception:
+                self.logger.exception(
+                    'Unable to deliver message to rabbit: %s' % kwargs)
+                self._retry_unconfirmed(kwargs, attempts + 1, sources)
+                with self.mq_client(reconnect=True):
+                    pass
+
+    def _publish_async(self, kwargs, attempts, sources):
+        with self.mq_client() as (conn, chan):
+            self._delivery_tag += 1
+            tag = self._delivery_tag
+            self._unconfirmed[tag] = (kwargs, attempts, sources, time.time())
+            try:
+                PipelinedChannel(conn, chan).publish(**kwargs)
+            except Exception:
+                self._unconfirmed.pop(tag, None)
+                raise
+
+    def _wait_for_window(self):
+        while len(self._unconfirmed) >= self.confirm_window:
+            self._expire_unconfirmed()
+            if len(self._unconfirmed) < self.confirm_window:
+                break
+            try:
+                with self.mq_client() as (conn, chan):
+                    conn.process_data_events(time_limit=0.1)
+            except Exception:
+                self.logger.exception('Failed waiting for rabbit confirms.')
+                eventlet.sleep(1)
+                with self.mq_client(reconnect=True):
+                    pass
+
+    def _on_confirm(self, frame):
+        """Delivery confirmation callback for the pipelined publisher."""
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self._unconfirmed
+                    if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        nacked = isinstance(method, pika.spec.Basic.Nack)
+
+        for tag in tags:
+            entry = self._unconfirmed.pop(tag, None)
+            if entry is None:
+                continue
+            kwargs, attempts, sources, sent = entry
+            if nacked:
+                metrics.registry.inc('swearch_publish_nacks_total')
+                self.logger.error(
+                    'Rabbit rejected delivery of message: %s' % kwargs)
+                self._retry_unconfirmed(kwargs, attempts, sources)
+            else:
+                metrics.registry.observe('swearch_publish_seconds',
+                                         time.time() - sent)
+                self._done(sources)
+
+    def _expire_unconfirmed(self):
+        expired = time.time() - self.confirm_timeout
+        while self._unconfirmed:
+            tag, entry = next(self._unconfirmed.iteritems())
+            kwargs, attempts, sources, sent = entry
+            if sent > expired:
+                break
+            del self._unconfirmed[tag]
             self.logger.error(
-                'Giving up delivering message to rabbit: %s' % kwargs)
+                'Timed out waiting for rabbit to confirm message: %s'
+                % kwargs)
+            self._retry_unconfirmed(kwargs, attempts, sources)
+
+    def _retry_unconfirmed(self, kwargs, attempts, sources):
+        if attempts < self.send_attempts:
+            self._resend.append((kwargs, attempts, sources))
+            return
 
-    def _publish(self, block=False, **kwargs):
+        self.logger.error(
+            'Giving up delivering message to rabbit: %s' % kwargs)
+        self.logger.update_stats('swearch.publish.dropped', len(sources))
+        self._done(sources)
+
+    def _select_confirms(self):
+        """Puts a new channel in confirm mode for the pipelined publisher.
+
+        Delivery tags restart with the channel, so anything still in flight
+        on the previous one is resent.
+        """
+        unconfirmed = self._unconfirmed.values()
+        self._unconfirmed.clear()
+        for kwargs, attempts, sources, sent in unconfirmed:
+            self._retry_unconfirmed(kwargs, attempts, sources)
+        self._delivery_tag = 0
+        PipelinedChannel(self.connection, self.channel).select_confirms(
+            self._on_confirm)
+
+    def _publish(self, body, key=None, block=False):
+        """Queues a bulk body for the river.
+
+        :param key: Document the body acts on, for coalescing.
+        """
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        message = buffer.Message(self.rabbitmq_exchange,
+                                 self.rabbitmq_routing_key, body, key)
         try:
-            self.publish_queue.put(kwargs, block)
+            if self.spool:
+                self.spool.append(dict(exchange=message.exchange,
+                                       routing_key=message.routing_key,
+                                       body=message.body))
+            else:
+                dropped = self.publish_queue.dropped
+                self.publish_queue.put(message, block)
+                if self.publish_queue.dropped > dropped:
+                    self.logger.update_stats(
+                        'swearch.publish.overflow_dropped',
+                        self.publish_queue.dropped - dropped)
         except Exception:
+            self.logger.increment('swearch.publish.enqueue_failed')
             self.logger.exception("Unable to queue message for publishing to "
                                   "rabbitmq. Messages have been lost!")
         else:
@@ -128,66 +457,102 @@ class RabbitMQElasticIndexer(object):
 
         return False
 
-    def index_doc(self, index_name, _id, props, block=False):
+    def _meta_props(self, index_name, _id, version=None, routing=None,
+                    version_type='external_gte'):
         meta_props = {
             "_index": index_name,
             "_type": "entity",
             "_id": _id
         }
-        doc = "%s\n%s\n" % (
+        if version is not None and self.external_versioning:
+            # external_gte, so that repairs at the same version apply
+            meta_props["_version"] = version
+            meta_props["_version_type"] = version_type
+        if routing:
+            meta_props["_routing"] = routing
+        return meta_props
+
+    def _index_action(self, index_name, _id, props, version=None,
+                      routing=None, version_type='external_gte'):
+        meta_props = self._meta_props(index_name, _id, version, routing,
+                                      version_type)
+        return "%s\n%s\n" % (
             json.dumps({"index": meta_props}),
             json.dumps(props)
         )
-        self._publish(
-            block=block,
-            exchange=self.rabbitmq_exchange,
-            mandatory=True,
-            routing_key=self.rabbitmq_routing_key,
-            body=doc,
-            properties=pika.BasicProperties(
-                delivery_mode=2,  # make message persistent
-            ),
-        )
 
-    def remove_doc(self, index_name, _id):
-        meta_props = {
-            "_index": index_name,
-            "_type": "entity",
-            "_id": _id
-        }
-        doc = "%s\n" % (json.dumps({"delete": meta_props}))
+    def _update_action(self, index_name, _id, fields, routing=None):
+        meta_props = self._meta_props(index_name, _id, routing=routing)
+        meta_props["_retry_on_conflict"] = 3
+        return "%s\n%s\n" % (
+            json.dumps({"update": meta_props}),
+            json.dumps({"script": self.update_script,
+                        "params": {"fields": fields}})
+        )
 
+    def update_doc(self, index_name, _id, fields, block=False,
+                   routing=None):
+        """Publishes an update replacing fields of an indexed document,
+        objects included. The river fails it if the document isn't
+        indexed."""
+        # not keyed, a full action for the document mustn't coalesce with
+        # it, see PublishBuffer
+        self._publish(self._update_action(index_name, _id, fields, routing),
+                      block=block)
+
+    def index_doc(self, index_name, _id, props, block=False, version=None,
+                  routing=None):
         self._publish(
-            exchange=self.rabbitmq_exchange,
-            mandatory=True,
-            routing_key=self.rabbitmq_routing_key,
-            body=doc,
-            properties=pika.BasicProperties(
-                delivery_mode=2,  # make message persistent
-            ),
-        )
+            self._index_action(index_name, _id, props, version, routing),
+            key=(index_name, _id), block=block)
+
+    def index_docs(self, index_name, docs, block=False, routing=None,
+                   version_type='external_gte'):
+        """Publishes (_id, props) or (_id, props, version) tuples sharing a
+        routing value as bulk messages of up to batch_size documents
+        each.
+
+        :param version_type: external to leave documents indexed at the
+                             same version alone.
+        """
+        for start in xrange(0, len(docs), self.batch_size):
+            self._publish(
+                ''.join(self._index_action(index_name, *doc, routing=routing,
+                                           version_type=version_type)
+                        for doc in docs[start:start + self.batch_size]),
+                block=block)
+
+    def remove_doc(self, index_name, _id, version=None, routing=None):
+        meta_props = self._meta_props(index_name, _id, version, routing)
+        doc = "%s\n" % (json.dumps({"delete": meta_props}))
+        self._publish(doc, key=(index_name, _id))
 
     def publish_backfill_task(self, _type, *args, **kwargs):
-        conn, channel = self.get_mq_client()
-        channel.basic_publish(
+        message = dict(
             exchange=self.rabbitmq_backfill_exchange,
             mandatory=True,
             routing_key=_type,
             body=json.dumps(
                 {'type': 'index_' + _type, 'args': args, 'kwargs': kwargs}),
-            properties=pika.BasicProperties(
-                delivery_mode=2,  # make message persistent
-            ),
+            properties=PERSISTENT,
         )
+        if self.require_confirmations and self.confirm_window > 0:
+            # Shares the channel, and so the delivery tags, with the
+            # pipelined publisher.
+            self._wait_for_window()
+            self._publish_async(message, 1, [])
+        else:
+            with self.mq_client() as (conn, channel):
+                channel.basic_publish(**message)
 
     def backfill_queue_size(self, queue):
         queue = self.backfill_queue_name(queue)
         return self.queue_size(queue)
 
     def queue_size(self, name):
-        conn, channel = self.get_mq_client()
         try:
-            q = channel.queue_declare(queue=name, passive=True)
+            with self.mq_client() as (conn, channel):
+                q = channel.queue_declare(queue=name, passive=True)
         except KeyError:
             return -1
         if not q:
@@ -195,51 +560,62 @@ class RabbitMQElasticIndexer(object):
         return q.method.message_count
 
     def setup_river(self):
-        conn, channel = self.get_mq_client()
         queue = self.rabbitmq_queue
         exchange = self.rabbitmq_exchange
-        channel.queue_declare(queue=queue,
-                              durable=True,
-                              arguments={"x-ha-policy": "all"})
-        channel.exchange_declare(exchange=exchange, durable=True)
-        channel.queue_bind(queue=queue,
-                           exchange=exchange,
-                           routing_key=self.rabbitmq_routing_key)
-
-    def setup_backfill(self):
-        conn, channel = self.get_mq_client()
-        exchange = self.rabbitmq_backfill_exchange
-        channel.exchange_declare(exchange=exchange, durable=True)
-        for queue in ['object', 'container', 'account']:
-            queue_name = self.backfill_queue_name(queue)
-            channel.queue_declare(queue=queue_name,
+        with self.mq_client() as (conn, channel):
+            channel.queue_declare(queue=queue,
                                   durable=True,
                                   arguments={"x-ha-policy": "all"})
-            channel.queue_bind(queue=queue_name,
+            channel.exchange_declare(exchange=exchange, durable=True)
+            channel.queue_bind(queue=queue,
                                exchange=exchange,
-                               routing_key=queue)
+                               routing_key=self.rabbitmq_routing_key)
+
+    def setup_backfill(self):
+        exchange = self.rabbitmq_backfill_exchange
+        with self.mq_client() as (conn, channel):
+            channel.exchange_declare(exchange=exchange, durable=True)
+            for queue in ['object', 'container', 'account']:
+                queue_name = self.backfill_queue_name(queue)
+                channel.queue_declare(queue=queue_name,
+                                      durable=True,
+                                      arguments={"x-ha-policy": "all"})
+                channel.queue_bind(queue=queue_name,
+                                   exchange=exchange,
+                                   routing_key=queue)
 
     def consume_one(self, queue, handler):
-        conn, channel = self.get_mq_client()
         queue_name = self.backfill_queue_name(queue)
-        method_frame, header_frame, body = channel.basic_get(queue=queue_name)
+        with self.mq_client() as (conn, channel):
+            method_frame, header_frame, body = channel.basic_get(
+                queue=queue_name)
         if method_frame:
+            # the handler may publish, the connection isn't held meanwhile
             try:
                 handler(body)
             except Exception:
-                channel.basic_nack(method_frame.delivery_tag)
+                with self.mq_client() as (conn, channel):
+                    channel.basic_nack(method_frame.delivery_tag)
+                metrics.registry.inc('swearch_nacks_total')
                 traceback.print_exc(file=sys.stderr)
             else:
-                channel.basic_ack(method_frame.delivery_tag)
+                with self.mq_client() as (conn, channel):
+                    channel.basic_ack(method_frame.delivery_tag)
 
-    def start_consumer(self, queue, handler, prefetch=100):
-        conn, _ = self.get_mq_client()
+    def start_consumer(self, queue, handler, prefetch=100, concurrency=1,
+                       partition=None, throttle=None):
+        conn = self.get_consumer_connection()
         queue_name = self.backfill_queue_name(queue)
         fetched = 0
 
         channel = conn.channel()
         channel.basic_qos(prefetch_count=prefetch)
 
+        if concurrency > 1:
+            return self._consume_concurrently(
+                channel, queue_name, handler, prefetch, concurrency,
+                partition or hash, throttle)
+
         try:
             messages = channel.consume(queue_name)
             for method_frame, properties, body in messages:
@@ -248,10 +624,13 @@ class RabbitMQElasticIndexer(object):
                     break
 
                 try:
+                    if throttle:
+                        throttle()
                     handler(body)
                 except Exception:
                     traceback.print_exc(file=sys.stderr)
                     channel.basic_nack(method_frame.delivery_tag, requeue=True)
+                    metrics.registry.inc('swearch_nacks_total')
                     raise
                 else:
                     channel.basic_ack(method_frame.delivery_tag)
@@ -264,7 +643,94 @@ class RabbitMQElasticIndexer(object):
                 channel.close()
             channel._generator_messages = []
 
+    def _consume_concurrently(self, channel, queue_name, handler, prefetch,
+                              concurrency, partition, throttle=None):
+        """Consumes up to prefetch messages with concurrency green threads.
+
+        Messages are hashed by partition(body) onto the green threads, so
+        messages of one partition are still handled in order. Each message
+        is acked or nacked as soon as its handler completes. throttle is
+        called on the consuming green thread before each message is handed
+        out. Handlers and throttle may publish, through mq_client.
+        """
+        partitions = [eventlet.Queue() for i in range(concurrency)]
+        done = eventlet.Queue()
+        pool = eventlet.GreenPool(concurrency)
+
+        def worker(tasks):
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                delivery_tag, body = task
+                try:
+                    handler(body)
+                except Exception:
+                    traceback.print_exc(file=sys.stderr)
+                    done.put((delivery_tag, False))
+                else:
+                    done.put((delivery_tag, True))
+
+        def settle(block=False):
+            # acks go out on the consuming green thread only
+            settled = 0
+            while block or not done.empty():
+                delivery_tag, handled = done.get()
+                if handled:
+                    channel.basic_ack(delivery_tag)
+                else:
+                    channel.basic_nack(delivery_tag, requeue=True)
+                    metrics.registry.inc('swearch_nacks_total')
+                settled += 1
+                block = False
+            return settled
+
+        for tasks in partitions:
+            pool.spawn_n(worker, tasks)
+
+        fetched = pending = 0
+        try:
+            messages = channel.consume(queue_name, inactivity_timeout=1)
+            for method_frame, properties, body in messages:
+                pending -= settle()
+                if fetched >= prefetch:
+                    break
+                if method_frame is None:
+                    continue
+
+                if throttle:
+                    throttle()
+                try:
+                    key = partition(body)
+                except Exception:
+                    key = 0
+                partitions[hash(key) % concurrency].put(
+                    (method_frame.delivery_tag, body))
+                fetched += 1
+                pending += 1
+
+            while pending:
+                pending -= settle(block=True)
+            channel.cancel()
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            for tasks in partitions:
+                tasks.put(None)
+            pool.waitall()
+            if channel.is_open:
+                channel.close()
+
+    @contextmanager
+    def mq_client(self, reconnect=False):
+        """Holds the publishing connection and channel, (re)connecting as
+        get_mq_client does, for the calling green thread."""
+        with self._conn_lock:
+            yield self.get_mq_client(reconnect=reconnect)
+
     def get_mq_client(self, reconnect=False):
+        """Use mq_client instead where other green threads may be
+        publishing."""
         if reconnect:
             self.connection = None
             self.channel = None
@@ -280,7 +746,9 @@ class RabbitMQElasticIndexer(object):
             try:
                 self.connection = pika.BlockingConnection(params)
                 self.channel = self.connection.channel()
-                if self.require_confirmations:
+                if self.require_confirmations and self.confirm_window > 0:
+                    self._select_confirms()
+                elif self.require_confirmations:
                     self.channel.confirm_delivery()
                 return self.connection, self.channel
             except pika.exceptions.AMQPError as amqp:
@@ -292,8 +760,30 @@ class RabbitMQElasticIndexer(object):
                 self.logger.critical(
                     'Failed to connect to rabbit. Reason: %s' % err)
 
+    def get_consumer_connection(self):
+        """Connection consumers open their channels on, only ever used by
+        the consuming green thread."""
+        if self.consumer_connection and self.consumer_connection.is_open:
+            return self.consumer_connection
+
+        self.consumer_connection = None
+        random.shuffle(self.rabbitmq_conn_params)
+        for params in self.rabbitmq_conn_params:
+            try:
+                self.consumer_connection = pika.BlockingConnection(params)
+                return self.consumer_connection
+            except Exception as err:
+                self.logger.error(
+                    'Can not connect to rabbit(%r). Reason: %r'
+                    % (params, err))
+        raise pika.exceptions.AMQPConnectionError(
+            'No rabbit server to consume from')
+
     def close_mq_client(self):
         if self.connection and self.channel:
             self.connection.close()
             self.channel = self.connection = None
+        if self.consumer_connection and self.consumer_connection.is_open:
+            self.consumer_connection.close()
+        self.consumer_connection = None
         self.heartbeat.cancel()
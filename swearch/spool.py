@@ -0,0 +1,210 @@
+import collections
+import errno
+import fcntl
+import itertools
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+
+import eventlet
+
+# length and crc32 of the record that follows
+RECORD_HEADER = struct.Struct('>II')
+SEGMENT_SUFFIX = '.seg'
+
+
+class SpoolFull(Exception):
+    pass
+
+
+class SpoolLocked(Exception):
+    pass
+
+
+class Spool(object):
+    """
+    Append-only journal of the messages waiting to be published, split
+    into numbered segment files.
+
+    Records are appended to the newest segment and read back in order. A
+    segment is deleted once it is no longer written to, has been read to
+    its end and every record read from it was acked. Segments left in the
+    directory by an earlier process are read first, so their messages are
+    replayed; messages that were sent but not acked before a crash are
+    sent again.
+
+    Appends are flushed to the OS, which covers process crashes. Records
+    only survive an OS crash or power loss once sync has run.
+
+    The directory is locked for as long as the spool is open.
+
+    :param path: Spool directory.
+    :param max_bytes: Appends fail with SpoolFull beyond this size.
+    :param segment_bytes: Size after which appends go to a new segment.
+    """
+
+    def __init__(self, path, max_bytes=1 << 30, segment_bytes=16 << 20,
+                 logger=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.logger = logger or logging.getLogger(__name__)
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.lock_file = open(os.path.join(path, 'lock'), 'a')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as err:
+            self.lock_file.close()
+            if err.errno in (errno.EAGAIN, errno.EACCES):
+                raise SpoolLocked(path)
+            raise
+
+        self.sizes = {}
+        for name in os.listdir(path):
+            if name.endswith(SEGMENT_SUFFIX):
+                segment = int(name[:-len(SEGMENT_SUFFIX)])
+                self.sizes[segment] = os.path.getsize(
+                    self.segment_path(segment))
+        self.outstanding = collections.defaultdict(int)
+        self.notify = eventlet.queue.LightQueue(1)
+        self.dirty = False
+
+        self.writer = None
+        self.write_segment = max(self.sizes or [-1]) + 1
+        self._open_writer()
+
+        self.reader = None
+        self.read_segment = min(self.sizes)
+        self.read_offset = 0
+
+    @property
+    def total_bytes(self):
+        return sum(self.sizes.itervalues())
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, '%012d%s' % (segment, SEGMENT_SUFFIX))
+
+    def _open_writer(self):
+        if self.writer:
+            self.sync()
+            self.writer.close()
+        self.writer = open(self.segment_path(self.write_segment), 'ab')
+        self.sizes[self.write_segment] = 0
+
+    def append(self, record):
+        """Journals a JSON serializable record."""
+        data = json.dumps(record)
+        size = RECORD_HEADER.size + len(data)
+        if self.total_bytes + size > self.max_bytes:
+            raise SpoolFull(self.path)
+        if self.sizes[self.write_segment] >= self.segment_bytes:
+            self.write_segment += 1
+            self._open_writer()
+
+        self.writer.write(
+            RECORD_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff) +
+            data)
+        # the record survives the process from here on
+        self.writer.flush()
+        self.dirty = True
+        self.sizes[self.write_segment] += size
+        try:
+            self.notify.put_nowait(None)
+        except eventlet.queue.Full:
+            pass
+
+    def sync(self):
+        """Forces the records appended since the last sync to disk."""
+        if self.dirty:
+            os.fsync(self.writer.fileno())
+            self.dirty = False
+
+    def read(self, limit, timeout=None):
+        """Returns up to limit (segment, record) pairs, waiting at most
+        timeout seconds for the first one. Each must be acked by segment
+        once it's been dealt with."""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            records = self._read(limit)
+            if records:
+                return records
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    return records
+            try:
+                self.notify.get(True, wait)
+            except eventlet.queue.Empty:
+                pass
+
+    def _read(self, limit):
+        records = []
+        while len(records) < limit:
+            if self.reader is None:
+                self.reader = open(self.segment_path(self.read_segment), 'rb')
+                self.reader.seek(self.read_offset)
+
+            header = self.reader.read(RECORD_HEADER.size)
+            data = None
+            if len(header) == RECORD_HEADER.size:
+                length, crc = RECORD_HEADER.unpack(header)
+                data = self.reader.read(length)
+                if len(data) < length or \
+                        zlib.crc32(data) & 0xffffffff != crc:
+                    if self.read_segment == self.write_segment:
+                        # can't happen to records this process wrote
+                        raise IOError('Corrupt spool segment %s' %
+                                      self.segment_path(self.read_segment))
+                    self.logger.error(
+                        'Skipping torn record at the end of %s' %
+                        self.segment_path(self.read_segment))
+                    data = None
+
+            if data is None:
+                if self.read_segment == self.write_segment:
+                    self.reader.seek(self.read_offset)
+                    break
+                self._next_segment()
+                continue
+
+            self.read_offset += RECORD_HEADER.size + length
+            self.outstanding[self.read_segment] += 1
+            records.append((self.read_segment, json.loads(data)))
+        return records
+
+    def _next_segment(self):
+        self.reader.close()
+        self.reader = None
+        done = self.read_segment
+        self.read_segment = min(s for s in self.sizes if s > done)
+        self.read_offset = 0
+        self._remove(done)
+
+    def ack(self, segment):
+        self.outstanding[segment] -= 1
+        self._remove(segment)
+
+    def _remove(self, segment):
+        if segment >= self.read_segment or self.outstanding[segment] > 0:
+            return
+        self.outstanding.pop(segment, None)
+        del self.sizes[segment]
+        os.unlink(self.segment_path(segment))
+
+
+def open_spool(path, *args, **kwargs):
+    """Opens the first unlocked spool under path, so every process of a
+    host gets its own and takes over those of processes gone before."""
+    for i in itertools.count():
+        try:
+            return Spool(os.path.join(path, str(i)), *args, **kwargs)
+        except SpoolLocked:
+            continue
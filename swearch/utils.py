@@ -1,3 +1,5 @@
+import collections
+import time
 import urllib
 
 from swift.common import swob
@@ -10,6 +12,13 @@ def unicode_encode(s):
         return s
 
 
+def unicode_decode(s):
+    """Decodes header strings, which newer swiftclients already decode."""
+    if isinstance(s, unicode):
+        return s
+    return unicode(s, errors='replace')
+
+
 def unicode_quote(s):
     """Properly URL-quotes unicode strings."""
     if isinstance(s, unicode):
@@ -24,6 +33,36 @@ def unicode_unquote(s):
         return urllib.unquote(s)
 
 
+def search_generation_key(account):
+    """Memcache key holding the time of the account's last indexed write."""
+    return 'swearch/generation/%s' % account
+
+
+class LRUCache(object):
+    """Small in-process LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        try:
+            expires, value = self.entries.pop(key)
+        except KeyError:
+            return None
+        if expires < time.time():
+            return None
+        self.entries[key] = (expires, value)
+        return value
+
+    def set(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + self.ttl, value)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
 def make_request(env, method, path, body=None, headers=None, agent='Swift'):
     newenv = {'REQUEST_METHOD': method,
               'HTTP_USER_AGENT': 'Swift-Search'}
@@ -0,0 +1,298 @@
+"""
+In-memory stand-ins for the services the indexing pipeline talks to.
+"""
+import collections
+import hashlib
+import json
+
+from swift.common import swob
+from swift.common.utils import split_path
+
+from swearch import daemon
+
+
+class FakeBroker(object):
+    """Exchanges, bindings and queues of a RabbitMQ server."""
+
+    def __init__(self):
+        self.queues = collections.defaultdict(collections.deque)
+        self.bindings = collections.defaultdict(list)
+        self.published = 0
+
+    def publish(self, exchange, routing_key, body):
+        for queue in self.bindings[(exchange, routing_key)]:
+            self.queues[queue].append(body)
+        self.published += 1
+
+
+class FakeMethod(object):
+    def __init__(self, delivery_tag=None, message_count=None):
+        self.delivery_tag = delivery_tag
+        self.message_count = message_count
+
+
+class FakeFrame(object):
+    def __init__(self, method):
+        self.method = method
+
+
+class FakeChannel(object):
+    """The parts of a pika BlockingChannel the indexer uses."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self.delivery_tag = 0
+        self.unacked = {}
+        self.consuming = None
+
+    def queue_declare(self, queue, passive=False, **kwargs):
+        if passive and queue not in self.broker.queues:
+            return None
+        return FakeFrame(FakeMethod(
+            message_count=len(self.broker.queues[queue])))
+
+    def exchange_declare(self, exchange, **kwargs):
+        pass
+
+    def queue_bind(self, queue, exchange, routing_key):
+        bindings = self.broker.bindings[(exchange, routing_key)]
+        if queue not in bindings:
+            bindings.append(queue)
+
+    def basic_qos(self, prefetch_count=0):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, **kwargs):
+        self.broker.publish(exchange, routing_key, body)
+        return True
+
+    def consume(self, queue, inactivity_timeout=None):
+        self.consuming = queue
+        messages = self.broker.queues[queue]
+        while messages and self.consuming:
+            body = messages.popleft()
+            self.delivery_tag += 1
+            self.unacked[self.delivery_tag] = (queue, body)
+            yield FakeMethod(delivery_tag=self.delivery_tag), None, body
+
+    def basic_ack(self, delivery_tag):
+        del self.unacked[delivery_tag]
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        queue, body = self.unacked.pop(delivery_tag)
+        if requeue:
+            self.broker.queues[queue].append(body)
+
+    def cancel(self):
+        self.consuming = None
+
+    def close(self):
+        # like rabbit, unacked deliveries go back on their queue
+        for delivery_tag in sorted(self.unacked, reverse=True):
+            queue, body = self.unacked.pop(delivery_tag)
+            self.broker.queues[queue].appendleft(body)
+        self.is_open = False
+
+
+class FakeConnection(object):
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+
+    def channel(self):
+        return FakeChannel(self.broker)
+
+    def process_data_events(self, time_limit=0):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+def connect(indexer, broker):
+    """Points a RabbitMQElasticIndexer at the fake broker."""
+    indexer.connection = FakeConnection(broker)
+    indexer.channel = indexer.connection.channel()
+    indexer.consumer_connection = FakeConnection(broker)
+    indexer.setup_river()
+    indexer.setup_backfill()
+
+
+class FakeMeta(dict):
+    def __init__(self, _id, found):
+        super(FakeMeta, self).__init__(found=found)
+        self.id = _id
+
+
+class FakeDoc(dict):
+    """A document as pyes mget returns it."""
+
+    def __init__(self, _id, source):
+        super(FakeDoc, self).__init__(source or {})
+        self.meta = FakeMeta(_id, source is not None)
+
+    def get_meta(self):
+        return self.meta
+
+
+class FakeElasticsearch(object):
+    """Applies the bulk actions the river would send to _bulk."""
+
+    def __init__(self):
+        self.docs = {}
+        self.actions = 0
+
+    def bulk(self, body):
+        lines = iter(body.splitlines())
+        for line in lines:
+            action = json.loads(line)
+            if 'index' in action:
+                self.docs[action['index']['_id']] = json.loads(next(lines))
+            elif 'update' in action:
+                _id = action['update']['_id']
+                update = json.loads(next(lines))
+                if _id in self.docs:
+                    # update_script, as it ships
+                    self.docs[_id].update(update['params']['fields'])
+            elif 'delete' in action:
+                self.docs.pop(action['delete']['_id'], None)
+            self.actions += 1
+
+    def mget(self, ids, **kwargs):
+        return [FakeDoc(_id, self.docs.get(_id)) for _id in ids]
+
+    def drain_river(self, broker, queue):
+        messages = broker.queues[queue]
+        while messages:
+            self.bulk(messages.popleft())
+
+
+class FakeSwift(object):
+    """WSGI proxy keeping objects, their metadata and listings in memory."""
+
+    def __init__(self):
+        self.containers = collections.defaultdict(dict)
+
+    def __call__(self, env, start_response):
+        req = swob.Request(env)
+        version, account, container, obj = split_path(req.path, 1, 4, True)
+        objects = self.containers[(account, container)]
+
+        if obj and req.method == 'PUT':
+            headers = dict((k, v) for k, v in req.headers.iteritems()
+                           if k.lower().startswith('x-object-meta-'))
+            headers['Etag'] = hashlib.md5(req.body).hexdigest()
+            headers['Content-Type'] = req.headers.get(
+                'content-type', 'application/octet-stream')
+            headers['Content-Length'] = len(req.body)
+            objects[obj] = headers
+            resp = swob.Response(status=201, headers={
+                'Etag': headers['Etag']})
+        elif obj and req.method == 'POST':
+            if obj not in objects:
+                resp = swob.HTTPNotFound()
+            else:
+                objects[obj].update(
+                    (k, v) for k, v in req.headers.iteritems()
+                    if k.lower().startswith('x-object-meta-'))
+                resp = swob.Response(status=202)
+        elif obj and req.method == 'DELETE':
+            resp = swob.Response(status=204 if objects.pop(obj, None)
+                                 else 404)
+        elif obj and req.method in ('HEAD', 'GET'):
+            if obj not in objects:
+                resp = swob.HTTPNotFound()
+            else:
+                resp = swob.Response(status=200, headers=objects[obj])
+        elif container and req.method in ('HEAD', 'GET'):
+            resp = self.listing(req, objects)
+        else:
+            resp = swob.Response(status=204)
+        return resp(env, start_response)
+
+    def listing(self, req, objects):
+        marker = req.params.get('marker', '')
+        limit = int(req.params.get('limit', 10000))
+        names = sorted(name for name in objects if name > marker)[:limit]
+        listing = [{
+            'name': name,
+            'hash': objects[name]['Etag'],
+            'bytes': objects[name]['Content-Length'],
+            'content_type': objects[name]['Content-Type'],
+            'last_modified': '2015-01-01T00:00:00.000000',
+        } for name in names]
+        headers = {
+            'Content-Type': 'application/json; charset=utf-8',
+            'X-Container-Object-Count': len(objects),
+            'X-Container-Bytes-Used': sum(
+                o['Content-Length'] for o in objects.itervalues()),
+            'X-Timestamp': '1420070400.00000',
+            'X-Put-Timestamp': '1420070400.00000',
+        }
+        body = json.dumps(listing) if req.method == 'GET' else ''
+        return swob.Response(status=200 if listing else 204, body=body,
+                             headers=headers)
+
+
+class FakeSwiftResponse(object):
+    def __init__(self, resp):
+        self.status = resp.status_int
+        self.reason = resp.status.split(' ', 1)[1]
+        self.headers = dict((k.lower(), v) for k, v in resp.headers.items())
+        self.body = resp.body
+
+    def read(self, *args):
+        body, self.body = self.body, ''
+        return body
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def getheaders(self):
+        return self.headers.items()
+
+
+class FakeSwiftConnection(object):
+    """Stands in for a swiftclient HTTPConnection to the proxy."""
+
+    def __init__(self, app):
+        self.app = app
+        self.resp = None
+
+    def request(self, method, full_path, data=None, headers=None, files=None):
+        path, _, query_string = full_path.partition('?')
+        req = swob.Request.blank(
+            path, environ={'REQUEST_METHOD': method,
+                           'QUERY_STRING': query_string},
+            headers=headers or {}, body=data or '')
+        self.resp = req.get_response(self.app)
+
+    def getresponse(self):
+        return FakeSwiftResponse(self.resp)
+
+    def close(self):
+        pass
+
+
+class FakeSwiftConnectionPool(daemon.SwiftConnectionPool):
+    def __init__(self, app, **kwargs):
+        self.app = app
+        super(FakeSwiftConnectionPool, self).__init__(daemon.PROXY_URL,
+                                                      **kwargs)
+
+    def create(self):
+        return FakeSwiftConnection(self.app)
+
+
+class FakeIndexWorker(daemon.IndexWorker):
+    """IndexWorker talking to the fake proxy and broker."""
+
+    def __init__(self, conf, app, broker, **kwargs):
+        self.app = app
+        super(FakeIndexWorker, self).__init__(conf, **kwargs)
+        self.conn_pool = FakeSwiftConnectionPool(app)
+        connect(self.indexer, broker)
+
+    def get_auth_token(self, key):
+        return 'AUTH_tk_bench'
@@ -0,0 +1,208 @@
+"""
+End to end benchmark of the indexing pipeline against in-memory fakes.
+
+Drives proxy writes through IndexMiddleware, publishes them to a fake
+broker and river, then backfills the same objects with IndexWorker.
+
+    python -m tests.benchmark.pipeline [--requests N] [--objects N]
+"""
+import json
+import optparse
+import resource
+import tempfile
+import time
+
+import mock
+from swift.common import swob
+
+from swearch import daemon
+from swearch.middleware import indexer as indexer_middleware
+from tests.benchmark import fakes
+
+ACCOUNT = 'AUTH_bench'
+CONTAINER = 'bench'
+
+CONFIG = """
+[index]
+search_index_name = os_default
+coalesce_window = %(coalesce_window)s
+
+[queue]
+rabbitmq_batch_size = %(batch_size)s
+"""
+
+
+def max_rss():
+    """Peak resident memory in KiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def timed_requests(app, count, prefix):
+    latencies = []
+    for i in range(count):
+        req = swob.Request.blank(
+            '/v1/%s/%s/%s%08d' % (ACCOUNT, CONTAINER, prefix, i),
+            environ={'REQUEST_METHOD': 'PUT'},
+            headers={'Content-Type': 'text/plain',
+                     'X-Object-Meta-Bench': str(i)},
+            body='x' * 64)
+        start = time.time()
+        req.get_response(app)
+        latencies.append(time.time() - start)
+    return latencies
+
+
+class Report(object):
+    def __init__(self):
+        self.rows = []
+
+    def add(self, phase, ops, seconds, rss_before, **extra):
+        row = {
+            'phase': phase,
+            'ops': ops,
+            'seconds': round(seconds, 4),
+            'ops_per_sec': round(ops / seconds, 1) if seconds else None,
+            'rss_growth_kib': max_rss() - rss_before,
+        }
+        row.update(extra)
+        self.rows.append(row)
+
+    def show(self, as_json=False):
+        if as_json:
+            print json.dumps(self.rows, indent=2)
+            return
+        for row in self.rows:
+            print '%-22s %8d ops %10s ops/s  +%d KiB rss' % (
+                row['phase'], row['ops'], row['ops_per_sec'],
+                row['rss_growth_kib'])
+            for name in sorted(row):
+                if name not in ('phase', 'ops', 'seconds', 'ops_per_sec',
+                                'rss_growth_kib'):
+                    print '    %s: %s' % (name, row[name])
+
+
+def bench_middleware(report, options, swift, broker, es):
+    conf_file = tempfile.NamedTemporaryFile(suffix='.conf')
+    conf_file.write(CONFIG % vars(options))
+    conf_file.flush()
+    middleware = indexer_middleware.IndexMiddleware(
+        swift, {'config_file': conf_file.name})
+    fakes.connect(middleware.indexer, broker)
+    conf_file.close()
+
+    rss = max_rss()
+    start = time.time()
+    bare = timed_requests(swift, options.requests, 'bare')
+    report.add('proxy without indexer', options.requests,
+               time.time() - start, rss,
+               p50_ms=round(percentile(bare, 50) * 1000, 3),
+               p99_ms=round(percentile(bare, 99) * 1000, 3))
+
+    rss = max_rss()
+    start = time.time()
+    indexed = timed_requests(middleware, options.requests, 'obj')
+    report.add('proxy with indexer', options.requests,
+               time.time() - start, rss,
+               p50_ms=round(percentile(indexed, 50) * 1000, 3),
+               p99_ms=round(percentile(indexed, 99) * 1000, 3),
+               added_p50_ms=round((percentile(indexed, 50) -
+                                   percentile(bare, 50)) * 1000, 3),
+               added_p99_ms=round((percentile(indexed, 99) -
+                                   percentile(bare, 99)) * 1000, 3),
+               queued=middleware.indexer.publish_queue.qsize(),
+               queued_bytes=middleware.indexer.publish_queue.bytes)
+
+    rss = max_rss()
+    start = time.time()
+    if middleware.coalescer:
+        middleware.coalescer.flush(force=True)
+        middleware.coalescer.pool.waitall()
+    middleware.indexer.publish_queue.join()
+    report.add('publish to river', options.requests, time.time() - start,
+               rss, messages=broker.published)
+
+    rss = max_rss()
+    start = time.time()
+    es.drain_river(broker, middleware.indexer.rabbitmq_queue)
+    report.add('river bulk to es', es.actions, time.time() - start, rss,
+               docs=len(es.docs))
+
+
+def bench_worker(report, options, swift, broker, es):
+    conf = {
+        'index': {'search_index_name': 'os_default'},
+        'queue': {'rabbitmq_batch_size': str(options.batch_size),
+                  'container_listing_count': str(options.listing_count)},
+    }
+    worker = fakes.FakeIndexWorker(conf, swift, broker, queue='object')
+    for i in range(options.objects):
+        worker.indexer.publish_backfill_task(
+            'object', ACCOUNT, CONTAINER, 'obj%08d' % i)
+
+    rss = max_rss()
+    start = time.time()
+    worker.indexer.start_consumer('object', worker.handle_messages,
+                                  prefetch=options.objects)
+    worker.indexer.publish_queue.join()
+    report.add('backfill by HEAD', options.objects, time.time() - start,
+               rss)
+
+    worker = fakes.FakeIndexWorker(conf, swift, broker, queue='container')
+    worker.indexer.publish_backfill_task('container', ACCOUNT, CONTAINER)
+
+    rss = max_rss()
+    start = time.time()
+    handled = 0
+    queue = worker.indexer.backfill_queue_name('container')
+    # listings only index the objects missing from elastic search
+    with mock.patch.object(daemon, 'get_search_client', return_value=es):
+        while broker.queues[queue]:
+            worker.indexer.start_consumer('container',
+                                          worker.handle_messages, prefetch=1)
+            handled += 1
+    worker.indexer.publish_queue.join()
+    report.add('backfill by listing', len(swift.containers[
+        (ACCOUNT, CONTAINER)]), time.time() - start, rss,
+        listing_pages=handled)
+
+    rss = max_rss()
+    start = time.time()
+    actions = es.actions
+    es.drain_river(broker, worker.indexer.rabbitmq_queue)
+    report.add('river bulk to es', es.actions - actions,
+               time.time() - start, rss, docs=len(es.docs))
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-r', '--requests', type='int', default=5000,
+                      help='object PUTs through the proxy')
+    parser.add_option('-o', '--objects', type='int', default=2000,
+                      help='objects backfilled through HEADs')
+    parser.add_option('-b', '--batch-size', type='int', default=100,
+                      help='rabbitmq_batch_size')
+    parser.add_option('-l', '--listing-count', type='int', default=1000,
+                      help='container_listing_count')
+    parser.add_option('-w', '--coalesce-window', type='float', default=0,
+                      help='coalesce_window')
+    parser.add_option('--json', action='store_true',
+                      help='print the report as JSON')
+    options, args = parser.parse_args()
+
+    swift = fakes.FakeSwift()
+    broker = fakes.FakeBroker()
+    es = fakes.FakeElasticsearch()
+    report = Report()
+
+    bench_middleware(report, options, swift, broker, es)
+    bench_worker(report, options, swift, broker, es)
+    report.show(options.json)
+
+
+if __name__ == '__main__':
+    main()
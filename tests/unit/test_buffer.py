@@ -0,0 +1,79 @@
+import unittest
+
+import eventlet
+
+from swearch import buffer
+
+
+def message(body, key=None):
+    return buffer.Message('a', 'r', body, key)
+
+
+class PublishBufferTest(unittest.TestCase):
+
+    def test_bounded_by_bytes(self):
+        buf = buffer.PublishBuffer(10)
+        buf.put(message('x' * 6), False)
+        self.assertRaises(eventlet.queue.Full, buf.put, message('y' * 6),
+                          False)
+        buf.put(message('y' * 4), False)
+        self.assertEqual(buf.bytes, 10)
+        self.assertEqual(buf.get().body, 'x' * 6)
+        self.assertEqual(buf.bytes, 4)
+
+    def test_bounded_by_count(self):
+        buf = buffer.PublishBuffer(100, maxsize=1)
+        buf.put(message('x'), False)
+        self.assertRaises(eventlet.queue.Full, buf.put, message('y'), False)
+
+    def test_oversized_message_fits_empty_buffer(self):
+        buf = buffer.PublishBuffer(1)
+        buf.put(message('xx'), False)
+        self.assertEqual(buf.qsize(), 1)
+
+    def test_drop_oldest(self):
+        buf = buffer.PublishBuffer(4, overflow=buffer.DROP_OLDEST)
+        for body in ('aa', 'bb', 'cc'):
+            buf.put(message(body), False)
+        self.assertEqual(buf.dropped, 1)
+        self.assertEqual(buf.unfinished_tasks, 2)
+        self.assertEqual([buf.get().body, buf.get().body], ['bb', 'cc'])
+
+    def test_coalesce(self):
+        buf = buffer.PublishBuffer(4, overflow=buffer.COALESCE)
+        buf.put(message('a1', 'a'), False)
+        buf.put(message('b1', 'b'), False)
+        buf.put(message('a2', 'a'), False)
+        self.assertRaises(eventlet.queue.Full, buf.put,
+                          message('c1', 'c'), False)
+        self.assertEqual(buf.coalesced, 1)
+        self.assertEqual(buf.unfinished_tasks, 2)
+        self.assertEqual(buf.qsize(), 2)
+        self.assertEqual([buf.get().body, buf.get().body], ['b1', 'a2'])
+
+        # sent messages aren't replaced
+        buf.put(message('a3', 'a'), False)
+        self.assertEqual(buf.get().body, 'a3')
+
+    def test_coalesce_compacts_tombstones(self):
+        buf = buffer.PublishBuffer(100, overflow=buffer.COALESCE)
+        buf.put(message('b', 'b'), False)
+        for i in range(1000):
+            buf.put(message(str(i), 'a'), False)
+            self.assertTrue(len(buf.queue) <= buffer.MAX_TOMBSTONES + 2)
+        self.assertEqual(buf.coalesced, 999)
+        self.assertEqual(buf.qsize(), 2)
+        self.assertEqual([buf.get().body, buf.get().body], ['b', '999'])
+
+    def test_blocking_put_waits_for_room(self):
+        buf = buffer.PublishBuffer(2)
+        buf.put(message('xx'))
+        eventlet.spawn_after(0.01, buf.get)
+        buf.put(message('yy'), timeout=1)
+        self.assertRaises(eventlet.queue.Full, buf.put, message('zz'),
+                          timeout=0.01)
+        self.assertEqual(buf.get().body, 'yy')
+
+    def test_unknown_overflow(self):
+        self.assertRaises(ValueError, buffer.PublishBuffer, 1,
+                          overflow='bogus')
@@ -1,6 +1,8 @@
 import mock
 import unittest
 import os
+import tempfile
+import time
 
 from swearch import utils
 from swift.common import swob
@@ -127,3 +129,392 @@ class IndexWorkerTest(unittest.TestCase):
            
 		
 	
+
+
+class WorkerSupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conf_file = tempfile.NamedTemporaryFile(suffix='.conf')
+        self.write_conf(object_workers=2, container_workers=1,
+                        account_workers=0)
+        self.supervisor = daemon.WorkerSupervisor(self.conf_file.name)
+        self.pids = iter(range(100, 200))
+        self.spawn = mock.patch.object(
+            self.supervisor, 'spawn', side_effect=self.fake_spawn).start()
+        self.kill = mock.patch.object(self.supervisor, 'kill').start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        self.conf_file.close()
+
+    def write_conf(self, **workers):
+        self.conf_file.seek(0)
+        self.conf_file.truncate()
+        self.conf_file.write('[index]\n[queue]\n')
+        for option, value in workers.items():
+            self.conf_file.write('%s = %s\n' % (option, value))
+        self.conf_file.flush()
+
+    def fake_spawn(self, queue):
+        pid = next(self.pids)
+        self.supervisor.children[queue].append(pid)
+        self.supervisor.started[pid] = 0
+
+    def test_manage_spawns_configured_workers(self):
+        self.supervisor.manage()
+        self.assertEqual(self.supervisor.children,
+                         {'object': [100, 101], 'container': [102],
+                          'account': []})
+
+    @mock.patch('os.waitpid')
+    def test_reap_respawns_crashed_worker(self, waitpid):
+        self.supervisor.manage()
+        waitpid.side_effect = [(101, 256), (0, 0)]
+        self.supervisor.reap()
+        self.assertEqual(self.supervisor.children['object'], [100])
+        self.supervisor.manage()
+        self.assertEqual(self.supervisor.children['object'], [100, 103])
+
+    @mock.patch('os.waitpid')
+    def test_reap_delays_respawn_of_failing_worker(self, waitpid):
+        self.supervisor.manage()
+        self.supervisor.started[101] = time.time()
+        waitpid.side_effect = [(101, 256), (0, 0)]
+        self.supervisor.reap()
+        self.supervisor.manage()
+        self.assertEqual(self.supervisor.children['object'], [100])
+
+    def test_scale_up_and_down(self):
+        self.supervisor.manage()
+        self.supervisor.scale_up()
+        self.supervisor.manage()
+        self.assertEqual(len(self.supervisor.children['object']), 3)
+        self.assertEqual(len(self.supervisor.children['container']), 2)
+        self.assertEqual(self.supervisor.children['account'], [])
+
+        self.supervisor.scale_down()
+        self.supervisor.scale_down()
+        self.supervisor.manage()
+        self.assertEqual(len(self.supervisor.children['object']), 1)
+        self.assertEqual(len(self.supervisor.children['container']), 1)
+        self.assertEqual(self.kill.call_count, 3)
+
+    def test_reload_rereads_worker_counts(self):
+        self.supervisor.manage()
+        self.write_conf(object_workers=1, container_workers=1,
+                        account_workers=1)
+        self.supervisor.reload()
+        self.supervisor.manage()
+        self.assertEqual(self.supervisor.children,
+                         {'object': [100], 'container': [102],
+                          'account': [103]})
+        self.kill.assert_called_once_with(101)
+
+
+class GreenWorkerProcessTest(unittest.TestCase):
+
+    @mock.patch.object(daemon.eventlet, 'monkey_patch')
+    def test_only_concurrent_workers_are_patched(self, monkey_patch):
+        conf = {'queue': {'object_concurrency': '8'}}
+        daemon.green_worker_process(conf, 'container')
+        self.assertEqual(monkey_patch.call_count, 0)
+        daemon.green_worker_process(conf, 'object')
+        self.assertEqual(monkey_patch.call_count, 1)
+
+    @mock.patch('os._exit')
+    @mock.patch('os.fork', return_value=0)
+    def test_spawned_worker_is_patched_before_it_is_built(self, fork, _exit):
+        supervisor = daemon.WorkerSupervisor('/dev/null')
+        calls = mock.Mock()
+        with mock.patch.object(daemon, 'green_worker_process',
+                               calls.green_worker_process), \
+                mock.patch.object(daemon, 'IndexWorker', calls.IndexWorker):
+            supervisor.spawn('object')
+        self.assertEqual([name for name, args, kwargs in calls.mock_calls],
+                         ['green_worker_process', 'IndexWorker',
+                          'IndexWorker().run_forever'])
+        _exit.assert_called_once_with(0)
+
+
+class SwiftConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.create = mock.patch.object(
+            daemon.client, 'HTTPConnection',
+            side_effect=lambda *args, **kwargs: mock.Mock()).start()
+        self.pool = daemon.SwiftConnectionPool('http://127.0.0.1',
+                                               idle_timeout=60)
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def test_connection_is_reused(self):
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as second:
+            pass
+        self.assertTrue(first is second)
+        self.assertEqual(self.create.call_count, 1)
+
+    def test_http_errors_keep_connection(self):
+        with self.pool.connection() as first:
+            pass
+        with self.assertRaises(daemon.ClientException):
+            with self.pool.connection():
+                raise daemon.ClientException('Object HEAD failed',
+                                             http_status=404)
+        with self.pool.connection() as second:
+            pass
+        self.assertTrue(first is second)
+
+    def test_failed_connection_is_replaced(self):
+        with self.pool.connection() as first:
+            pass
+        with self.assertRaises(IOError):
+            with self.pool.connection():
+                raise IOError('connection reset')
+        with self.pool.connection() as second:
+            pass
+        self.assertFalse(first is second)
+        first.close.assert_called_once_with()
+
+    def test_idle_connection_is_replaced(self):
+        with self.pool.connection() as first:
+            pass
+        self.pool.last_used[first] -= 61
+        with self.pool.connection() as second:
+            pass
+        self.assertFalse(first is second)
+        first.close.assert_called_once_with()
+
+
+class ContainerWorkerTest(unittest.TestCase):
+
+    @mock.patch.object(daemon, 'get_fingerprint_store')
+    @mock.patch.object(daemon.IndexWorker, 'get_auth_token')
+    @mock.patch.object(daemon, 'RabbitMQElasticIndexer')
+    def test_container_worker_gets_fingerprint_store(
+            self, indexer, get_auth_token, get_fingerprint_store):
+        worker = daemon.IndexWorker({'index': {
+            'fingerprint_store': 'sqlite'}}, queue='container')
+        self.assertEqual(worker.queue_type, 'container')
+        self.assertTrue(
+            worker.fingerprints is get_fingerprint_store.return_value)
+
+        worker = daemon.IndexWorker({}, queue='object')
+        self.assertEqual(worker.fingerprints, None)
+
+
+class ListingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.indexer = mock.patch.object(
+            daemon, 'RabbitMQElasticIndexer').start().return_value
+        mock.patch.object(daemon.IndexWorker, 'get_auth_token').start()
+        mock.patch.object(daemon.client, 'HTTPConnection').start()
+        self.client = mock.patch.object(
+            daemon, 'get_search_client').start().return_value
+        self.head_object = mock.patch.object(
+            daemon, 'head_object', side_effect=self.fake_head).start()
+        self.get_container = mock.patch.object(
+            daemon, 'get_container').start()
+        self.fingerprints = mock.patch.object(
+            daemon, 'get_fingerprint_store').start().return_value
+        self.fingerprints.get.return_value = None
+        self.client.indices.aliases.return_value = {'os_v1': {}}
+        self.worker = daemon.IndexWorker(
+            {'queue': {'container_listing_count': '2'}}, queue='container')
+        self.objects = {}
+        self.headers = {'x-container-object-count': '3',
+                        'x-container-bytes-used': '30',
+                        'x-put-timestamp': '1420070400.00000'}
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def fake_head(self, url, token, container, obj, http_conn=None):
+        if obj not in self.objects:
+            raise daemon.ClientException('HEAD failed', http_status=404)
+        return self.objects[obj]
+
+    def indexed(self, *docs):
+        results = []
+        for _id, fields in docs:
+            doc = mock.Mock(get=fields.get)
+            doc.get_meta.return_value = mock.Mock(
+                id=_id, get=mock.Mock(return_value=True))
+            results.append(doc)
+        self.client.mget.return_value = results
+
+    def listing(self, *names):
+        return [{'name': name, 'hash': name, 'content_type': 'text/plain',
+                 'last_modified': '2015-01-01T00:00:00.000000'}
+                for name in names]
+
+    def test_verify_repairs_stale_objects_in_one_batch(self):
+        self.objects = {
+            'b': {'etag': 'b', 'content-type': 'text/plain',
+                  'x-timestamp': '1420070400.00000',
+                  'x-object-meta-color': 'red'},
+        }
+        self.indexed((index.get_index_id('a', 'c', 'a'),
+                      {'hash': 'a', 'content_type': 'text/plain'}),
+                     (index.get_index_id('a', 'c', 'b'),
+                      {'hash': 'old', 'content_type': 'text/plain'}))
+        self.worker.index_listing('a', 'c', self.listing('a', 'b', 'gone'),
+                                  verify=True)
+
+        self.assertEqual(self.client.mget.call_count, 1)
+        self.assertEqual(self.head_object.call_count, 2)
+        self.assertEqual(self.indexer.index_doc.call_count, 0)
+        self.indexer.index_docs.assert_called_once_with(
+            'os_default', mock.ANY, block=True, routing=None)
+        docs = self.indexer.index_docs.call_args[0][1]
+        self.assertEqual([(_id, props['meta'], version)
+                          for _id, props, version in docs],
+                         [(index.get_index_id('a', 'c', 'b'),
+                           {'color': 'red'}, 142007040000000)])
+
+    def test_listing_only_indexes_missing_objects(self):
+        self.indexed((index.get_index_id('a', 'c', 'a'),
+                      {'hash': 'changed', 'content_type': 'text/plain'}))
+        self.worker.index_listing('a', 'c', self.listing('a', 'b'))
+
+        self.assertEqual(self.head_object.call_count, 0)
+        self.indexer.index_docs.assert_called_once_with(
+            'os_default', mock.ANY, block=True, routing=None,
+            version_type='external')
+        docs = self.indexer.index_docs.call_args[0][1]
+        self.assertEqual([(_id, props['hash'], version)
+                          for _id, props, version in docs],
+                         [(index.get_index_id('a', 'c', 'b'), 'b',
+                           142007040000000)])
+
+    def test_head_errors_other_than_404_fail_the_page(self):
+        self.head_object.side_effect = daemon.ClientException(
+            'HEAD failed', http_status=401)
+        self.indexed()
+        self.assertRaises(daemon.ClientException, self.worker.index_listing,
+                          'a', 'c', self.listing('a'), verify=True)
+        self.assertEqual(self.indexer.index_docs.call_count, 0)
+
+    def test_full_pages_publish_the_next_page(self):
+        self.get_container.return_value = (self.headers,
+                                           self.listing('a', 'b'))
+        self.indexed()
+        self.worker.index_container('a', 'c')
+
+        fingerprint = daemon.container_fingerprint(self.headers)
+        self.indexer.publish_backfill_task.assert_called_once_with(
+            'container', 'a', 'c', marker='b', verify=False,
+            fingerprint=fingerprint)
+        self.assertEqual(self.indexer.index_doc.call_args[0][1],
+                         index.get_index_id('a', 'c'))
+        docs = self.indexer.index_docs.call_args[0][1]
+        self.assertEqual(len(docs), 2)
+        # the pass isn't done until the last page
+        self.assertEqual(self.fingerprints.set.call_count, 0)
+
+        self.get_container.return_value = (self.headers, self.listing('d'))
+        self.worker.index_container('a', 'c', marker='b',
+                                    fingerprint=fingerprint)
+        self.fingerprints.set.assert_called_once_with(
+            'os_v1', 'a', 'c', fingerprint)
+
+    def test_unchanged_container_is_skipped(self):
+        self.get_container.return_value = (self.headers, self.listing('a'))
+        self.fingerprints.get.return_value = daemon.container_fingerprint(
+            self.headers)
+        self.worker.index_container('a', 'c')
+        self.fingerprints.get.assert_called_once_with('os_v1', 'a', 'c')
+        self.assertEqual(self.indexer.index_doc.call_count, 0)
+        self.assertEqual(self.indexer.index_docs.call_count, 0)
+        self.assertEqual(self.client.mget.call_count, 0)
+
+        # verify backfills check unchanged containers too
+        self.indexed()
+        self.worker.index_container('a', 'c', verify=True)
+        # one mget for the container doc, one for the listing
+        self.assertEqual(self.client.mget.call_count, 2)
+
+
+class RateControllerTest(unittest.TestCase):
+
+    def get_controller(self, **kwargs):
+        kwargs.setdefault('target_depth', 100)
+        return daemon.RateController(mock.Mock(), interval=1, min_rate=1,
+                                     max_rate=100, increase=10,
+                                     decrease=0.5, **kwargs)
+
+    def test_increases_below_target(self):
+        controller = self.get_controller()
+        controller.rate = 50
+        self.assertEqual(controller.update(10, now=1), 60)
+        self.assertEqual(controller.update(10, now=2), 70)
+        controller.rate = 95
+        self.assertEqual(controller.update(10, now=3), 100)
+
+    def test_decreases_above_target(self):
+        controller = self.get_controller()
+        self.assertEqual(controller.update(500, now=1), 50)
+        self.assertEqual(controller.update(600, now=2), 25)
+        controller.rate = 1.5
+        self.assertEqual(controller.update(700, now=3), 1)
+
+    def test_holds_while_heading_to_target(self):
+        controller = self.get_controller()
+        controller.update(500, now=1)
+        # draining 300/s brings the queue below the target
+        self.assertEqual(controller.update(200, now=2), 50)
+        controller.update(60, now=3)
+        rate = controller.rate
+        # growing 60/s takes the queue over the target
+        self.assertEqual(controller.update(90, now=3.5), rate)
+
+    @mock.patch('time.sleep')
+    def test_wait_paces_messages(self, sleep):
+        controller = self.get_controller()
+        controller.measure.return_value = 10
+        controller.rate = 90
+        with mock.patch('time.time', return_value=10):
+            controller.wait()
+            self.assertEqual(controller.rate, 100)
+            self.assertFalse(sleep.called)
+            controller.wait()
+            controller.wait()
+        self.assertEqual(controller.measure.call_count, 1)
+        delays = [c[0][0] for c in sleep.call_args_list]
+        self.assertEqual(len(delays), 2)
+        self.assertAlmostEqual(delays[0], 0.01)
+        self.assertAlmostEqual(delays[1], 0.02)
+
+    @mock.patch('time.sleep')
+    @mock.patch.object(daemon.IndexWorker, 'get_auth_token')
+    @mock.patch.object(daemon, 'RabbitMQElasticIndexer')
+    def test_zero_rates_are_clamped(self, indexer, get_auth_token, sleep):
+        indexer.return_value.queue_size.return_value = 10 ** 6
+        worker = daemon.IndexWorker({'queue': {
+            'object_min_rate': '0', 'object_max_rate': '0'}})
+        self.assertEqual(worker.rate.min_rate, daemon.MIN_RATE)
+        self.assertEqual(worker.rate.max_rate, daemon.MIN_RATE)
+        with mock.patch('time.time', return_value=10):
+            worker.rate.wait()
+            worker.rate.wait()
+        self.assertEqual(worker.rate.rate, daemon.MIN_RATE)
+        self.assertAlmostEqual(sleep.call_args[0][0], 1 / daemon.MIN_RATE)
+
+
+class FingerprintIndexTest(unittest.TestCase):
+
+    @mock.patch.object(daemon, 'get_search_client')
+    @mock.patch.object(daemon.IndexWorker, 'get_auth_token')
+    @mock.patch.object(daemon, 'RabbitMQElasticIndexer')
+    def test_fingerprints_follow_the_alias(self, indexer, get_auth_token,
+                                           get_search_client):
+        aliases = get_search_client.return_value.indices.aliases
+        aliases.return_value = {'os_default-2': {}, 'os_default-1': {}}
+        worker = daemon.IndexWorker({'index': {
+            'search_index_name': 'os_default'}}, queue='container')
+        self.assertEqual(worker.fingerprint_index(),
+                         'os_default-1,os_default-2')
+        aliases.assert_called_once_with('os_default')
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from swearch import fingerprint
+
+
+class ContainerFingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.headers = {
+            'x-container-object-count': '10',
+            'x-container-bytes-used': '2048',
+            'x-put-timestamp': '1400000000.00000',
+            'x-timestamp': '1400000000.00000',
+            'x-container-meta-color': 'blue',
+            'x-trans-id': 'tx1',
+        }
+
+    def test_ignores_request_headers(self):
+        before = fingerprint.container_fingerprint(self.headers)
+        self.headers['x-trans-id'] = 'tx2'
+        self.assertEqual(fingerprint.container_fingerprint(self.headers),
+                         before)
+
+    def test_changes_with_listing_and_meta(self):
+        before = fingerprint.container_fingerprint(self.headers)
+        for name, value in [('x-container-object-count', '11'),
+                            ('x-container-meta-color', 'red'),
+                            ('x-container-meta-size', 'big')]:
+            headers = dict(self.headers)
+            headers[name] = value
+            self.assertNotEqual(fingerprint.container_fingerprint(headers),
+                                before)
+
+
+class FingerprintStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_disabled_by_default(self):
+        self.assertEqual(fingerprint.get_fingerprint_store({}), None)
+
+    def test_sqlite_store(self):
+        config = {'fingerprint_store': 'sqlite',
+                  'fingerprint_db': os.path.join(self.tempdir, 'a', 'f.db')}
+        store = fingerprint.get_fingerprint_store(config)
+        self.assertEqual(store.get('os-1', 'AUTH_test', u'c\xe9'), None)
+        store.set('os-1', 'AUTH_test', u'c\xe9', 'abc')
+        store.set('os-1', 'AUTH_test', u'c\xe9', 'def')
+
+        store = fingerprint.get_fingerprint_store(config)
+        self.assertEqual(store.get('os-1', 'AUTH_test', u'c\xe9'), 'def')
+        self.assertEqual(store.get('os-1', 'AUTH_test', 'other'), None)
+        # a new index has none
+        self.assertEqual(store.get('os-2', 'AUTH_test', u'c\xe9'), None)
+
+    def test_unknown_store(self):
+        self.assertRaises(ValueError, fingerprint.get_fingerprint_store,
+                          {'fingerprint_store': 'memcache'})
@@ -195,3 +195,347 @@ class ObjectUpdateHandlerTest(unittest.TestCase):
 	pass
 		
 """	
+
+
+class ParsePropsTest(unittest.TestCase):
+
+    def test_decoded_headers(self):
+        from swearch import index
+        handler = index.ObjectUpdateHandler(
+            mock.Mock(), 'AUTH_test', 'c', 'o', logger=mock.Mock())
+        _id, props = handler.parse_props({
+            u'etag': u'abc', u'x-object-meta-color': u'blue',
+            'x-object-meta-size': 'big'})
+        self.assertEqual(props['meta'], {u'color': u'blue', u'size': u'big'})
+
+        handler = index.ContainerUpdateHandler(
+            mock.Mock(), 'AUTH_test', 'c', logger=mock.Mock())
+        _id, props = handler.parse_props({u'x-container-meta-color': u'red'})
+        self.assertEqual(props['meta'], {u'color': u'red'})
+
+
+class ObjectUpdateFromResponseTest(unittest.TestCase):
+
+    def setUp(self):
+        from swearch import index
+        self.indexer = mock.Mock()
+        self.app = mock.Mock()
+        self.handler = index.ObjectUpdateHandler(
+            self.indexer, 'AUTH_test', 'c', 'dir/o.txt', app=self.app)
+
+    def put(self, path='/v1/AUTH_test/c/dir/o.txt', **headers):
+        headers.setdefault('Content-Type', 'text/plain')
+        return swob.Request.blank(
+            path, environ={'REQUEST_METHOD': 'PUT'}, headers=headers)
+
+    def test_put_indexes_without_head(self):
+        req = self.put(**{'X-Object-Meta-Color': 'blue'})
+        self.handler.after_PUT(req, {'etag': 'abc',
+                                     'content-type': 'text/html'})
+
+        self.assertFalse(self.app.called)
+        index_name, _id, props = self.indexer.index_doc.call_args[0]
+        self.assertEqual(self.indexer.index_doc.call_args[1]['version'],
+                         None)
+        self.assertEqual(props['hash'], 'abc')
+        self.assertEqual(props['content_type'], 'text/plain')
+        self.assertEqual(props['meta'], {'color': 'blue'})
+
+    def test_falls_back_to_head(self):
+        self.app.side_effect = swob.Response(headers={
+            'Etag': 'def', 'Content-Type': 'image/png'})
+        reqs = [
+            self.put(**{'X-Copy-From': '/c/other'}),
+            self.put(**{'X-Object-Manifest': 'c/segments'}),
+            self.put(path='/v1/AUTH_test/c/dir/o.txt?'
+                          'multipart-manifest=put'),
+            self.put(**{'X-Detect-Content-Type': 'true'}),
+            swob.Request.blank('/v1/AUTH_test/c/dir/o.txt',
+                               environ={'REQUEST_METHOD': 'POST'}),
+        ]
+        for req in reqs:
+            self.assertEqual(
+                self.handler.request_headers(req, {'etag': 'abc'}), None)
+
+        self.handler.after_PUT(reqs[0], {'etag': 'abc'})
+        self.assertEqual(self.app.call_count, 1)
+        props = self.indexer.index_doc.call_args[0][2]
+        self.assertEqual(props['hash'], 'def')
+        self.assertEqual(props['content_type'], 'image/png')
+
+    def test_head_is_timed(self):
+        from swearch import index
+        logger = mock.Mock()
+        handler = index.ObjectUpdateHandler(
+            self.indexer, 'AUTH_test', 'c', 'o', app=self.app, logger=logger)
+        self.app.side_effect = swob.Response(headers={'Etag': 'def'})
+        handler.after_PUT(self.put(), None)
+        self.assertEqual(logger.timing_since.call_args[0][0],
+                         'swearch.head.object.timing')
+
+    def test_listing_headers(self):
+        from swearch import index
+        listing = {'name': u'dir/o.txt', 'hash': 'abc', 'bytes': 10,
+                   'content_type': u'text/plain;swift_bytes=2048',
+                   'last_modified': '2014-01-01T00:00:00.000000'}
+        _id, props = self.handler.parse_props(
+            self.handler.listing_headers(listing))
+        self.assertEqual(props['hash'], 'abc')
+        self.assertEqual(props['content_type'], 'text/plain')
+        self.assertEqual(props['path'], 'c/dir/o.txt')
+        self.assertEqual(props['meta'], {})
+        self.assertEqual(index.timestamp_version(
+            self.handler.listing_headers(listing)['x-timestamp']),
+            138853440000000)
+
+    def test_put_and_delete_are_versioned(self):
+        req = self.put(**{'X-Timestamp': '1420070400.12345'})
+        self.handler.after_PUT(req, {'etag': 'abc'})
+        self.assertEqual(self.indexer.index_doc.call_args[1]['version'],
+                         142007040012345)
+
+        req = swob.Request.blank(
+            '/v1/AUTH_test/c/dir/o.txt', environ={'REQUEST_METHOD': 'DELETE'},
+            headers={'X-Timestamp': '1420070401.00000_0000000000000001'})
+        self.handler.after_DELETE(req)
+        self.assertEqual(self.indexer.remove_doc.call_args[1]['version'],
+                         142007040100000)
+        self.assertEqual(self.indexer.remove_doc.call_args[1]['routing'],
+                         None)
+
+    def test_handlers_route_by_account(self):
+        from swearch import index
+        routing = index.AccountRouting()
+        handler = index.ObjectUpdateHandler(
+            self.indexer, 'AUTH_test', 'c', 'o', routing=routing)
+        handler.index('id', {})
+        self.assertEqual(self.indexer.index_doc.call_args[1]['routing'],
+                         'AUTH_test')
+        handler = index.ContainerUpdateHandler(
+            self.indexer, 'AUTH_test', 'c', routing=routing)
+        handler.after_DELETE(None)
+        self.assertEqual(self.indexer.remove_doc.call_args[1]['routing'],
+                         'AUTH_test')
+
+    def test_post_updates_metadata_only(self):
+        req = swob.Request.blank(
+            '/v1/AUTH_test/c/dir/o.txt', environ={'REQUEST_METHOD': 'POST'},
+            headers={'X-Object-Meta-Color': 'red',
+                     'X-Object-Meta-Size': ''})
+        self.handler.after_POST(req, {})
+
+        self.assertFalse(self.app.called)
+        self.assertFalse(self.indexer.index_doc.called)
+        index_name, _id, fields = self.indexer.update_doc.call_args[0]
+        self.assertEqual(_id, self.handler.parse_props({})[0])
+        self.assertEqual(fields, {'meta': {'color': 'red'}})
+
+    def test_post_detecting_content_type_reindexes(self):
+        self.app.side_effect = swob.Response(headers={
+            'Etag': 'def', 'Content-Type': 'image/png'})
+        req = swob.Request.blank(
+            '/v1/AUTH_test/c/dir/o.txt', environ={'REQUEST_METHOD': 'POST'},
+            headers={'X-Detect-Content-Type': 'true'})
+        self.handler.after_POST(req, {})
+
+        self.assertFalse(self.indexer.update_doc.called)
+        props = self.indexer.index_doc.call_args[0][2]
+        self.assertEqual(props['content_type'], 'image/png')
+
+
+class StaleDocsTest(unittest.TestCase):
+
+    def test_missing_and_stale_docs(self):
+        from swearch import index
+        import pyes
+        from pyes.models import ElasticSearchModel
+        es = pyes.ES('127.0.0.1:9200')
+        client = mock.Mock()
+        client.mget.return_value = [
+            ElasticSearchModel(es, {'_id': 'a', 'found': True, '_source': {
+                'hash': u'abc', 'meta': {u'color': u'blue'}}}),
+            ElasticSearchModel(es, {'_id': 'b', 'found': True, '_source': {
+                'hash': u'old', 'meta': {}}}),
+            ElasticSearchModel(es, {'_id': 'c', 'found': False}),
+        ]
+        docs = [
+            ('a', {'hash': 'abc', 'meta': {'color': 'blue'}}),
+            ('b', {'hash': 'new', 'meta': {}}, 142007040012345),
+            ('c', {'hash': 'abc', 'meta': {}}),
+        ]
+        self.assertEqual(index.stale_docs(client, 'os_default', docs),
+                         docs[1:])
+        client.mget.assert_called_once_with(
+            ['a', 'b', 'c'], index='os_default', doc_type='entity')
+
+    def test_listing_fields_ignore_meta(self):
+        from swearch import index
+        import pyes
+        from pyes.models import ElasticSearchModel
+        es = pyes.ES('127.0.0.1:9200')
+        client = mock.Mock()
+        client.mget.return_value = [
+            ElasticSearchModel(es, {'_id': 'a', 'found': True, '_source': {
+                'hash': u'abc', 'content_type': u'text/plain',
+                'meta': {u'color': u'blue'}}}),
+            ElasticSearchModel(es, {'_id': 'b', 'found': True, '_source': {
+                'hash': u'old', 'content_type': u'text/plain',
+                'meta': {}}}),
+        ]
+        docs = [
+            ('a', {'hash': 'abc', 'content_type': 'text/plain',
+                   'meta': {}}),
+            ('b', {'hash': 'new', 'content_type': 'text/plain',
+                   'meta': {}}),
+        ]
+        self.assertEqual(
+            index.stale_docs(client, 'os_default', docs,
+                             fields=index.LISTING_FIELDS),
+            docs[1:])
+
+
+class SearchClientTest(unittest.TestCase):
+
+    def test_client_is_shared(self):
+        from swearch import index
+        config = {'elastic_hosts': '10.0.0.1:9200, 10.0.0.2:9200'}
+        client = index.get_search_client(config)
+        self.assertTrue(client is index.get_search_client(config))
+        self.assertTrue(isinstance(client.connection,
+                                   index.RoundRobinConnection))
+
+    def test_round_robin_skips_failed_hosts(self):
+        from swearch import index
+        import urlparse
+        servers = [urlparse.urlparse('http://10.0.0.%d:9200' % i)
+                   for i in range(3)]
+        conn = index.RoundRobinConnection(servers, retry_time=60)
+        picked = [conn._get_server() for i in range(3)]
+        self.assertEqual(len(set(picked)), 3)
+
+        conn._drop_server(picked[0])
+        picked = set(conn._get_server() for i in range(4))
+        self.assertEqual(len(picked), 2)
+
+        with mock.patch.object(index.time, 'time',
+                               return_value=index.time.time() + 61):
+            picked = set(conn._get_server() for i in range(3))
+        self.assertEqual(len(picked), 3)
+
+
+class SearcherTest(unittest.TestCase):
+
+    def setUp(self):
+        from swearch import index
+        self.index = index
+        self.client = mock.Mock()
+        self.client.search_raw.return_value = {'hits': {'total': 3, 'hits': [
+            {'_source': {'name': 'a'}, 'sort': ['c', 'c/a']},
+            {'_source': {'name': 'b'}, 'sort': ['c', 'c/b']},
+        ]}}
+        self.searcher = index.Searcher(['127.0.0.1:9200'], 'os_default',
+                                       'AUTH_test', client=self.client,
+                                       keyword_fields=True)
+        self.searcher.limit = 2
+
+    def test_sort_keys(self):
+        self.assertEqual(self.searcher.sort_keys(), [('path', 'asc')])
+        self.searcher.sort = 'container desc,bogus,name'
+        self.assertEqual(self.searcher.sort_keys(), [
+            ('container', 'desc'), ('name', 'asc'), ('path', 'asc')])
+        self.searcher.sort = 'path desc,name'
+        self.assertEqual(self.searcher.sort_keys(), [('path', 'desc')])
+        self.searcher.sort = None
+        self.searcher.add_condition('_all', 'needle')
+        self.assertEqual(self.searcher.sort_keys(), None)
+
+    def test_sort_is_sent_to_es(self):
+        self.searcher.sort = 'container desc'
+        results = self.searcher.execute()
+        body = self.client.search_raw.call_args[0][0].serialize()
+        self.assertEqual(body['sort'], [{'container': {'order': 'desc'}},
+                                        {'path': {'order': 'asc'}}])
+        self.assertEqual([r['name'] for r in results], ['a', 'b'])
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results.total, 3)
+
+        marker = results.next_marker
+        self.assertEqual(self.index.decode_marker(
+            marker, self.searcher.sort_keys()), ['c', 'c/b'])
+
+    def test_cursor_marker(self):
+        self.searcher.sort = 'container desc'
+        self.searcher.marker = self.index.encode_marker(['c', 'c/b'])
+        self.searcher.execute()
+        body = self.client.search_raw.call_args[0][0].serialize()
+        cursor = body['query']['filtered']['filter']['and'][-1]['or']
+        self.assertEqual(cursor[0], {'and': [
+            {'range': {'container': {'lt': 'c'}}}]})
+        self.assertEqual(cursor[1]['and'][0], {'term': {'container': 'c'}})
+
+    def test_legacy_name_marker(self):
+        self.searcher.marker = 'some-object'
+        self.searcher.execute()
+        body = self.client.search_raw.call_args[0][0].serialize()
+        marker = body['query']['filtered']['filter']['and'][-1]
+        self.assertEqual(marker.keys(), ['range'])
+        self.assertTrue('name' in marker['range'])
+
+    def test_no_marker_for_last_page(self):
+        self.searcher.limit = 10
+        self.assertEqual(self.searcher.execute().next_marker, None)
+
+    def test_analyzed_fields_page_by_start(self):
+        self.searcher.keyword_fields = False
+        self.assertEqual(self.searcher.sort_keys(), None)
+        self.searcher.sort = 'container desc'
+        self.assertEqual(self.searcher.sort_keys(), [('container', 'desc')])
+
+        self.searcher.marker = self.index.encode_marker(['c', 'c/b'])
+        results = self.searcher.execute()
+        self.assertEqual(results.next_marker, None)
+        body = self.client.search_raw.call_args[0][0].serialize()
+        self.assertEqual(body['sort'], [{'container': {'order': 'desc'}}])
+        marker = body['query']['filtered']['filter']['and'][-1]
+        self.assertEqual(marker.keys(), ['range'])
+        self.assertTrue('name' in marker['range'])
+
+        self.searcher.sort = self.searcher.marker = None
+        self.searcher.execute()
+        body = self.client.search_raw.call_args[0][0].serialize()
+        self.assertFalse('sort' in body)
+
+    def test_routed_search(self):
+        self.searcher.routing = self.index.AccountRouting({'AUTH_test': 2})
+        self.searcher.execute()
+        self.assertEqual(self.client.search_raw.call_args[1]['routing'],
+                         'AUTH_test:0,AUTH_test:1')
+
+        self.searcher.path = 'c/dir'
+        self.searcher.execute()
+        self.assertEqual(self.client.search_raw.call_args[1]['routing'],
+                         self.searcher.routing.route('AUTH_test', 'c'))
+
+
+class AccountRoutingTest(unittest.TestCase):
+
+    def test_get_routing(self):
+        from swearch import index
+        self.assertEqual(index.get_routing({}), None)
+        routing = index.get_routing({
+            'account_routing': 'true',
+            'routing_partitions': 'AUTH_big:4, AUTH_huge:16'})
+        self.assertEqual(routing.partitions, {'AUTH_big': 4, 'AUTH_huge': 16})
+
+    def test_route(self):
+        from swearch import index
+        routing = index.AccountRouting({'AUTH_big': 4})
+        self.assertEqual(routing.route('AUTH_test', 'c'), 'AUTH_test')
+        self.assertEqual(routing.search_routing('AUTH_test'), 'AUTH_test')
+
+        values = set(routing.route('AUTH_big', 'c%d' % i) for i in range(50))
+        self.assertEqual(values, set('AUTH_big:%d' % i for i in range(4)))
+        self.assertEqual(routing.route('AUTH_big', u'caf\xe9'),
+                         routing.route('AUTH_big', u'caf\xe9'))
+        self.assertEqual(routing.search_routing('AUTH_big', 'c1'),
+                         routing.route('AUTH_big', 'c1'))
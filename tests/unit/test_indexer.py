@@ -1,6 +1,9 @@
 import mock
 import unittest
 import os
+import tempfile
+
+import eventlet
 
 from swearch import utils
 from swift.common import swob
@@ -15,6 +18,7 @@ from swearch import index
 from swearch import rabbit
 from swearch import daemon
 from swearch.middleware import indexer
+from swearch.middleware import searcher
 
 
 
@@ -84,3 +88,169 @@ class IndexerTest(unittest.TestCase):
 		
         
      
+
+
+class WriteCoalescerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spawn_patcher = mock.patch.object(indexer.eventlet, 'spawn')
+        self.spawn_patcher.start()
+        self.coalescer = indexer.WriteCoalescer(60, max_pending=2,
+                                                logger=mock.Mock())
+
+    def tearDown(self):
+        self.spawn_patcher.stop()
+
+    def flush(self):
+        self.coalescer.flush(force=True)
+        self.coalescer.pool.waitall()
+
+    def test_last_action_wins(self):
+        put, post, delete = mock.Mock(), mock.Mock(), mock.Mock()
+        self.coalescer.add('a', put, 'req1')
+        self.coalescer.add('a', post, 'req2')
+        self.coalescer.add('a', delete, 'req3')
+        self.coalescer.add('b', put, 'req4')
+        self.flush()
+
+        self.assertFalse(post.called)
+        delete.assert_called_once_with('req3')
+        put.assert_called_once_with('req4')
+        self.assertEqual(self.coalescer.pending, {})
+        self.assertEqual(self.coalescer.logger.increment.call_args_list,
+                         [mock.call('swearch.coalesced')] * 2)
+
+    def test_window_starts_with_first_action(self):
+        with mock.patch.object(indexer.time, 'time', return_value=100):
+            self.coalescer.add('a', mock.Mock())
+        with mock.patch.object(indexer.time, 'time', return_value=130):
+            self.coalescer.add('a', mock.Mock())
+        self.assertEqual(self.coalescer.pending['a'][0], 160)
+
+    def test_overflow_runs_immediately(self):
+        action = mock.Mock()
+        for _id in 'abc':
+            self.coalescer.add(_id, action, _id)
+        action.assert_called_once_with('c')
+        self.assertEqual(sorted(self.coalescer.pending), ['a', 'b'])
+
+
+class FakeMemcache(object):
+
+    def __init__(self):
+        self.store = {}
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, *args, **kwargs):
+        self.store[key] = value
+
+
+class IndexMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config_file = tempfile.NamedTemporaryFile(suffix='.conf')
+        self.indexer = mock.patch.object(
+            indexer.rabbit, 'RabbitMQElasticIndexer').start().return_value
+        self.logger = mock.patch.object(
+            indexer.swift_utils, 'get_logger').start().return_value
+        self.memcache = FakeMemcache()
+        self.app = self.get_app()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        self.config_file.close()
+
+    def get_app(self, **index_conf):
+        self.config_file.seek(0)
+        self.config_file.truncate()
+        self.config_file.write('[index]\n')
+        for option, value in index_conf.items():
+            self.config_file.write('%s = %s\n' % (option, value))
+        self.config_file.write('[queue]\n')
+        self.config_file.flush()
+        return indexer.IndexMiddleware(
+            swob.HTTPCreated(headers={'Etag': 'abc'}),
+            {'config_file': self.config_file.name})
+
+    def request(self, method, path='/v1/AUTH_test/c/o', app=None):
+        req = swob.Request.blank(path, environ={
+            'REQUEST_METHOD': method, 'swift.cache': self.memcache})
+        return req.get_response(app or self.app)
+
+    def test_write_bumps_generation(self):
+        key = indexer.utils.search_generation_key('AUTH_test')
+        with mock.patch.object(indexer.time, 'time', return_value=100):
+            self.assertEqual(self.request('PUT').status_int, 201)
+            eventlet.sleep(0)
+        self.assertEqual(self.memcache.store, {key: 100})
+
+    def test_search_after_write_misses_cache(self):
+        self.memcache.set(indexer.utils.search_generation_key('AUTH_test'), 0)
+        search_app = searcher.SearchMiddleware(
+            mock.Mock(), {'config_file': self.config_file.name})
+
+        def search():
+            return swob.Request.blank(
+                '/search/AUTH_test?format=json', environ={
+                    'swift.cache': self.memcache,
+                    'swift.authorize': lambda req: None,
+                }).get_response(search_app).body
+
+        with mock.patch.object(searcher.index.Searcher,
+                               'execute') as execute:
+            execute.return_value = mock.MagicMock(total=0, next_marker=None)
+            search()
+            search()
+            self.assertEqual(execute.call_count, 1)
+
+            self.request('PUT')
+            eventlet.sleep(0)
+            search()
+            self.assertEqual(execute.call_count, 2)
+
+    def test_memcache_down_doesnt_fail_writes(self):
+        self.memcache.set = mock.Mock(side_effect=Exception('down'))
+        self.assertEqual(self.request('PUT').status_int, 201)
+        # the generation is bumped after the response
+        self.assertEqual(self.memcache.set.call_count, 0)
+        eventlet.sleep(0)
+        self.assertEqual(self.memcache.set.call_count, 1)
+        self.assertEqual(self.logger.exception.call_count, 1)
+
+    def test_post_replacing_pending_write_reindexes(self):
+        with mock.patch.object(indexer.eventlet, 'spawn'):
+            app = self.get_app(coalesce_window=60)
+        _id = index.get_index_id('AUTH_test', 'c', 'o')
+
+        self.request('POST', app=app)
+        self.assertEqual(app.coalescer.pending[_id][1].__name__,
+                         'after_POST')
+        app.coalescer.pending.clear()
+
+        self.request('PUT', app=app)
+        self.request('POST', app=app)
+        # the partial update can't stand in for the pending PUT
+        self.assertEqual(app.coalescer.pending[_id][1].__name__, 'update')
+        app.coalescer.flush(force=True)
+        app.coalescer.pool.waitall()
+        self.assertEqual(self.indexer.index_doc.call_count, 1)
+        self.assertEqual(self.indexer.update_doc.call_count, 0)
+
+    def test_statsd(self):
+        self.indexer.publish_queue.qsize.return_value = 3
+        self.indexer.publish_queue.bytes = 300
+        with mock.patch.object(indexer.time, 'time', return_value=100):
+            self.request('DELETE')
+        self.logger.increment.assert_called_once_with(
+            'swearch.actions.DELETE')
+        self.assertEqual(self.logger.timing.call_args_list, [
+            mock.call('swearch.publish_queue.depth', 3),
+            mock.call('swearch.publish_queue.bytes', 300)])
+        self.logger.timing_since.assert_called_once_with(
+            'swearch.index_request.timing', 100)
+
+        # only indexed writes are timed
+        self.request('GET')
+        self.assertEqual(self.logger.timing_since.call_count, 1)
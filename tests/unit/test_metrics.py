@@ -0,0 +1,69 @@
+import httplib
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from swearch import metrics
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = metrics.Metrics(buckets=(0.1, 1))
+
+    def test_render(self):
+        self.metrics.inc('messages_total', {'type': 'index_object'})
+        self.metrics.inc('messages_total', {'type': 'index_object'}, 2)
+        self.metrics.set('water_level', 10, {'queue': 'river'})
+        self.metrics.observe('handler_seconds', 0.05)
+        self.metrics.observe('handler_seconds', 0.5)
+        self.metrics.observe('handler_seconds', 5)
+
+        self.assertEqual(self.metrics.render().splitlines(), [
+            '# TYPE handler_seconds histogram',
+            'handler_seconds_bucket{le="0.1"} 1',
+            'handler_seconds_bucket{le="1"} 2',
+            'handler_seconds_bucket{le="+Inf"} 3',
+            'handler_seconds_sum 5.55',
+            'handler_seconds_count 3',
+            '# TYPE messages_total counter',
+            'messages_total{type="index_object"} 3.0',
+            '# TYPE water_level gauge',
+            'water_level{queue="river"} 10.0',
+        ])
+
+    def test_timer_observes_failures(self):
+        with self.assertRaises(ValueError):
+            with self.metrics.timer('handler_seconds'):
+                raise ValueError()
+        self.assertTrue('handler_seconds_count 1' in self.metrics.render())
+
+    def test_unix_socket_server(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'metrics.sock')
+            self.metrics.inc('messages_total')
+            server = metrics.start_server('unix:' + path, self.metrics)
+            try:
+                conn = UnixHTTPConnection(path)
+                conn.request('GET', '/metrics')
+                resp = conn.getresponse()
+                self.assertEqual(resp.status, 200)
+                self.assertTrue('messages_total 1.0' in resp.read())
+            finally:
+                server.shutdown()
+                server.server_close()
+        finally:
+            shutil.rmtree(tempdir)
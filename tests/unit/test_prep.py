@@ -0,0 +1,63 @@
+import mock
+import unittest
+
+from pyes.exceptions import IndexMissingException
+
+from swearch import prep
+
+
+class PrepTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.config = {'search_index_name': 'os_default',
+                       'index_shards': '10'}
+
+    def test_mapping(self):
+        mapping = prep.index_mapping()
+        self.assertEqual(mapping['_all'], {'enabled': False})
+        self.assertFalse('_routing' in mapping)
+        properties = mapping['properties']
+        for name in prep.KEYWORD_FIELDS:
+            self.assertEqual(properties[name]['index'], 'not_analyzed')
+            self.assertTrue(properties[name]['doc_values'])
+        self.assertEqual(properties['analyzed_name']['copy_to'],
+                         prep.TEXT_FIELD)
+        self.assertFalse('index' in properties['analyzed_name'])
+        self.assertEqual(
+            mapping['dynamic_templates'][0]['meta']['mapping']['copy_to'],
+            prep.TEXT_FIELD)
+
+        self.assertEqual(prep.index_mapping(routing=True)['_routing'],
+                         {'required': True})
+
+    def test_create_index(self):
+        prep.create_index(self.client, 'os_default-1', self.config,
+                          bulk=True)
+        name, body = self.client.indices.create_index.call_args[0]
+        self.assertEqual(name, 'os_default-1')
+        self.assertEqual(body['settings'], {'number_of_shards': 10,
+                                            'number_of_replicas': 0,
+                                            'refresh_interval': '-1'})
+        self.assertFalse('_routing' in body['mappings']['entity'])
+
+        self.config['account_routing'] = 'true'
+        prep.create_index(self.client, 'os_default-2', self.config)
+        name, body = self.client.indices.create_index.call_args[0]
+        self.assertEqual(body['settings']['number_of_replicas'], 1)
+        self.assertTrue('_routing' in body['mappings']['entity'])
+
+    def test_finish_index(self):
+        prep.finish_index(self.client, 'os_default-1', self.config)
+        self.client.indices.update_settings.assert_called_once_with(
+            'os_default-1', {'index': {'number_of_replicas': 1,
+                                       'refresh_interval': '1s'}})
+
+    def test_alias(self):
+        prep.point_alias(self.client, 'os_default-1', self.config)
+        self.client.indices.set_alias.assert_called_once_with(
+            'os_default', ['os_default-1'])
+
+        self.client.indices.get_alias.side_effect = IndexMissingException(
+            "IndexMissingException[[os_default] missing]")
+        self.assertEqual(prep.alias_indices(self.client, self.config), [])
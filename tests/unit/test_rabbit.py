@@ -0,0 +1,353 @@
+import json
+import mock
+import shutil
+import tempfile
+import unittest
+
+import eventlet
+import pika
+
+from swearch import buffer
+from swearch import rabbit
+
+
+class RabbitMQElasticIndexerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spawn_patcher = mock.patch.object(rabbit.eventlet, 'spawn')
+        self.spawn_patcher.start()
+
+    def tearDown(self):
+        self.spawn_patcher.stop()
+
+    def get_indexer(self, **conf):
+        indexer = rabbit.RabbitMQElasticIndexer(conf)
+        indexer.connection = mock.Mock()
+        indexer.channel = mock.Mock()
+        indexer.channel.basic_publish.return_value = True
+        return indexer
+
+    def test_get_batch_drains_queue(self):
+        indexer = self.get_indexer(rabbitmq_batch_size='3')
+        messages = [buffer.Message('a', 'r', str(i), None) for i in range(5)]
+        for message in messages:
+            indexer.publish_queue.put(message)
+        self.assertEqual(indexer._get_batch(),
+                         [(m, None) for m in messages[:3]])
+        self.assertEqual(indexer._get_batch(),
+                         [(m, None) for m in messages[3:]])
+
+    def test_get_batch_lingers(self):
+        indexer = self.get_indexer(rabbitmq_batch_size='2',
+                                   rabbitmq_batch_linger_ms='50')
+        messages = [buffer.Message('a', 'r', str(i), None) for i in range(2)]
+        indexer.publish_queue.put(messages[0])
+        eventlet.spawn_after(0.01, indexer.publish_queue.put, messages[1])
+        self.assertEqual(indexer._get_batch(),
+                         [(m, None) for m in messages])
+
+    def test_publish_retry_sends_one_bulk_message(self):
+        indexer = self.get_indexer()
+        indexer.index_doc('os_default', 'a', {'name': 'a'})
+        indexer.remove_doc('os_default', 'b')
+        indexer._publish_retry()
+
+        self.assertEqual(indexer.channel.basic_publish.call_count, 1)
+        body = indexer.channel.basic_publish.call_args[1]['body']
+        lines = body.splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue('"index"' in lines[0])
+        self.assertTrue('"delete"' in lines[2])
+        self.assertEqual(indexer.publish_queue.unfinished_tasks, 0)
+
+    def test_publish_through_spool(self):
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        indexer = self.get_indexer(rabbitmq_spool_dir=spool_dir)
+        indexer.index_doc('os_default', 'a', {'name': 'a'})
+        indexer.remove_doc('os_default', 'b')
+        self.assertEqual(indexer.publish_queue.qsize(), 0)
+        indexer._publish_retry()
+
+        self.assertEqual(indexer.channel.basic_publish.call_count, 1)
+        kwargs = indexer.channel.basic_publish.call_args[1]
+        self.assertEqual(len(kwargs['body'].splitlines()), 3)
+        self.assertEqual(kwargs['properties'].delivery_mode, 2)
+        self.assertEqual(indexer.spool.outstanding[0], 0)
+
+    def test_index_docs_publishes_batches(self):
+        indexer = self.get_indexer(rabbitmq_batch_size='2')
+        docs = [(str(i), {'name': str(i)}) for i in range(5)]
+        indexer.index_docs('os_default', docs)
+
+        bodies = [indexer.publish_queue.get().body for i in range(3)]
+        self.assertEqual([len(body.splitlines()) for body in bodies],
+                         [4, 4, 2])
+        self.assertTrue('"_id": "4"' in bodies[2])
+
+    def test_update_doc_replaces_objects(self):
+        indexer = self.get_indexer()
+        indexer.update_doc('os_default', 'a', {'meta': {'color': 'red'},
+                                               'content_type': 'text/html'})
+        message = indexer.publish_queue.get()
+        self.assertEqual(message.key, None)
+        lines = [json.loads(line) for line in message.body.splitlines()]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0]['update']['_id'], 'a')
+        self.assertEqual(lines[1], {
+            'script': 'ctx._source.putAll(fields)',
+            'params': {'fields': {'meta': {'color': 'red'},
+                                  'content_type': 'text/html'}}})
+
+        indexer = self.get_indexer(update_script='swearch_update')
+        indexer.update_doc('os_default', 'a', {'meta': {}})
+        body = indexer.publish_queue.get().body
+        self.assertEqual(json.loads(body.splitlines()[1])['script'],
+                         'swearch_update')
+
+    def test_index_docs_version_type(self):
+        indexer = self.get_indexer()
+        indexer.index_docs('os_default', [('a', {}, 7)],
+                           version_type='external')
+        action = json.loads(indexer.publish_queue.get().body.split('\n')[0])
+        self.assertEqual(action['index']['_version'], 7)
+        self.assertEqual(action['index']['_version_type'], 'external')
+
+    def test_actions_carry_external_version(self):
+        indexer = self.get_indexer()
+        indexer.index_doc('os_default', 'a', {'name': 'a'},
+                          version=142007040012345)
+        indexer.remove_doc('os_default', 'a', version=142007040012346)
+        indexer.index_docs('os_default', [('b', {}), ('c', {}, 7)])
+        actions = [json.loads(indexer.publish_queue.get().body.split('\n')[0])
+                   for i in range(3)]
+
+        self.assertEqual(actions[0]['index']['_version'], 142007040012345)
+        self.assertEqual(actions[0]['index']['_version_type'], 'external_gte')
+        self.assertEqual(actions[1]['delete']['_version'], 142007040012346)
+        # unversioned docs keep the internal version
+        self.assertFalse('_version' in actions[2]['index'])
+
+        indexer = self.get_indexer(external_versioning='no')
+        indexer.remove_doc('os_default', 'a', version=142007040012346)
+        action = json.loads(indexer.publish_queue.get().body)
+        self.assertFalse('_version' in action['delete'])
+
+    def test_actions_carry_routing(self):
+        indexer = self.get_indexer()
+        indexer.index_doc('os_default', 'a', {}, routing='AUTH_test')
+        indexer.update_doc('os_default', 'a', {'meta': {}},
+                           routing='AUTH_test')
+        indexer.index_docs('os_default', [('b', {}, 7)], routing='AUTH_test')
+        indexer.remove_doc('os_default', 'a')
+        lines = [json.loads(line)
+                 for i in range(4)
+                 for line in indexer.publish_queue.get().body.splitlines()]
+        actions = [line.values()[0] for line in lines
+                   if line.keys() in (['index'], ['update'], ['delete'])]
+        self.assertEqual([action.get('_routing') for action in actions],
+                         ['AUTH_test'] * 3 + [None])
+
+    def test_merge_batch_keeps_routing(self):
+        indexer = self.get_indexer()
+        batch = [
+            (buffer.Message('a', 'r', '1\n', None), None),
+            (buffer.Message('a', 'r', '2\n', None), None),
+            (buffer.Message('b', 'r', '3\n', None), 7),
+        ]
+        merged = indexer._merge_batch(batch)
+        self.assertEqual([(m['body'], sources) for m, sources in merged],
+                         [('1\n2\n', [None, None]), ('3\n', [7])])
+        self.assertEqual(merged[1][0]['exchange'], 'b')
+        self.assertTrue(merged[0][0]['properties'] is rabbit.PERSISTENT)
+
+    def test_send_retry_gives_up_per_batch(self):
+        indexer = self.get_indexer(rabbitmq_send_attempts='3')
+        indexer.channel.basic_publish.return_value = False
+        with mock.patch.object(indexer, 'get_mq_client') as get_client:
+            get_client.return_value = (indexer.connection, indexer.channel)
+            self.assertFalse(indexer._send_retry(
+                {'exchange': 'a', 'routing_key': 'r', 'body': '1\n'}))
+        self.assertEqual(indexer.channel.basic_publish.call_count, 3)
+        self.assertEqual(get_client.call_args_list[1],
+                         mock.call(reconnect=True))
+
+
+class PipelinedConfirmsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spawn_patcher = mock.patch.object(rabbit.eventlet, 'spawn')
+        self.spawn_patcher.start()
+        self.indexer = rabbit.RabbitMQElasticIndexer({
+            'rabbitmq_require_confirmations': 'yes',
+            'rabbitmq_confirm_window': '2',
+            'rabbitmq_batch_size': '1',
+        })
+        self.indexer.connection = mock.Mock()
+        self.indexer.channel = mock.Mock()
+
+    def tearDown(self):
+        self.spawn_patcher.stop()
+
+    def confirm(self, method, tag, multiple=False):
+        self.indexer._on_confirm(
+            mock.Mock(method=method(delivery_tag=tag, multiple=multiple)))
+
+    def test_publish_does_not_block_on_confirm(self):
+        for name in 'abc':
+            self.indexer.remove_doc('os_default', name)
+        self.indexer._publish_retry()
+        self.indexer._publish_retry()
+
+        publish = self.indexer.channel._impl.basic_publish
+        self.assertEqual(publish.call_count, 2)
+        self.assertFalse(self.indexer.channel.basic_publish.called)
+        self.assertEqual(list(self.indexer._unconfirmed), [1, 2])
+
+        # window is full until the broker acks
+        self.confirm(pika.spec.Basic.Ack, 2, multiple=True)
+        self.indexer._publish_retry()
+        self.assertEqual(publish.call_count, 3)
+        self.assertEqual(list(self.indexer._unconfirmed), [3])
+        self.assertEqual(self.indexer.publish_queue.unfinished_tasks, 1)
+
+    def test_nack_resends_only_rejected(self):
+        for name in 'ab':
+            self.indexer.remove_doc('os_default', name)
+        self.indexer._publish_retry()
+        self.indexer._publish_retry()
+
+        self.confirm(pika.spec.Basic.Ack, 1)
+        self.confirm(pika.spec.Basic.Nack, 2)
+        self.assertEqual(len(self.indexer._resend), 1)
+
+        self.indexer._publish_retry()
+        publish = self.indexer.channel._impl.basic_publish
+        self.assertEqual(publish.call_count, 3)
+        self.assertEqual(publish.call_args_list[1], publish.call_args_list[2])
+
+    def test_timed_out_messages_are_resent(self):
+        self.indexer.remove_doc('os_default', 'a')
+        self.indexer._publish_retry()
+        self.indexer.confirm_timeout = -1
+        self.indexer._expire_unconfirmed()
+        self.assertFalse(self.indexer._unconfirmed)
+        self.assertEqual(len(self.indexer._resend), 1)
+
+    def test_gives_up_after_send_attempts(self):
+        self.indexer.remove_doc('os_default', 'a')
+        self.indexer._publish_retry()
+        self.confirm(pika.spec.Basic.Nack, 1)
+        self.indexer._publish_retry()
+        self.confirm(pika.spec.Basic.Nack, 2)
+        self.assertFalse(self.indexer._resend)
+        self.assertEqual(self.indexer.publish_queue.unfinished_tasks, 0)
+
+
+class PipelinedChannelTest(unittest.TestCase):
+
+    def setUp(self):
+        # the asynchronous channel pika wraps, with its real signatures
+        self.impl = mock.create_autospec(pika.channel.Channel, instance=True)
+        self.impl.channel_number = 1
+        self.connection = mock.Mock()
+        self.channel = pika.adapters.blocking_connection.BlockingChannel(
+            self.impl, self.connection)
+        self.pipelined = rabbit.PipelinedChannel(self.connection,
+                                                 self.channel)
+
+    def test_select_confirms(self):
+        callback = mock.Mock()
+        self.pipelined.select_confirms(callback)
+        self.impl.confirm_delivery.assert_called_once_with(callback,
+                                                           nowait=True)
+
+    def test_publish_does_not_wait(self):
+        self.pipelined.publish(exchange='a', routing_key='r', body='1\n',
+                               mandatory=True, properties=rabbit.PERSISTENT)
+        self.impl.basic_publish.assert_called_once_with(
+            exchange='a', routing_key='r', body='1\n', mandatory=True,
+            properties=rabbit.PERSISTENT)
+        self.connection.process_data_events.assert_called_once_with(
+            time_limit=0)
+
+
+class ConcurrentConsumerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spawn_patcher = mock.patch.object(rabbit.eventlet, 'spawn')
+        self.spawn_patcher.start()
+        self.indexer = rabbit.RabbitMQElasticIndexer({})
+        self.indexer.connection = mock.Mock()
+        self.indexer.channel = mock.Mock()
+        self.indexer.consumer_connection = mock.Mock()
+        self.channel = self.indexer.consumer_connection.channel.return_value
+
+    def tearDown(self):
+        self.spawn_patcher.stop()
+
+    def deliver(self, bodies):
+        frames = [(mock.Mock(delivery_tag=i), None, body)
+                  for i, body in enumerate(bodies)]
+        frames.append((None, None, None))
+        self.channel.consume.return_value = iter(frames)
+
+    def test_handlers_overlap_but_keep_partition_order(self):
+        self.deliver(['a1', 'b1', 'a2', 'b2', 'bad'])
+        handled = []
+
+        def handler(body):
+            if body == 'bad':
+                raise ValueError(body)
+            eventlet.sleep(0.01 if body == 'a1' else 0)
+            handled.append(body)
+
+        with mock.patch.object(rabbit.traceback, 'print_exc'):
+            self.indexer.start_consumer('object', handler, prefetch=10,
+                                        concurrency=2,
+                                        partition=lambda body: body[0])
+
+        # b's didn't wait for the slow a1, a2 did
+        self.assertTrue(handled.index('b2') < handled.index('a1'))
+        self.assertTrue(handled.index('a1') < handled.index('a2'))
+        self.assertEqual(
+            sorted(c[0][0] for c in self.channel.basic_ack.call_args_list),
+            [0, 1, 2, 3])
+        self.channel.basic_nack.assert_called_once_with(4, requeue=True)
+        self.assertTrue(self.channel.cancel.called)
+
+    def test_stops_at_prefetch(self):
+        self.deliver(['a', 'b', 'c'])
+        handler = mock.Mock()
+        self.indexer.start_consumer('object', handler, prefetch=2,
+                                    concurrency=2)
+        self.assertEqual(handler.call_count, 2)
+        self.assertEqual(self.channel.basic_ack.call_count, 2)
+
+    def test_handlers_publish_while_consuming(self):
+        self.deliver(['a', 'b', 'c', 'd'])
+        published = []
+        publishing = []
+
+        def basic_publish(**kwargs):
+            # pika fails a second green thread reading from the connection
+            self.assertFalse(publishing)
+            publishing.append(True)
+            eventlet.sleep(0.01)
+            published.append(kwargs['body'])
+            publishing.pop()
+            return True
+
+        self.indexer.channel.basic_publish.side_effect = basic_publish
+
+        def handler(body):
+            self.indexer.publish_backfill_task('object', 'a', 'c', body)
+
+        self.indexer.start_consumer('container', handler, prefetch=10,
+                                    concurrency=4, partition=lambda b: b)
+
+        self.assertEqual(len(published), 4)
+        self.assertEqual(self.channel.basic_ack.call_count, 4)
+        self.assertFalse(self.channel.basic_nack.called)
+        # the consumer has a connection of its own
+        self.assertFalse(self.indexer.connection.channel.called)
@@ -0,0 +1,230 @@
+import mock
+import os
+import tempfile
+import unittest
+
+from swift.common import swob
+
+from swearch import utils
+from swearch.middleware import searcher
+
+
+class FakeMemcache(object):
+
+    def __init__(self):
+        self.store = {}
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, *args, **kwargs):
+        self.store[key] = value
+
+
+class FakeResults(list):
+    total = 0
+    next_marker = None
+
+
+class SearchMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.config_file = tempfile.mkstemp()
+        os.write(fd, '[index]\nelastic_hosts = 127.0.0.1:9200\n'
+                     'search_cache_settle = 5\n')
+        os.close(fd)
+        self.app = searcher.SearchMiddleware(
+            mock.Mock(), {'config_file': self.config_file})
+        self.memcache = FakeMemcache()
+        # last written to long enough ago for results to be cached
+        self.memcache.set(utils.search_generation_key('AUTH_test'),
+                          utils.time.time() - 10)
+
+        self.execute_patcher = mock.patch.object(
+            searcher.index.Searcher, 'execute')
+        self.execute = self.execute_patcher.start()
+        results = FakeResults([{'name': 'o', 'container': 'c'}])
+        results.total = 1
+        self.execute.return_value = results
+
+    def tearDown(self):
+        self.execute_patcher.stop()
+        os.unlink(self.config_file)
+
+    def search(self, query='format=json'):
+        req = swob.Request.blank(
+            '/search/AUTH_test?' + query,
+            environ={'swift.cache': self.memcache,
+                     'swift.authorize': lambda req: None})
+        resp = req.get_response(self.app)
+        resp.body
+        return resp
+
+    def test_repeated_search_is_cached(self):
+        self.assertEqual(self.search().status_int, 200)
+        resp = self.search()
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.headers['X-Search-Items-Total'], '1')
+        self.assertEqual(self.execute.call_count, 1)
+
+        self.search('format=json&limit=5')
+        self.assertEqual(self.execute.call_count, 2)
+
+    def test_unknown_generation_is_not_cached(self):
+        self.memcache.store.clear()
+        self.search()
+        self.search()
+        self.assertEqual(self.execute.call_count, 2)
+
+    def test_write_invalidates_cache(self):
+        self.search()
+        key = utils.search_generation_key('AUTH_test')
+        self.memcache.set(key, utils.time.time())
+        self.search()
+        self.search()
+        # not cached while the new generation settles
+        self.assertEqual(self.execute.call_count, 3)
+
+        self.memcache.set(key, utils.time.time() - 10)
+        self.search()
+        self.search()
+        self.assertEqual(self.execute.call_count, 4)
+
+    def test_serialized_formats(self):
+        results = FakeResults([{'name': u'\u2603', 'type': 'object'},
+                               {'name': 'a&b', 'type': 'object'}])
+        results.total = 12
+        self.execute.return_value = results
+
+        resp = self.search('format=json&start=10')
+        self.assertEqual(resp.headers['X-Search-Items-Count'], '2')
+        self.assertEqual(
+            [r['name'] for r in searcher.json.loads(resp.body)],
+            [u'\u2603', 'a&b'])
+
+        resp = self.search('format=xml')
+        self.assertEqual(resp.body.count('<object>'), 2)
+        self.assertTrue('<name>a&amp;b</name>' in resp.body)
+        self.assertTrue(resp.body.endswith('</results>'))
+
+        resp = self.search('format=text')
+        self.assertTrue('name: \xe2\x98\x83\n' in resp.body)
+
+    def test_items_count_from_total(self):
+        self.execute.return_value.total = 250
+        resp = self.search('format=json&start=200&limit=100')
+        self.assertEqual(resp.headers['X-Search-Items-Count'], '50')
+        resp = self.search('format=json&start=100&limit=100')
+        self.assertEqual(resp.headers['X-Search-Items-Count'], '100')
+        resp = self.search('format=json&start=300')
+        self.assertEqual(resp.headers['X-Search-Items-Count'], '0')
+
+    def test_next_marker_header(self):
+        self.execute.return_value.next_marker = 'abc'
+        resp = self.search()
+        self.assertEqual(resp.headers['X-Search-Next-Marker'], 'abc')
+        resp = self.search()
+        self.assertEqual(self.execute.call_count, 1)
+        self.assertEqual(resp.headers['X-Search-Next-Marker'], 'abc')
+
+    def test_buffered_joins_chunks(self):
+        chunks = list(searcher.buffered(['ab', 'cd', 'e'], size=3))
+        self.assertEqual(chunks, ['abcd', 'e'])
+
+    def test_default_field_matches_prep(self):
+        with mock.patch.object(
+                searcher.index.Searcher, 'add_condition') as add_condition:
+            self.search('format=json&q=needle')
+            add_condition.assert_called_once_with(
+                searcher.prep.TEXT_FIELD, u'needle')
+            self.search('format=json&q=needle&field=name')
+            add_condition.assert_called_with('name', u'needle')
+
+    def test_no_cache_without_memcache(self):
+        self.memcache = None
+        self.search()
+        self.search()
+        self.assertEqual(self.execute.call_count, 2)
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = utils.LRUCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expires(self):
+        cache = utils.LRUCache(2, -1)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.config_file = tempfile.mkstemp()
+        os.write(fd, '[index]\nelastic_hosts = 127.0.0.1:9200\n')
+        os.close(fd)
+        self.app = searcher.SearchMiddleware(
+            mock.Mock(), {'config_file': self.config_file})
+        self.client = mock.Mock()
+        self.app.search_client = self.client
+        self.client.search_raw.return_value = {
+            '_scroll_id': 'scroll1', 'hits': {'total': 3, 'hits': []}}
+        self.client.search_scroll.side_effect = [
+            {'_scroll_id': 'scroll2', 'hits': {'hits': [
+                {'_source': {'name': 'a'}}, {'_source': {'name': 'b'}}]}},
+            {'_scroll_id': 'scroll3', 'hits': {'hits': [
+                {'_source': {'name': 'c'}}]}},
+            {'_scroll_id': 'scroll4', 'hits': {'hits': []}},
+        ]
+
+    def tearDown(self):
+        os.unlink(self.config_file)
+
+    def export(self, fmt='ndjson'):
+        req = swob.Request.blank(
+            '/search/AUTH_test/c?export=' + fmt,
+            environ={'swift.authorize': lambda req: None})
+        return req.get_response(self.app)
+
+    def test_export_streams_ndjson(self):
+        resp = self.export()
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.headers['X-Search-Items-Total'], '3')
+        lines = resp.body.splitlines()
+        self.assertEqual(
+            [searcher.json.loads(line)['name'] for line in lines],
+            ['a', 'b', 'c'])
+
+        search, = self.client.search_raw.call_args[0]
+        kwargs = self.client.search_raw.call_args[1]
+        self.assertEqual(kwargs['search_type'], 'scan')
+        self.assertEqual(kwargs['scroll'], '5m')
+        self.assertTrue('prefix' in str(search.serialize()))
+        self.client._send_request.assert_called_once_with(
+            'DELETE', '_search/scroll', 'scroll4')
+
+    def test_closing_stream_clears_scroll(self):
+        resp = self.export()
+        app_iter = iter(resp.app_iter)
+        next(app_iter)
+        resp.app_iter.close()
+        self.client._send_request.assert_called_once_with(
+            'DELETE', '_search/scroll', 'scroll2')
+
+    def test_closing_unstarted_stream_clears_scroll(self):
+        resp = self.export()
+        resp.app_iter.close()
+        self.assertFalse(self.client.search_scroll.called)
+        self.client._send_request.assert_called_once_with(
+            'DELETE', '_search/scroll', 'scroll1')
+
+    def test_unknown_export_format(self):
+        self.assertEqual(self.export('csv').status_int, 400)
@@ -0,0 +1,92 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from swearch import spool
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.path)
+                      if name.endswith(spool.SEGMENT_SUFFIX))
+
+    def test_append_read_ack(self):
+        s = spool.Spool(self.path)
+        s.append({'body': 'a'})
+        s.append({'body': 'b'})
+        records = s.read(10, timeout=0)
+        self.assertEqual([r['body'] for seg, r in records], ['a', 'b'])
+        self.assertEqual(s.read(10, timeout=0), [])
+        for seg, r in records:
+            s.ack(seg)
+        self.assertEqual(s.outstanding[0], 0)
+
+    def test_rotates_and_removes_acked_segments(self):
+        s = spool.Spool(self.path, segment_bytes=1)
+        for body in 'abc':
+            s.append({'body': body})
+        self.assertEqual(len(self.segments()), 3)
+
+        records = s.read(2, timeout=0)
+        self.assertEqual([r['body'] for seg, r in records], ['a', 'b'])
+        s.ack(records[0][0])
+        self.assertEqual(len(self.segments()), 2)
+        # b's segment is still being read from
+        s.ack(records[1][0])
+        self.assertEqual(len(self.segments()), 2)
+        s.read(1, timeout=0)
+        self.assertEqual(len(self.segments()), 1)
+
+    def test_replays_unacked_records(self):
+        s = spool.Spool(self.path)
+        s.append({'body': 'a'})
+        s.append({'body': 'b'})
+        s.read(1, timeout=0)
+        s.lock_file.close()
+
+        s = spool.Spool(self.path)
+        self.assertEqual([r['body'] for seg, r in s.read(10, timeout=0)],
+                         ['a', 'b'])
+
+    def test_skips_torn_record(self):
+        s = spool.Spool(self.path)
+        s.append({'body': 'a'})
+        s.writer.write(spool.RECORD_HEADER.pack(100, 0) + '{"bo')
+        s.writer.flush()
+        s.lock_file.close()
+
+        s = spool.Spool(self.path)
+        s.append({'body': 'b'})
+        self.assertEqual([r['body'] for seg, r in s.read(10, timeout=0)],
+                         ['a', 'b'])
+
+    def test_sync_fsyncs_new_records(self):
+        s = spool.Spool(self.path)
+        with mock.patch.object(spool.os, 'fsync') as fsync:
+            s.sync()
+            self.assertFalse(fsync.called)
+            s.append({'body': 'a'})
+            s.sync()
+            s.sync()
+        fsync.assert_called_once_with(s.writer.fileno())
+
+    def test_full(self):
+        s = spool.Spool(self.path, max_bytes=30)
+        s.append({'body': 'a'})
+        self.assertRaises(spool.SpoolFull, s.append, {'body': 'b'})
+
+    def test_open_spool_skips_locked(self):
+        first = spool.open_spool(self.path)
+        second = spool.open_spool(self.path)
+        self.assertEqual(first.path, os.path.join(self.path, '0'))
+        self.assertEqual(second.path, os.path.join(self.path, '1'))
+        self.assertRaises(spool.SpoolLocked, spool.Spool, first.path)